@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Smart Notes Benchmarks
+Times NotesManager operations and the data side of the sidebar refresh
+on synthetic note collections, without opening a window.
+
+Examples:
+    python benchmark.py
+    python benchmark.py --sizes 1k,10k,100k --backends journal,sqlite --output results.json
+    python benchmark.py --compare results.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import smartnotes
+import smartnotes_core
+
+SIZE_SUFFIXES = {"k": 1000, "m": 1000000}
+WORDS = [
+    "meeting", "project", "idea", "todo", "review", "design", "notes", "budget", "release", "customer",
+    "python", "storage", "search", "index", "journal", "sidebar", "theme", "draft", "summary", "follow",
+    "deadline", "schedule", "research", "question", "answer", "plan", "risk", "feature", "bug", "fix",
+]
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    if text[-1:] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def make_vocabulary(rng, size=20000):
+    """Common words plus made-up ones, so word frequencies have a long tail"""
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    extra = {"".join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(size)}
+    return WORDS + sorted(extra)
+
+
+def generate_notes(count, seed=1):
+    """A reproducible list of note dicts with varied sizes.
+
+    Word counts follow a log-normal distribution: most notes are a few dozen
+    words, a few run to thousands.
+    """
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(vocabulary))))
+    start = datetime(2024, 1, 1)
+    notes = []
+    for note_id in range(1, count + 1):
+        length = min(int(rng.lognormvariate(3.7, 1.0)) + 1, 5000)
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=length)
+        lines = [" ".join(words[i:i + 12]) for i in range(0, len(words), 12)]
+        timestamp = (start + timedelta(seconds=note_id * 37)).strftime("%Y-%m-%d %H:%M:%S")
+        notes.append({
+            "id": note_id,
+            "title": " ".join(rng.choices(vocabulary[:200], k=rng.randint(1, 5))).title(),
+            "content": "\n".join(lines),
+            "created_at": timestamp,
+            "updated_at": timestamp,
+        })
+    return notes
+
+
+class StubTree:
+    """Just enough of ttk.Treeview for the sidebar code to run against"""
+
+    def __init__(self):
+        self.rows = []
+        self.values = {}
+
+    def get_children(self):
+        return tuple(self.rows)
+
+    def delete(self, *iids):
+        removed = set(iids)
+        self.rows = [iid for iid in self.rows if iid not in removed]
+
+    def move(self, iid, parent, position):
+        self.rows.remove(iid)
+        self.rows.insert(position, iid)
+
+    def insert(self, parent, position, iid, text="", values=()):
+        self.rows.insert(position, iid)
+        self.values[iid] = values
+
+    def item(self, iid, values=()):
+        self.values[iid] = values
+
+    def exists(self, iid):
+        return iid in self.values
+
+    def selection_set(self, iid):
+        pass
+
+    def see(self, iid):
+        pass
+
+    def yview(self):
+        # As if about 30 rows fit in the window
+        return 0.0, min(1.0, 30 / max(len(self.rows), 1))
+
+    def yview_moveto(self, fraction):
+        pass
+
+
+class StubRoot:
+    """Runs idle callbacks straight away, so their cost is timed too"""
+
+    def after_idle(self, callback):
+        callback()
+
+
+def make_sidebar(notes_manager):
+    """A SmartNotesApp with only the sidebar state set up, on a StubTree"""
+    app = object.__new__(smartnotes.SmartNotesApp)
+    app.notes_manager = notes_manager
+    app.notes_list = StubTree()
+    app.sidebar_notes = []
+    app.sidebar_titles = {}
+    app.sidebar_virtual = False
+    app.sidebar_offset = 0
+    app.sidebar_window = 300
+    app.sidebar_virtual_threshold = 2000
+    app.sidebar_order = "recent"
+    app.relevance_results = 200
+    app.sidebar_query = None
+    app.sidebar_snippets = {}
+    app.root = StubRoot()
+    app.set_sidebar_row_lines = lambda lines: None
+    return app
+
+
+def summarize(operation, durations, **details):
+    durations = sorted(durations)
+    count = len(durations)
+    result = {
+        "operation": operation,
+        "runs": count,
+        "total_s": round(sum(durations), 6),
+        "mean_ms": round(sum(durations) / count * 1000, 6),
+        "p50_ms": round(durations[count // 2] * 1000, 6),
+        "p95_ms": round(durations[min(count - 1, int(count * 0.95))] * 1000, 6),
+        "max_ms": round(durations[-1] * 1000, 6),
+    }
+    result.update(details)
+    return result
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+
+def run_backend(backend, size, args, log):
+    """All operations for one storage backend and collection size"""
+    results = []
+    directory = tempfile.mkdtemp(prefix="smartnotes-bench-")
+    path = os.path.join(directory, smartnotes_core.STORAGE_BACKENDS[backend].default_path)
+    rng = random.Random(args.seed)
+    try:
+        log(f"{backend} / {size:,} notes: generating")
+        notes = generate_notes(size, args.seed)
+        content_bytes = sum(len(note["content"]) for note in notes)
+        storage = smartnotes_core.create_storage(backend, path)
+        storage.save_all(notes)
+        storage.close()
+        del notes
+        bytes_on_disk = smartnotes_core.storage_size(path)
+
+        log(f"{backend} / {size:,} notes: loading")
+        durations = []
+        for _ in range(args.repeat):
+            storage = smartnotes_core.create_storage(backend, path)
+            duration, manager = timed(smartnotes_core.NotesManager, storage=storage, lazy=args.lazy)
+            durations.append(duration)
+            if len(durations) < args.repeat:
+                manager.close()
+        results.append(summarize("open_manager", durations))
+        results.append(summarize("load_notes", [timed(manager.load_notes)[0] for _ in range(args.repeat)]))
+
+        # Too quick to time one at a time: each run is a batch, reported per call
+        ids = [note["id"] for note in manager.notes]
+        lookups = [rng.choice(ids) for _ in range(args.lookups)]
+        durations = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            for note_id in lookups:
+                manager.get_note_by_id(note_id)
+            durations.append((time.perf_counter() - started) / len(lookups))
+        results.append(summarize("get_note_by_id", durations, calls_per_run=len(lookups)))
+
+        log(f"{backend} / {size:,} notes: searching")
+        vocabulary = make_vocabulary(random.Random(args.seed))
+        queries = [("words", "meeting"), ("words", "project budget"), ("words", "rele"),
+                   ("words", vocabulary[-1]), ("substring", "ing pro"), ("substring", "zzzq")]
+        for mode, query in queries:
+            manager.search_notes(query, mode)  # builds the index once in lazy mode
+            durations = [timed(manager.search_notes, query, mode)[0] for _ in range(args.repeat)]
+            results.append(summarize("search_notes", durations, mode=mode, query=query))
+        for mode, query in queries:
+            if mode == "words":
+                durations = [timed(manager.rank_notes, query, k=50)[0] for _ in range(args.repeat)]
+                results.append(summarize("rank_notes", durations, query=query, k=50))
+
+        sidebar = make_sidebar(manager)
+        sidebar.refresh_notes_list()
+        durations = []
+        for _ in range(args.repeat):
+            manager.update_note(rng.choice(ids), content="moved to the top")
+            durations.append(timed(sidebar.refresh_notes_list)[0])
+        results.append(summarize("refresh_notes_list", durations, query=None))
+        durations = [timed(sidebar.refresh_notes_list, "project")[0] for _ in range(args.repeat)]
+        results.append(summarize("refresh_notes_list", durations, query="project"))
+        # Best 200 matches, with snippets for the rows in view
+        sidebar.sidebar_order = "relevance"
+        durations = []
+        for _ in range(args.repeat):
+            sidebar.refresh_notes_list()
+            durations.append(timed(sidebar.refresh_notes_list, "project")[0])
+        results.append(summarize("refresh_notes_list", durations, query="project", order="relevance"))
+        sidebar.sidebar_order = "recent"
+
+        log(f"{backend} / {size:,} notes: writing")
+        manager.autosave = True
+        durations = [timed(manager.add_note, f"Bench {i}", "benchmark note body " * 20)[0]
+                     for i in range(args.operations)]
+        results.append(summarize("add_note", durations))
+        durations = [timed(manager.update_note, rng.choice(ids), content=f"updated body {i} " * 20)[0]
+                     for i in range(args.operations)]
+        results.append(summarize("update_note", durations))
+
+        # Batched saves: a burst of edits written by one save_notes()
+        manager.autosave = False
+        durations = []
+        for _ in range(args.repeat):
+            for i in range(100):
+                manager.update_note(rng.choice(ids), content=f"batched edit {i}")
+            durations.append(timed(manager.save_notes)[0])
+        results.append(summarize("save_notes", durations, dirty_notes=100))
+        manager.autosave = True
+
+        victims = rng.sample(ids, min(args.operations, len(ids)))
+        results.append(summarize("delete_note", [timed(manager.delete_note, i)[0] for i in victims]))
+        manager.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    for result in results:
+        result.update(backend=backend, notes=size)
+    results.append({"operation": "corpus", "backend": backend, "notes": size, "content_bytes": content_bytes,
+                    "bytes_on_disk": bytes_on_disk})
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def result_key(result):
+    return (result["backend"], result["notes"], result["operation"], result.get("mode"), result.get("query"))
+
+
+def compare(baseline_file, results, threshold, min_ms):
+    """Print mean times against a previous run; returns how many regressed
+
+    A regression is a mean more than threshold times the baseline's, and
+    slower by at least min_ms so timer noise on tiny operations is ignored.
+    """
+    with open(baseline_file, 'r') as file:
+        baseline = {result_key(r): r for r in json.load(file)["results"] if "mean_ms" in r}
+    regressions = 0
+    print(f"{'backend':10} {'notes':>9} {'operation':32} {'before ms':>11} {'after ms':>11} {'ratio':>7}")
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None or "mean_ms" not in result:
+            continue
+        ratio = result["mean_ms"] / old["mean_ms"] if old["mean_ms"] else float("inf")
+        flag = ""
+        if ratio > threshold and result["mean_ms"] - old["mean_ms"] >= min_ms:
+            flag = "  REGRESSION"
+            regressions += 1
+        name = result["operation"] + (f" [{result['query']}]" if result.get("query") else "")
+        print(f"{result['backend']:10} {result['notes']:>9,} {name[:32]:32} {old['mean_ms']:>11.4f} "
+              f"{result['mean_ms']:>11.4f} {ratio:>7.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Smart Notes storage, search and sidebar code")
+    parser.add_argument("--sizes", default="1k,10k", help="note counts, e.g. 1k,10k,100k,1m (default: 1k,10k)")
+    parser.add_argument("--backends", default=smartnotes_core.DEFAULT_STORAGE_BACKEND,
+                        help="comma-separated storage backends: " + ", ".join(smartnotes_core.STORAGE_BACKENDS))
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each bulk operation (default: 5)")
+    parser.add_argument("--operations", type=int, default=200, help="single-note adds/updates/deletes timed")
+    parser.add_argument("--lookups", type=int, default=10000, help="get_note_by_id calls timed")
+    parser.add_argument("--lazy", action="store_true", help="load metadata only, where the backend supports it")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against an earlier --output file")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio reported as a regression by --compare (default: 1.25)")
+    parser.add_argument("--min-ms", type=float, default=0.05,
+                        help="smallest slowdown in ms --compare reports (default: 0.05)")
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    backends = [backend.strip() for backend in args.backends.split(",")]
+    for backend in backends:
+        if backend not in smartnotes_core.STORAGE_BACKENDS:
+            parser.error(f"unknown backend {backend!r}")
+
+    def log(message):
+        print(message, file=sys.stderr, flush=True)
+
+    results = []
+    for size in sizes:
+        for backend in backends:
+            results.extend(run_backend(backend, size, args, log))
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "lazy": args.lazy,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        log(f"Results written to {args.output}")
+    elif not args.compare:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        if compare(args.compare, results, args.threshold, args.min_ms):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
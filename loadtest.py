@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Smart Notes API Load Test
+Drives the HTTP API (smartnotes_cli.py serve) with a mix of reads and
+writes from several client threads, then reports requests per second and
+latency percentiles for each kind of request.
+
+Without --url a server is started on a temporary store seeded with
+--notes generated notes, and stopped at the end.
+
+Examples:
+    python loadtest.py
+    python loadtest.py --clients 16 --duration 20 --write-ratio 0.3 --backend sqlite
+    python loadtest.py --url http://127.0.0.1:8765 --token secret
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote, urlsplit
+
+import smartnotes_core
+
+WORDS = ["meeting", "project", "idea", "todo", "review", "design", "budget", "release", "customer", "draft",
+         "plan", "report", "travel", "recipe", "research", "bug", "feature", "sprint", "call", "invoice"]
+# Share of reads and of writes taken by each kind of request
+READ_MIX = {"get": 0.7, "list": 0.15, "search": 0.15}
+WRITE_MIX = {"update": 0.75, "create": 0.25}
+
+
+def random_text(rng, words):
+    return " ".join(rng.choices(WORDS, k=words))
+
+
+def start_server(backend, notes, seed):
+    """Seed a temporary store and serve it; returns (process, url, directory)"""
+    directory = tempfile.mkdtemp(prefix="smartnotes-load-")
+    path = os.path.join(directory, smartnotes_core.STORAGE_BACKENDS[backend].default_path)
+    rng = random.Random(seed)
+    manager = smartnotes_core.NotesManager(storage=smartnotes_core.create_storage(backend, path), autosave=False)
+    manager.add_notes([(random_text(rng, 4), random_text(rng, rng.randint(20, 400))) for _ in range(notes)])
+    manager.close()
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), "smartnotes_cli.py")
+    process = subprocess.Popen([sys.executable, cli, "--backend", backend, "--path", path, "serve", "--port", "0"],
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith("Serving notes on "):
+        process.kill()
+        raise RuntimeError("The server didn't start")
+    return process, line.split()[3].rstrip("/"), directory
+
+
+class Client:
+    """One keep-alive connection issuing a random mix of requests"""
+
+    def __init__(self, url, token, write_ratio, note_ids, seed):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        self.headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self.write_ratio = write_ratio
+        self.note_ids = note_ids
+        self.rng = random.Random(seed)
+        # Last ETag seen for each note, sent as If-Match on updates
+        self.etags = {}
+        self.latencies = {name: [] for name in list(READ_MIX) + list(WRITE_MIX)}
+        self.conflicts = 0
+        self.errors = 0
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(self.headers, **(headers or {}))
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        return response.status, response.getheader("ETag"), data
+
+    def run(self, deadline):
+        while time.perf_counter() < deadline:
+            if self.rng.random() < self.write_ratio:
+                kind = self.rng.choices(list(WRITE_MIX), weights=list(WRITE_MIX.values()))[0]
+            else:
+                kind = self.rng.choices(list(READ_MIX), weights=list(READ_MIX.values()))[0]
+            start = time.perf_counter()
+            try:
+                ok = getattr(self, "do_" + kind)()
+            except (OSError, http.client.HTTPException):
+                self.connection.close()
+                ok = False
+            if ok:
+                self.latencies[kind].append(time.perf_counter() - start)
+            else:
+                self.errors += 1
+
+    def do_get(self):
+        note_id = self.rng.choice(self.note_ids)
+        status, etag, _ = self.request("GET", f"/notes/{note_id}")
+        if status == 200:
+            self.etags[note_id] = etag
+        return status in (200, 404)
+
+    def do_list(self):
+        return self.request("GET", "/notes?limit=50")[0] == 200
+
+    def do_search(self):
+        query = quote(self.rng.choice(WORDS)[:4])
+        return self.request("GET", f"/search?q={query}&limit=20")[0] == 200
+
+    def do_update(self):
+        note_id = self.rng.choice(self.note_ids)
+        headers = {"If-Match": self.etags[note_id]} if note_id in self.etags else {}
+        status, etag, _ = self.request("PUT", f"/notes/{note_id}",
+                                       {"content": random_text(self.rng, self.rng.randint(20, 400))}, headers)
+        if status == 200:
+            self.etags[note_id] = etag
+        elif status == 412:
+            # Another client changed it first: the stale update was refused
+            self.conflicts += 1
+            self.etags.pop(note_id, None)
+        return status in (200, 404, 412)
+
+    def do_create(self):
+        status, etag, data = self.request("POST", "/notes", {"title": random_text(self.rng, 4),
+                                                             "content": random_text(self.rng, 50)})
+        return status == 201
+
+
+def fetch_note_ids(url, token, most):
+    """Ids of up to most notes, paging through GET /notes"""
+    client = Client(url, token, 0, [], 0)
+    note_ids, cursor = [], None
+    while len(note_ids) < most:
+        path = "/notes?limit=500" + (f"&cursor={quote(cursor)}" if cursor else "")
+        status, _, data = client.request("GET", path)
+        if status != 200:
+            raise RuntimeError(f"GET /notes failed with status {status}")
+        page = json.loads(data)
+        note_ids.extend(note["id"] for note in page["notes"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    return note_ids[:most]
+
+
+def percentile(samples, percent):
+    return samples[min(int(len(samples) * percent / 100), len(samples) - 1)] if samples else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Smart Notes HTTP API")
+    parser.add_argument("--url", help="server to test (default: start one on a temporary store)")
+    parser.add_argument("--token", help="API token the server was started with")
+    parser.add_argument("--backend", default=smartnotes_core.DEFAULT_STORAGE_BACKEND,
+                        choices=sorted(smartnotes_core.STORAGE_BACKENDS), help="backend of the temporary store")
+    parser.add_argument("--notes", type=int, default=10000, help="notes in the temporary store (default: 10000)")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent connections (default: 8)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run (default: 10)")
+    parser.add_argument("--write-ratio", type=float, default=0.2, help="share of writes (default: 0.2)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    server = directory = None
+    url = args.url
+    if url is None:
+        server, url, directory = start_server(args.backend, args.notes, args.seed)
+    try:
+        note_ids = fetch_note_ids(url, args.token, 5000)
+        if not note_ids:
+            parser.error("the server has no notes to read")
+        clients = [Client(url, args.token, args.write_ratio, note_ids, args.seed + i) for i in range(args.clients)]
+        deadline = time.perf_counter() + args.duration
+        started = time.perf_counter()
+        threads = [threading.Thread(target=client.run, args=(deadline,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    operations = {}
+    for name in list(READ_MIX) + list(WRITE_MIX):
+        samples = sorted(sample for client in clients for sample in client.latencies[name])
+        operations[name] = {
+            "requests": len(samples),
+            "per_second": len(samples) / elapsed,
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000
+        }
+    total = sum(operation["requests"] for operation in operations.values())
+    report = {
+        "url": url,
+        "clients": args.clients,
+        "seconds": elapsed,
+        "write_ratio": args.write_ratio,
+        "requests": total,
+        "per_second": total / elapsed,
+        "conflicts": sum(client.conflicts for client in clients),
+        "errors": sum(client.errors for client in clients),
+        "operations": operations
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['requests']} requests in {elapsed:.1f} s from {args.clients} clients: "
+          f"{report['per_second']:.0f} requests/s ({report['conflicts']} stale updates refused, "
+          f"{report['errors']} errors)")
+    print(f"{'operation':10} {'requests':>9} {'per sec':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, operation in operations.items():
+        print(f"{name:10} {operation['requests']:>9} {operation['per_second']:>9.0f} {operation['p50_ms']:>8.2f} "
+              f"{operation['p95_ms']:>8.2f} {operation['p99_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
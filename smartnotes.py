@@ -1,98 +1,27 @@
 import tkinter as tk
 from tkinter import filedialog, ttk, messagebox
-import os
-import json
-from datetime import datetime
-try:
-    import google.generativeai as genai
-    GENAI_AVAILABLE = True
-except ImportError:
-    GENAI_AVAILABLE = False
-    genai = None
-# API key will be loaded from config
-
-# Notes management class
-class NotesManager:
-    def __init__(self, notes_file="smart_notes.json"):
-        self.notes_file = notes_file
-        self.notes = self.load_notes()
-
-    def load_notes(self):
-        if os.path.exists(self.notes_file):
-            try:
-                with open(self.notes_file, 'r') as file:
-                    return json.load(file)
-            except json.JSONDecodeError:
-                return []
-        return []
-
-    def save_notes(self):
-        with open(self.notes_file, 'w') as file:
-            json.dump(self.notes, file, indent=2)
-
-    def add_note(self, title, content):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        note_id = self._get_next_id()
-
-        new_note = {
-            "id": note_id,
-            "title": title,
-            "content": content,
-            "created_at": timestamp,
-            "updated_at": timestamp
-        }
-
-        self.notes.append(new_note)
-        self.save_notes()
-        return note_id
-
-    def _get_next_id(self):
-        if not self.notes:
-            return 1
-        return max(note["id"] for note in self.notes) + 1
-
-    def update_note(self, note_id, title=None, content=None):
-        for note in self.notes:
-            if note["id"] == note_id:
-                if title is not None:
-                    note["title"] = title
-                if content is not None:
-                    note["content"] = content
-                note["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.save_notes()
-                return True
-        return False
-
-    def delete_note(self, note_id):
-        for i, note in enumerate(self.notes):
-            if note["id"] == note_id:
-                del self.notes[i]
-                self.save_notes()
-                return True
-        return False
-
-    def search_notes(self, query):
-        query = query.lower()
-        results = []
-
-        for note in self.notes:
-            if query in note["title"].lower() or query in note["content"].lower():
-                results.append(note)
-
-        return results
-
-    def get_all_notes(self):
-        return self.notes
-
-    def get_note_by_id(self, note_id):
-        for note in self.notes:
-            if note["id"] == note_id:
-                return note
-        return None
+import tkinter.font as tkfont
+import argparse
+import queue
+import threading
+import time
+
+STARTED_AT = time.perf_counter()
+
+# Everything that doesn't need a window lives in smartnotes_core, which
+# scripts can import without loading Tkinter
+import smartnotes_core
+from smartnotes_core import (
+    AIWorker, AutosaveWriter, BackgroundSearch, BatchJobRunner, BATCH_ACTIONS, CachedBackend,
+    ChunkedBackend, GeminiBackend, METRICS, NotesManager, NUMPY_AVAILABLE, PromptBuilder,
+    ResponseCache, STORAGE_BACKENDS, create_storage, export_notes, import_notes, load_config,
+    make_snippet, migrate_storage, save_config
+)
+
 
 # Main application
 class SmartNotesApp:
-    def __init__(self, root):
+    def __init__(self, root, ai_backend=None):
         self.root = root
         self.root.geometry(f"{1280}x{720}")
         self.root.title("Personal Note-Taking App // A.K.A : smart notes")
@@ -101,16 +30,110 @@ class SmartNotesApp:
 
         self.current_theme = "dark"
         self.focus = None
-        self.notes_manager = NotesManager()
+        self.config = load_config()
+        self.notes_manager = NotesManager(storage=create_storage(), lazy=self.config.get("lazy_load", True),
+                                          autosave=False)
         self.current_note_id = None
+
+        # Editor text is copied into the note shortly after typing; a writer
+        # thread then saves bursts of changes together, off the Tk thread
+        self.autosave_writer = AutosaveWriter(
+            self.notes_manager,
+            quiet_period=self.config.get("autosave_quiet_seconds", 2.0),
+            max_delay=self.config.get("autosave_max_delay_seconds", 10.0)
+        )
+        self.autosave_interval_ms = self.config.get("autosave_interval_ms", 1000)
+        self.editor_dirty = False
+        self.editor_commit_id = None
+        self.save_status_poll_id = None
+        # Notes saved meanwhile by other windows, the command line or the
+        # API server are picked up on this timer (0 turns it off)
+        self.external_poll_ms = self.config.get("external_poll_ms", 1000)
+        self.external_poll_id = None
+        # Set while a worker thread reads other processes' changes
+        self.external_sync_id = None
+
+        # Notes this long are loaded into the editor a chunk at a time, and
+        # saved by copying only the lines edited since the last save. In
+        # that mode editor_lines holds the note's lines as last saved, and
+        # the clean prefix/suffix count the lines at either end untouched
+        self.large_document_threshold = self.config.get("large_document_chars", 1000000)
+        self.editor_chunk_chars = 65536
+        self.editor_lines = None
+        self.editor_loading = False
+        self.editor_load_generation = 0
+        self.editor_clean_prefix = 0
+        self.editor_clean_suffix = 0
         self.api_key = self.load_api_key()
 
+        # AI requests stream back from a worker thread; a custom backend
+        # (anything with a stream(prompt) method) skips the Gemini checks
+        self.custom_ai_backend = ai_backend is not None
+        ttl_hours = self.config.get("ai_cache_ttl_hours")
+        self.ai_cache = ResponseCache(
+            max_disk_bytes=int(self.config.get("ai_cache_max_mb", 50) * 1024 * 1024),
+            ttl=ttl_hours * 3600 if ttl_hours else None
+        )
+        self.gemini = GeminiBackend(self.config.get("ai_model", "gemini-1.5-flash"), api_key=self.api_key)
+        backend = ai_backend if ai_backend is not None else self.gemini
+        # Prompts are sized to a token budget before they reach the model;
+        # oversized input is condensed in chunks first
+        self.prompt_builder = PromptBuilder(
+            max_tokens=self.config.get("ai_max_prompt_tokens", 8000),
+            context_tokens=self.config.get("ai_context_tokens", 1500),
+            chunk_tokens=self.config.get("ai_chunk_tokens", 4000)
+        )
+        self.ai_backend = ChunkedBackend(CachedBackend(backend, self.ai_cache), self.prompt_builder,
+                                         concurrency=self.config.get("ai_batch_concurrency", 4))
+        self.ai_worker = AIWorker(self.ai_backend)
+        self.batch_runner = None
+        self.ai_request_id = None
+        self.ai_response_started = False
+        self.ai_poll_id = None
+        self.diagnostics_window = None
+        # Notes most similar to the prompt are sent along with it (needs numpy)
+        self.ai_context_notes = self.config.get("ai_context_notes", 3)
+
+        # Sidebar search runs on a worker thread after a short typing pause
+        self.background_search = BackgroundSearch(self.notes_manager)
+        self.search_debounce_ms = self.config.get("search_debounce_ms", 150)
+        self.search_after_id = None
+        self.search_poll_id = None
+
+        # Sidebar rows currently listed, and the slice of them materialized
+        # in the Treeview once there are too many to insert them all
+        self.sidebar_notes = []
+        self.sidebar_titles = {}
+        self.sidebar_virtual = False
+        self.sidebar_offset = 0
+        self.sidebar_window = 300
+        self.sidebar_virtual_threshold = self.config.get("sidebar_virtual_threshold", 2000)
+        # "recent" lists search results newest first; "relevance" lists the
+        # relevance_results best matches, best first, each with a snippet of
+        # the matching text. Snippets are made only for rows scrolled into
+        # view, and kept per note id as ((query, updated_at), snippet)
+        self.sidebar_order = self.config.get("sidebar_order", "recent")
+        self.relevance_results = self.config.get("relevance_results", 200)
+        self.sidebar_query = None
+        self.sidebar_snippets = {}
+
         # Initialize theme colors
         self.update_theme_colors()
 
         self.setup_ui()
         self.setup_bindings()
         self.refresh_notes_list()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        if self.external_poll_ms:
+            self.external_poll_id = self.root.after(self.external_poll_ms, self.poll_external_changes)
+
+        # Import Gemini and build the model once the window is up, so the
+        # first AI request doesn't pay for it
+        if ai_backend is None and self.api_key and smartnotes_core.GENAI_AVAILABLE:
+            self.root.after(300, lambda: threading.Thread(target=self.gemini.warm, daemon=True).start())
+        # Likewise vectorize the notes before the first AI request needs them
+        if self.ai_context_notes and NUMPY_AVAILABLE and (self.custom_ai_backend or self.api_key):
+            self.root.after(1000, lambda: self.notes_manager.ensure_semantic_index(wait=False))
 
     def update_theme_colors(self):
         """Update theme color variables based on current theme"""
@@ -182,12 +205,17 @@ class SmartNotesApp:
         self.search_frame.grid(row=0, column=0, sticky="ew", padx=5, pady=5)
 
         self.search_var = tk.StringVar()
-        self.search_var.trace("w", lambda *args: self.search_notes())
+        self.search_var.trace("w", lambda *args: self.schedule_search())
         self.search_entry = tk.Entry(self.search_frame, textvariable=self.search_var,
                                     bg=self.entry_bg, fg=self.entry_fg, font="Helvetica 13",
                                     insertbackground=self.entry_fg, relief=tk.FLAT, bd=8,
                                     highlightthickness=1, highlightcolor="#1A73E8")
         self.search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.order_var = tk.StringVar(value=self.sidebar_order)
+        order_box = ttk.Combobox(self.search_frame, textvariable=self.order_var, values=("recent", "relevance"),
+                                 state="readonly", width=9)
+        order_box.pack(side=tk.RIGHT, padx=(5, 0))
+        order_box.bind("<<ComboboxSelected>>", self.change_sidebar_order)
 
         # Notes list with Treeview
         self.notes_list_frame = tk.Frame(self.sidebar_frame, bg=self.sidebar_bg)
@@ -204,11 +232,16 @@ class SmartNotesApp:
                         borderwidth=0)
         style.map('Treeview', background=[('selected', self.tree_select_bg)])
 
-        self.notes_list = ttk.Treeview(self.notes_list_frame, columns=("title",), show="tree")
+        # Rows get a second line for the snippet when ranked by relevance
+        self.sidebar_line_height = tkfont.nametofont("TkDefaultFont").metrics("linespace")
+        style.configure("Sidebar.Treeview", rowheight=self.sidebar_line_height + 6)
+        self.notes_list = ttk.Treeview(self.notes_list_frame, columns=("title",), show="tree",
+                                       style="Sidebar.Treeview")
         self.notes_list.grid(row=0, column=0, sticky="nsew")
         self.notes_list.column("#0", width=30)
         self.notes_list.column("title", width=170)
         self.notes_list.bind("<<TreeviewSelect>>", self.on_note_select)
+        self.notes_list.config(yscrollcommand=self.on_sidebar_scroll)
 
         # Main text editor with frame
         self.main_editor_frame = tk.Frame(self.main_frame, bg=self.textbox_border, relief=tk.FLAT, bd=2)
@@ -221,6 +254,12 @@ class SmartNotesApp:
                              relief=tk.FLAT, bd=0, highlightthickness=0, selectbackground=self.tree_select_bg)
         self.txtBox.grid(row=0, column=0, sticky="nsew", padx=2, pady=2)
         self.txtBox.bind("<FocusIn>", self.focus_changed)
+        self.txtBox.bind("<<Modified>>", self.on_editor_modified)
+        self.install_editor_proxy()
+
+        self.save_status_label = tk.Label(self.main_editor_frame, text="All changes saved", anchor="e",
+                                          bg=self.textbox_border, fg=self.fg_color, font=("Segoe UI", 9))
+        self.save_status_label.grid(row=1, column=0, sticky="ew", padx=2, pady=(0,2))
 
         # AI assistant section with frame
         self.ai_input_frame = tk.Frame(self.main_frame, bg=self.textbox_border, relief=tk.FLAT, bd=2)
@@ -243,8 +282,9 @@ class SmartNotesApp:
         self.ai_response_frame.grid_rowconfigure(0, weight=1)
         self.ai_response_frame.grid_columnconfigure(0, weight=1)
 
-        tk.Label(self.ai_response_frame, text="AI Response", bg=self.textbox_border, fg=self.fg_color,
-                font=("Segoe UI", 10, "bold")).grid(row=0, column=0, sticky="ew", padx=2, pady=(2,0))
+        self.ai_response_label = tk.Label(self.ai_response_frame, text="AI Response", bg=self.textbox_border, fg=self.fg_color,
+                                          font=("Segoe UI", 10, "bold"))
+        self.ai_response_label.grid(row=0, column=0, sticky="ew", padx=2, pady=(2,0))
 
         self.bubble = tk.Text(self.ai_response_frame, wrap=tk.WORD, font="Helvetica 15",
                              bg=self.bg_color, fg=self.fg_color, insertbackground=self.fg_color,
@@ -260,10 +300,15 @@ class SmartNotesApp:
             ("Clear", self.clear_notes),
             ("Tutorial", self.tutorial),
             ("AI", self.ai_assist),
+            ("Batch AI", self.batch_ai),
+            ("Stop AI", self.cancel_ai),
             ("Assign API", self.assign_api),
             ("Theme", self.change_theme),
             ("Delete", self.delete_note),
-            ("Export", self.export_note)
+            ("History", self.show_history),
+            ("Export", self.export_note),
+            ("Export All", self.export_all_notes),
+            ("Import", self.import_folder)
         ]
 
         for i, (text, command) in enumerate(buttons):
@@ -283,8 +328,12 @@ class SmartNotesApp:
         self.root.bind("<Control-n>", lambda event: self.new_note())
         self.root.bind("<Control-Alt-c>", lambda event: self.clear_notes())
         self.root.bind("<Control-Alt-d>", lambda event: self.ai_assist())
+        self.root.bind("<Control-Alt-r>", lambda event: self.ai_assist(fresh=True))
+        self.root.bind("<Control-Alt-x>", lambda event: self.cancel_ai())
         self.root.bind("<Control-Alt-f>", lambda event: self.create_sample_note())
         self.root.bind("<Control-Delete>", lambda event: self.delete_note())
+        self.root.bind("<Control-Alt-m>", lambda event: self.show_diagnostics())
+        self.root.bind("<Control-Alt-h>", lambda event: self.show_history())
 
     def focus_changed(self, event):
         focused_widget = event.widget
@@ -296,25 +345,200 @@ class SmartNotesApp:
             elif focused_widget == self.bubble:
                 self.focus = "c"
 
-    def refresh_notes_list(self, search_query=None):
-        # Clear existing items
-        self.notes_list.delete(*self.notes_list.get_children())
-
-        # Get notes, either all or search results
-        notes = self.notes_manager.search_notes(search_query) if search_query else self.notes_manager.get_all_notes()
-
-        # Sort by most recently updated
-        notes.sort(key=lambda x: x["updated_at"], reverse=True)
-
-        # Add to treeview
-        for note in notes:
-            note_id = str(note["id"])
-            self.notes_list.insert("", tk.END, note_id, text="", values=(note["title"],))
+    @METRICS.timed("sidebar.refresh")
+    def refresh_notes_list(self, search_query=None, notes=None):
+        # Get notes, most recently updated first; all notes come presorted
+        # from NotesManager, search results are few enough to sort here. In
+        # relevance order, results passed in are already ranked (see
+        # BackgroundSearch)
+        relevance = self.sidebar_order == "relevance" and bool(search_query)
+        if notes is None and not search_query:
+            notes = self.notes_manager.get_notes_by_recency()
+        elif relevance:
+            if notes is None:
+                notes = [note for note, score in self.notes_manager.rank_notes(
+                    search_query, self.notes_manager.search_notes(search_query), self.relevance_results)]
+        else:
+            if notes is None:
+                notes = self.notes_manager.search_notes(search_query)
+            notes = sorted(notes, key=lambda x: x["updated_at"], reverse=True)
+
+        query = search_query if relevance else None
+        if query != self.sidebar_query:
+            self.sidebar_snippets = {}
+            if (query is None) != (self.sidebar_query is None):
+                self.set_sidebar_row_lines(1 if query is None else 2)
+        self.sidebar_query = query
+        self.sidebar_notes = notes
+        self.sidebar_virtual = len(notes) > self.sidebar_virtual_threshold
+        self.render_sidebar()
+
+    def render_sidebar(self):
+        """Bring the Treeview in line with sidebar_notes.
+
+        In virtual mode only sidebar_window rows starting at sidebar_offset
+        exist in the Treeview; scrolling near either end slides the window.
+        """
+        if self.sidebar_virtual:
+            last_offset = max(0, len(self.sidebar_notes) - self.sidebar_window)
+            self.sidebar_offset = min(max(self.sidebar_offset, 0), last_offset)
+            rows = self.sidebar_notes[self.sidebar_offset:self.sidebar_offset + self.sidebar_window]
+        else:
+            self.sidebar_offset = 0
+            rows = self.sidebar_notes
+        self.sync_tree_rows(rows)
+
+    def sync_tree_rows(self, notes):
+        """Insert, remove, move and retitle only the rows that changed"""
+        wanted = [str(note["id"]) for note in notes]
+        wanted_set = set(wanted)
+        current = self.notes_list.get_children()
+
+        stale = [iid for iid in current if iid not in wanted_set]
+        if stale:
+            self.notes_list.delete(*stale)
+            for iid in stale:
+                self.sidebar_titles.pop(iid, None)
+        current = [iid for iid in current if iid in wanted_set]
+        existing = set(current)
+
+        # Walk the wanted order; rows already in place are skipped, the rest
+        # are moved or inserted at their position
+        placed = set()
+        next_current = 0
+        for position, (iid, note) in enumerate(zip(wanted, notes)):
+            while next_current < len(current) and current[next_current] in placed:
+                next_current += 1
+            if next_current < len(current) and current[next_current] == iid:
+                next_current += 1
+            elif iid in existing:
+                self.notes_list.move(iid, "", position)
+            else:
+                self.notes_list.insert("", position, iid, text="", values=(self.sidebar_row_text(note),))
+                self.sidebar_titles[iid] = self.sidebar_row_text(note)
+            placed.add(iid)
+            text = self.sidebar_row_text(note)
+            if self.sidebar_titles.get(iid) != text:
+                self.notes_list.item(iid, values=(text,))
+                self.sidebar_titles[iid] = text
+        if self.sidebar_query is not None:
+            # Rows just put in view need their snippets
+            self.root.after_idle(lambda: self.show_snippets(*self.notes_list.yview()))
+
+    def set_sidebar_row_lines(self, lines):
+        ttk.Style().configure("Sidebar.Treeview", rowheight=self.sidebar_line_height * lines + 6)
+
+    def sidebar_row_text(self, note):
+        """The note's title, plus its snippet once it has been made"""
+        if self.sidebar_query is None:
+            return note["title"]
+        cached = self.sidebar_snippets.get(note["id"])
+        if cached is None or cached[0] != (self.sidebar_query, note["updated_at"]):
+            return note["title"]
+        return f"{note['title']}\n{cached[1]}"
+
+    def show_snippets(self, first, last):
+        """Make snippets for the rows in view that don't have a current one yet"""
+        if self.sidebar_query is None:
+            return
+        rows = self.notes_list.get_children()
+        start = int(float(first) * len(rows))
+        end = min(len(rows), int(float(last) * len(rows)) + 1)
+        for iid in rows[start:end]:
+            note = self.notes_manager.get_note_by_id(int(iid))
+            if note is None:
+                continue
+            key = (self.sidebar_query, note["updated_at"])
+            cached = self.sidebar_snippets.get(note["id"])
+            if cached is not None and cached[0] == key:
+                continue
+            self.sidebar_snippets[note["id"]] = (key, make_snippet(note["content"], self.sidebar_query, 60))
+            text = self.sidebar_row_text(note)
+            self.notes_list.item(iid, values=(text,))
+            self.sidebar_titles[iid] = text
+
+    def change_sidebar_order(self, event=None):
+        """Switch search results between newest first and best match first"""
+        self.sidebar_order = self.order_var.get()
+        config = load_config()
+        config["sidebar_order"] = self.sidebar_order
+        save_config(config)
+        self.search_notes()
+
+    def on_sidebar_scroll(self, first, last):
+        """Slide the virtual window when the view nears either end of it"""
+        self.show_snippets(first, last)
+        if not self.sidebar_virtual:
+            return
+        first, last = float(first), float(last)
+        shift = self.sidebar_window // 3
+        rows = self.notes_list.get_children()
+        if not rows:
+            return
+        top_row = first * len(rows)
+        if last > 0.9 and self.sidebar_offset + len(rows) < len(self.sidebar_notes):
+            old_offset = self.sidebar_offset
+            self.sidebar_offset += shift
+        elif first < 0.1 and self.sidebar_offset > 0:
+            old_offset = self.sidebar_offset
+            self.sidebar_offset -= shift
+        else:
+            return
+        self.render_sidebar()
+        # Keep the same note at the top of the view after the window moved
+        top_row += old_offset - self.sidebar_offset
+        self.notes_list.yview_moveto(top_row / max(len(self.notes_list.get_children()), 1))
+
+    def select_note_in_sidebar(self, note_id):
+        """Select a note, sliding the virtual window to it if needed"""
+        iid = str(note_id)
+        if self.sidebar_virtual and not self.notes_list.exists(iid):
+            ids = [note["id"] for note in self.sidebar_notes]
+            if note_id not in ids:
+                return
+            self.sidebar_offset = ids.index(note_id) - self.sidebar_window // 2
+            self.render_sidebar()
+        if self.notes_list.exists(iid):
+            self.notes_list.selection_set(iid)
+            self.notes_list.see(iid)
+
+    def schedule_search(self):
+        """Restart the debounce timer on each keystroke"""
+        if self.search_after_id is not None:
+            self.root.after_cancel(self.search_after_id)
+        self.search_after_id = self.root.after(self.search_debounce_ms, self.search_notes)
 
     def search_notes(self):
+        self.search_after_id = None
         query = self.search_var.get().strip()
-        self.refresh_notes_list(query if query else None)
+        if not query:
+            self.background_search.cancel()
+            if self.search_poll_id is not None:
+                self.root.after_cancel(self.search_poll_id)
+                self.search_poll_id = None
+            self.refresh_notes_list()
+            return
+        self.background_search.submit(query, self.relevance_results if self.sidebar_order == "relevance" else None)
+        if self.search_poll_id is None:
+            self.search_poll_id = self.root.after(15, self.poll_search_results)
+
+    def poll_search_results(self):
+        """Show finished searches, ignoring any that were superseded meanwhile"""
+        self.search_poll_id = None
+        latest = None
+        while True:
+            try:
+                result = self.background_search.results.get_nowait()
+            except queue.Empty:
+                break
+            if result[0] == self.background_search.generation:
+                latest = result
+        if latest is not None:
+            self.refresh_notes_list(latest[1], notes=latest[2])
+        else:
+            self.search_poll_id = self.root.after(15, self.poll_search_results)
 
+    @METRICS.timed("note.open")
     def on_note_select(self, event):
         selected_items = self.notes_list.selection()
         if not selected_items:
@@ -323,9 +547,10 @@ class SmartNotesApp:
         note_id = int(selected_items[0])
         note = self.notes_manager.get_note_by_id(note_id)
         if note:
+            # Keep any unsaved typing in the note being left
+            self.commit_editor()
             self.current_note_id = note_id
-            self.txtBox.delete(1.0, tk.END)
-            self.txtBox.insert(tk.END, note["content"])
+            self.load_editor(note["content"])
 
     def new_note(self):
         # Show a dialog to get the note title
@@ -344,12 +569,14 @@ class SmartNotesApp:
         def create_note():
             title = title_entry.get().strip()
             if title:
+                self.commit_editor()
                 note_id = self.notes_manager.add_note(title, "")
+                self.autosave_writer.notify()
                 self.current_note_id = note_id
-                self.txtBox.delete(1.0, tk.END)
+                self.load_editor("")
                 self.refresh_notes_list()
                 # Select the new note in the list
-                self.notes_list.selection_set(str(note_id))
+                self.select_note_in_sidebar(note_id)
                 title_window.destroy()
             else:
                 tk.Label(title_window, text="Title cannot be empty!", fg="#FF6B6B", bg=self.bg_color, font=("Segoe UI", 10)).pack()
@@ -364,8 +591,10 @@ class SmartNotesApp:
             self.new_note()
             return
 
-        content = self.txtBox.get("1.0", tk.END).strip()
-        success = self.notes_manager.update_note(self.current_note_id, content=content)
+        # Save right away instead of waiting for the autosave pause
+        self.editor_dirty = True
+        success = self.commit_editor()
+        self.autosave_writer.flush(wait=False)
 
         if success:
             # Update the note in the list if needed
@@ -379,9 +608,229 @@ class SmartNotesApp:
         if confirm:
             success = self.notes_manager.delete_note(self.current_note_id)
             if success:
+                self.autosave_writer.notify()
                 self.current_note_id = None
-                self.txtBox.delete(1.0, tk.END)
+                self.load_editor("")
                 self.refresh_notes_list()
+                self.update_save_status()
+
+    def on_editor_modified(self, event):
+        if not self.txtBox.edit_modified():
+            return
+        # Reset the flag so the next edit fires <<Modified>> again
+        self.txtBox.edit_modified(False)
+        if self.current_note_id is None or self.editor_loading:
+            return
+        self.editor_dirty = True
+        if self.editor_commit_id is None:
+            self.editor_commit_id = self.root.after(self.autosave_interval_ms, self.commit_editor)
+        self.update_save_status()
+
+    @METRICS.timed("note.commit")
+    def commit_editor(self):
+        """Copy the editor text into the current note if it was edited"""
+        if self.editor_commit_id is not None:
+            self.root.after_cancel(self.editor_commit_id)
+            self.editor_commit_id = None
+        if not self.editor_dirty or self.current_note_id is None or self.editor_loading:
+            return False
+        self.editor_dirty = False
+        if self.editor_lines is not None:
+            content = self.read_edited_lines()
+        else:
+            content = self.txtBox.get("1.0", "end-1c")
+            if len(content) >= self.large_document_threshold:
+                # Grew past the threshold; from now on only edits are copied
+                self.start_line_tracking(content)
+            else:
+                content = content.strip()
+        success = self.notes_manager.update_note(self.current_note_id, content=content)
+        self.autosave_writer.notify()
+        self.update_save_status()
+        return success
+
+    def load_editor(self, text):
+        """Replace the editor text without it counting as an edit"""
+        self.editor_load_generation += 1
+        self.editor_loading = False
+        self.txtBox.config(state=tk.NORMAL)
+        self.txtBox.delete("1.0", tk.END)
+        if len(text) >= self.large_document_threshold:
+            # Show the first screen now and append the rest between events,
+            # keeping the editor read-only until it is all there
+            self.start_line_tracking(text)
+            self.editor_loading = True
+            self.txtBox.insert(tk.END, text[:self.editor_chunk_chars])
+            self.txtBox.config(state=tk.DISABLED)
+            self.root.after(1, self.load_editor_chunk, self.editor_load_generation, text, self.editor_chunk_chars)
+        else:
+            self.editor_lines = None
+            self.txtBox.insert(tk.END, text)
+        self.txtBox.edit_modified(False)
+        self.editor_dirty = False
+        if self.editor_commit_id is not None:
+            self.root.after_cancel(self.editor_commit_id)
+            self.editor_commit_id = None
+
+    def load_editor_chunk(self, generation, text, position):
+        if generation != self.editor_load_generation:
+            # Another note was opened in the meantime
+            return
+        end = position + self.editor_chunk_chars
+        self.txtBox.config(state=tk.NORMAL)
+        self.txtBox.insert("end-1c", text[position:end])
+        self.txtBox.edit_modified(False)
+        if end < len(text):
+            self.txtBox.config(state=tk.DISABLED)
+            self.root.after(1, self.load_editor_chunk, generation, text, end)
+        else:
+            self.editor_loading = False
+
+    def start_line_tracking(self, text):
+        self.editor_lines = text.split("\n")
+        self.editor_clean_prefix = self.editor_clean_suffix = len(self.editor_lines)
+
+    def read_edited_lines(self):
+        """Rebuild the note text, reading only the edited lines from the editor"""
+        old_count = len(self.editor_lines)
+        new_count = self.editor_line(self.txtBox.index("end-1c"))
+        prefix = min(self.editor_clean_prefix, old_count, new_count)
+        suffix = min(self.editor_clean_suffix, old_count - prefix, new_count - prefix)
+        if new_count - suffix > prefix:
+            edited = self.txtBox.get(f"{prefix + 1}.0", f"{new_count - suffix}.end").split("\n")
+        else:
+            edited = []
+        self.editor_lines[prefix:old_count - suffix] = edited
+        self.editor_clean_prefix = self.editor_clean_suffix = new_count
+        return "\n".join(self.editor_lines)
+
+    def install_editor_proxy(self):
+        """Send the editor's Tcl widget command through track_editor_change"""
+        widget = str(self.txtBox)
+        self.txtBox_command = widget + "_orig"
+        self.root.tk.call("rename", widget, self.txtBox_command)
+        self.root.tk.createcommand(widget, self.track_editor_change)
+
+    def track_editor_change(self, *args):
+        # Narrows the untouched prefix and suffix of the editor to exclude
+        # the lines each insert, delete or replace touches
+        command = self.txtBox_command
+        operation = args[0] if args else ""
+        if self.editor_lines is not None and not self.editor_loading:
+            if operation in ("insert", "delete", "replace"):
+                call = self.root.tk.call
+                last = self.editor_line(call(command, "index", "end-1c"))
+                if operation == "insert":
+                    indices = args[1:2]
+                elif operation == "replace":
+                    indices = args[1:3]
+                else:
+                    indices = args[1:]
+                lines = [min(self.editor_line(call(command, "index", index)), last) for index in indices]
+                first, end = min(lines), max(lines)
+                if operation == "delete" and len(indices) == 1:
+                    # Deleting one character may join the next line on
+                    end = min(first + 1, last)
+                self.editor_clean_prefix = min(self.editor_clean_prefix, first - 1)
+                self.editor_clean_suffix = min(self.editor_clean_suffix, last - end)
+            elif operation == "edit" and args[1:2] in (("undo",), ("redo",)):
+                self.editor_clean_prefix = self.editor_clean_suffix = 0
+        return self.root.tk.call((command,) + args)
+
+    @staticmethod
+    def editor_line(index):
+        return int(str(index).split(".")[0])
+
+    def update_save_status(self):
+        writer = self.autosave_writer
+        settled = False
+        if writer.last_error is not None:
+            text = f"Save failed, retrying: {writer.last_error}"
+        elif writer.saving:
+            text = "Saving..."
+        elif self.editor_dirty or writer.pending:
+            text = "Unsaved changes"
+        else:
+            text = "All changes saved"
+            if writer.last_saved is not None:
+                text += writer.last_saved.strftime(" at %H:%M:%S")
+            settled = True
+        self.save_status_label.config(text=text)
+        # Keep checking until the writer thread has caught up
+        if not settled and self.save_status_poll_id is None:
+            self.save_status_poll_id = self.root.after(250, self.poll_save_status)
+
+    def poll_save_status(self):
+        self.save_status_poll_id = None
+        self.update_save_status()
+
+    def poll_external_changes(self):
+        """Bring the sidebar and editor up to date with other processes' saves
+
+        Reading what changed can mean reloading the whole store (after
+        another process compacted it), so that runs on a worker thread and
+        the result is shown once it's done.
+        """
+        self.external_poll_id = self.root.after(self.external_poll_ms, self.poll_external_changes)
+        if self.external_sync_id is not None:
+            return
+        if not self.notes_manager.storage_changed():
+            # Nothing to read, but saves may have picked changes up meanwhile
+            self.show_external_changes(self.notes_manager.poll_changes())
+            return
+        # Hand pending typing to the manager first, where it wins over the stored note
+        self.commit_editor()
+        results = queue.Queue()
+
+        def run():
+            try:
+                results.put(self.notes_manager.poll_changes())
+            except Exception as e:
+                print(f"Could not read other processes' changes: {e}")
+                results.put(None)
+
+        def check():
+            try:
+                changes = results.get_nowait()
+            except queue.Empty:
+                self.external_sync_id = self.root.after(50, check)
+                return
+            self.external_sync_id = None
+            self.show_external_changes(changes)
+
+        threading.Thread(target=run, daemon=True).start()
+        self.external_sync_id = self.root.after(50, check)
+
+    def show_external_changes(self, changes):
+        """Update the editor and sidebar for what poll_changes() returned"""
+        if changes is None:
+            return
+        while self.current_note_id in changes["renumbered"]:
+            self.current_note_id = changes["renumbered"][self.current_note_id]
+        if self.current_note_id in changes["deleted"]:
+            self.current_note_id = None
+            self.load_editor("")
+        elif self.current_note_id in changes["changed"] and not self.editor_dirty and not self.editor_loading:
+            # Reload in place, keeping the cursor and scroll position
+            cursor = self.txtBox.index(tk.INSERT)
+            top = self.txtBox.yview()[0]
+            self.load_editor(self.notes_manager.get_note_by_id(self.current_note_id)["content"])
+            if not self.editor_loading:
+                self.txtBox.mark_set(tk.INSERT, cursor)
+                self.txtBox.yview_moveto(top)
+        # Re-runs the current search, or lists all notes; rows are updated in place
+        self.search_notes()
+
+    def on_close(self):
+        # Flush pending edits before the window goes away
+        if self.external_poll_id is not None:
+            self.root.after_cancel(self.external_poll_id)
+        if self.external_sync_id is not None:
+            self.root.after_cancel(self.external_sync_id)
+        self.commit_editor()
+        self.autosave_writer.stop()
+        self.notes_manager.close()
+        self.root.destroy()
 
     def export_note(self):
         if self.current_note_id is None:
@@ -395,8 +844,65 @@ class SmartNotesApp:
             filetypes=[("Text files", "*.txt"), ("All files", "*.*")]
         )
         if file_path:
+            # Export the note itself, as a large one may still be loading
+            self.commit_editor()
+            note = self.notes_manager.get_note_by_id(self.current_note_id)
             with open(file_path, "w") as file:
-                file.write(self.txtBox.get("1.0", tk.END).strip())
+                file.write(note["content"].strip())
+
+    def export_all_notes(self):
+        """Export the notes listed in the sidebar (all, or the search results)"""
+        self.commit_editor()
+        as_zip = messagebox.askyesnocancel(
+            "Export Notes", "Export to a zip archive?\n\nChoose No to write Markdown files to a folder instead.")
+        if as_zip is None:
+            return
+        if as_zip:
+            destination = filedialog.asksaveasfilename(
+                initialdir=".", title="Export Notes", defaultextension=".zip",
+                filetypes=[("Zip archives", "*.zip"), ("All files", "*.*")]
+            )
+        else:
+            destination = filedialog.askdirectory(initialdir=".", title="Export Notes")
+        if not destination:
+            return
+        notes = list(self.sidebar_notes)
+        self.run_bulk_task(lambda: export_notes(notes, destination), "Exported {} notes")
+
+    def import_folder(self):
+        directory = filedialog.askdirectory(initialdir=".", title="Import .md/.txt files")
+        if not directory:
+            return
+        self.run_bulk_task(lambda: len(import_notes(self.notes_manager, directory)), "Imported {} notes")
+
+    def run_bulk_task(self, work, message):
+        """Run an import or export on a worker thread and report when it's done"""
+        results = queue.Queue()
+        started = time.perf_counter()
+        self.save_status_label.config(text="Working...")
+
+        def run():
+            try:
+                results.put((True, work()))
+            except Exception as e:
+                results.put((False, e))
+
+        def check():
+            try:
+                ok, result = results.get_nowait()
+            except queue.Empty:
+                self.root.after(100, check)
+                return
+            self.search_notes()
+            self.update_save_status()
+            if ok:
+                elapsed = time.perf_counter() - started
+                messagebox.showinfo("Done", message.format(result) + f" in {elapsed:.1f}s")
+            else:
+                messagebox.showerror("Error", str(result))
+
+        threading.Thread(target=run, daemon=True).start()
+        self.root.after(100, check)
 
     def about_app(self):
         about_window = tk.Toplevel(self.root)
@@ -425,58 +931,186 @@ class SmartNotesApp:
         if self.focus == "c":
             self.bubble.delete("1.0", tk.END)
 
-    def ai_assist(self):
-        if not GENAI_AVAILABLE:
+    def check_ai_ready(self):
+        """Explain in the response box why the AI can't be used, if it can't"""
+        if not self.custom_ai_backend and not smartnotes_core.GENAI_AVAILABLE:
             self.bubble.delete("1.0", tk.END)
             self.bubble.insert(tk.END, "ERROR: Google Generative AI library not installed!\n\nPlease install it with:\npip install google-generativeai")
-            return
+            return False
 
-        if not self.api_key:
+        if not self.custom_ai_backend and not self.api_key:
             self.bubble.delete("1.0", tk.END)
             self.bubble.insert(tk.END, "ERROR: No API key configured!\n\nPlease click 'Assign API' to set up your Google Gemini API key.")
+            return False
+        return True
+
+    def ai_assist(self, fresh=False):
+        if not self.check_ai_ready():
             return
 
         uinput = self.aitxtBox.get("1.0", tk.END)
         if not uinput.strip():
             return
 
+        self.commit_editor()
+        context = self.related_notes_for(uinput)
+
+        # A new request supersedes one still streaming
         self.bubble.delete("1.0", tk.END)
-        self.bubble.insert(tk.END, "Thinking...\n")
-        self.root.update()
+        if context:
+            titles = ", ".join(note["title"] for note in context)
+            self.bubble.insert(tk.END, f"Thinking... (using notes: {titles})\n")
+        else:
+            self.bubble.insert(tk.END, "Thinking...\n")
+        self.ai_request_id = self.ai_worker.submit(uinput, context=context, fresh=fresh)
+        self.ai_response_started = False
+        if self.ai_poll_id is None:
+            self.ai_poll_id = self.root.after(30, self.poll_ai_events)
+
+    def batch_ai(self):
+        """Run an AI action over every note listed in the sidebar"""
+        if not self.check_ai_ready():
+            return
+        if self.batch_runner is not None:
+            messagebox.showinfo("Batch AI", "A batch job is already running")
+            return
+        self.commit_editor()
+        runner = BatchJobRunner(
+            self.notes_manager, self.ai_backend,
+            concurrency=self.config.get("ai_batch_concurrency", 4),
+            requests_per_minute=self.config.get("ai_requests_per_minute", 15),
+            tokens_per_minute=self.config.get("ai_tokens_per_minute", 1000000),
+            max_retries=self.config.get("ai_max_retries", 5)
+        )
+        unfinished = runner.unfinished_jobs()
+
+        batch_window = tk.Toplevel(self.root)
+        batch_window.title("Batch AI")
+        batch_window.geometry("380x220")
+        batch_window.configure(bg=self.bg_color)
+
+        note_ids = [note["id"] for note in self.sidebar_notes]
+        tk.Label(batch_window, text=f"Run the AI over the {len(note_ids)} notes listed in the sidebar:",
+                 bg=self.bg_color, fg=self.fg_color, font=("Segoe UI", 10)).pack(pady=(10, 5))
+        action_var = tk.StringVar(value="summarize")
+        tk.OptionMenu(batch_window, action_var, *BATCH_ACTIONS).pack(pady=5)
+
+        def start(job_id=None):
+            if job_id is None:
+                if not note_ids:
+                    return
+                job_id = runner.create(note_ids, action_var.get())
+            batch_window.destroy()
+            self.run_batch_job(runner, job_id)
+
+        tk.Button(batch_window, text="Start", command=start, bg=self.button_bg, fg=self.button_fg,
+                  relief=tk.FLAT, bd=0, font=("Segoe UI", 11), cursor="hand2",
+                  activebackground=self.button_hover_bg, activeforeground=self.button_fg).pack(pady=5)
+        if unfinished:
+            tk.Button(batch_window, text=f"Resume unfinished job ({unfinished[-1]})",
+                      command=lambda: start(unfinished[-1]), bg=self.button_bg, fg=self.button_fg,
+                      relief=tk.FLAT, bd=0, font=("Segoe UI", 10), cursor="hand2",
+                      activebackground=self.button_hover_bg, activeforeground=self.button_fg).pack(pady=5)
+
+    def run_batch_job(self, runner, job_id):
+        self.batch_runner = runner
+        results = queue.Queue()
+
+        def run():
+            try:
+                results.put(runner.resume(job_id))
+            except Exception as e:
+                results.put(e)
 
-        try:
-            model = genai.GenerativeModel("gemini-1.5-flash")
-            response = model.generate_content(uinput)
-            self.bubble.delete("1.0", tk.END)
-            self.bubble.insert(tk.END, response.text)
-        except Exception as e:
+        def check():
+            try:
+                result = results.get_nowait()
+            except queue.Empty:
+                done, failed, total = runner.progress
+                self.ai_response_label.config(text=f"AI Response  (batch: {done + failed}/{total}, Stop AI cancels)")
+                self.root.after(250, check)
+                return
+            self.batch_runner = None
+            self.update_ai_cache_label()
+            self.search_notes()
+            # Show the AI's reply if it went into the open note, unless the
+            # note was being edited meanwhile (those edits win)
+            if self.current_note_id in runner.updated and not self.editor_dirty:
+                self.load_editor(self.notes_manager.get_note_by_id(self.current_note_id)["content"])
+            self.update_save_status()
+            if isinstance(result, Exception):
+                messagebox.showerror("Batch AI", str(result))
+            else:
+                state = "Cancelled" if result["cancelled"] else "Finished"
+                messagebox.showinfo("Batch AI", f"{state}: {result['done']} of {result['total']} notes done, "
+                                                f"{result['failed']} failed, {result['retries']} retries after rate limits.")
+
+        threading.Thread(target=run, daemon=True).start()
+        self.root.after(250, check)
+
+    def related_notes_for(self, prompt):
+        """Notes similar to the prompt to send as context, if enabled"""
+        if not self.ai_context_notes:
+            return []
+        # Sent without context until the background build has finished
+        return self.notes_manager.related_notes(prompt, self.ai_context_notes, wait=False)
+
+    def update_ai_cache_label(self):
+        stats = self.ai_cache.stats()
+        self.ai_response_label.config(text=f"AI Response  (cache: {stats['hits']} hits / {stats['misses']} misses)")
+
+    def cancel_ai(self):
+        """Stop the AI request in flight, keeping what has streamed so far"""
+        if self.batch_runner is not None:
+            self.batch_runner.cancel()
+        if self.ai_request_id is None:
+            return
+        self.ai_worker.cancel()
+        self.ai_request_id = None
+        if not self.ai_response_started:
             self.bubble.delete("1.0", tk.END)
-            self.bubble.insert(tk.END, f"Error: {str(e)}\n\nPlease check your API key using 'Assign API' button.")
+        self.bubble.insert(tk.END, "\n\n[Cancelled]")
+
+    def poll_ai_events(self):
+        """Move streamed AI output from the worker queue into the response box"""
+        self.ai_poll_id = None
+        while True:
+            try:
+                request_id, kind, payload = self.ai_worker.events.get_nowait()
+            except queue.Empty:
+                break
+            if request_id != self.ai_request_id:
+                continue
+            if kind == "chunk":
+                if not self.ai_response_started:
+                    self.bubble.delete("1.0", tk.END)
+                    self.ai_response_started = True
+                self.bubble.insert(tk.END, payload)
+            elif kind == "error":
+                self.bubble.delete("1.0", tk.END)
+                self.bubble.insert(tk.END, f"Error: {payload}\n\nPlease check your API key using 'Assign API' button.")
+                self.ai_request_id = None
+            elif kind == "done":
+                self.ai_request_id = None
+                self.update_ai_cache_label()
+        if self.ai_request_id is not None:
+            self.ai_poll_id = self.root.after(30, self.poll_ai_events)
 
     def load_api_key(self):
         """Load API key from config file"""
-        config_file = "smartnotes_config.json"
         try:
-            if os.path.exists(config_file):
-                with open(config_file, 'r') as f:
-                    config = json.load(f)
-                    api_key = config.get('api_key', '')
-                    if api_key and GENAI_AVAILABLE:
-                        genai.configure(api_key=api_key)
-                    return api_key
+            return load_config().get('api_key', '')
         except Exception as e:
             print(f"Error loading API key: {e}")
         return ""
 
     def save_api_key(self, api_key):
         """Save API key to config file"""
-        config_file = "smartnotes_config.json"
         try:
-            config = {'api_key': api_key}
-            with open(config_file, 'w') as f:
-                json.dump(config, f)
-            if GENAI_AVAILABLE:
-                genai.configure(api_key=api_key)
+            config = load_config()
+            config['api_key'] = api_key
+            save_config(config)
+            self.gemini.configure(api_key)
             return True
         except Exception as e:
             print(f"Error saving API key: {e}")
@@ -486,7 +1120,7 @@ class SmartNotesApp:
         """Open API key assignment window"""
         api_window = tk.Toplevel(self.root)
         api_window.title("Assign Google Gemini API Key")
-        api_window.geometry("500x300")
+        api_window.geometry("500x380")
         api_window.configure(bg=self.bg_color)
 
         # Title label
@@ -518,15 +1152,29 @@ class SmartNotesApp:
         if self.api_key:
             api_entry.insert(0, self.api_key)
 
+        # Model entry
+        tk.Label(api_window, text="Model:", bg=self.bg_color, fg=self.fg_color, font=("Segoe UI", 11)).pack(pady=(10,0))
+
+        model_entry = tk.Entry(api_window, width=60, bg=self.entry_bg, fg=self.entry_fg,
+                              insertbackground=self.entry_fg, relief=tk.FLAT, bd=5, font=("Segoe UI", 11))
+        model_entry.pack(pady=5)
+        model_entry.insert(0, self.gemini.model_name)
+
         # Buttons frame
         button_frame = tk.Frame(api_window, bg=self.bg_color)
         button_frame.pack(pady=20)
 
         def save_api():
             new_api_key = api_entry.get().strip()
+            model_name = model_entry.get().strip() or "gemini-1.5-flash"
             if new_api_key:
                 if self.save_api_key(new_api_key):
                     self.api_key = new_api_key
+                    if model_name != self.gemini.model_name:
+                        config = load_config()
+                        config['ai_model'] = model_name
+                        save_config(config)
+                        self.gemini.set_model(model_name)
                     messagebox.showinfo("Success", "API key saved successfully!")
                     api_window.destroy()
                 else:
@@ -535,21 +1183,44 @@ class SmartNotesApp:
                 messagebox.showwarning("Warning", "Please enter a valid API key.")
 
         def test_api():
-            if not GENAI_AVAILABLE:
+            if not smartnotes_core.GENAI_AVAILABLE:
                 messagebox.showerror("Error", "Google Generative AI library not installed.\nPlease install: pip install google-generativeai")
                 return
 
             test_key = api_entry.get().strip()
-            if test_key:
+            model_name = model_entry.get().strip() or "gemini-1.5-flash"
+            if not test_key:
+                messagebox.showwarning("Warning", "Please enter an API key to test.")
+                return
+
+            # Run the round trip on a worker thread and check back for the outcome
+            outcome = queue.Queue()
+
+            def run_test():
                 try:
-                    genai.configure(api_key=test_key)
-                    model = genai.GenerativeModel("gemini-1.5-flash")
-                    response = model.generate_content("Hello, just testing the API")
-                    messagebox.showinfo("Success", "API key is working correctly!")
+                    model = GeminiBackend(model_name, api_key=test_key).get_model()
+                    model.generate_content("Hello, just testing the API")
+                    outcome.put(None)
                 except Exception as e:
-                    messagebox.showerror("Error", f"API key test failed: {str(e)}")
-            else:
-                messagebox.showwarning("Warning", "Please enter an API key to test.")
+                    outcome.put(str(e))
+
+            def check_test():
+                if not api_window.winfo_exists():
+                    return
+                try:
+                    error = outcome.get_nowait()
+                except queue.Empty:
+                    api_window.after(50, check_test)
+                    return
+                test_btn.config(state=tk.NORMAL, text="Test API Key")
+                if error is None:
+                    messagebox.showinfo("Success", "API key is working correctly!")
+                else:
+                    messagebox.showerror("Error", f"API key test failed: {error}")
+
+            test_btn.config(state=tk.DISABLED, text="Testing...")
+            threading.Thread(target=run_test, daemon=True).start()
+            api_window.after(50, check_test)
 
         # Save button
         save_btn = tk.Button(button_frame, text="Save API Key", command=save_api,
@@ -572,6 +1243,142 @@ class SmartNotesApp:
                               activebackground=self.button_hover_bg, activeforeground=self.button_fg)
         cancel_btn.pack(side=tk.LEFT, padx=5)
 
+    def show_diagnostics(self):
+        """Window listing live latencies of the instrumented operations"""
+        if self.diagnostics_window is not None and self.diagnostics_window.winfo_exists():
+            self.diagnostics_window.lift()
+            return
+        window = self.diagnostics_window = tk.Toplevel(self.root)
+        window.title("Diagnostics")
+        window.geometry("560x320")
+        window.configure(bg=self.bg_color)
+
+        columns = ("count", "p50", "p95", "max")
+        table = ttk.Treeview(window, columns=columns, show="tree headings")
+        table.heading("#0", text="Operation")
+        table.column("#0", width=180)
+        for column in columns:
+            table.heading(column, text=column if column == "count" else f"{column} (ms)")
+            table.column(column, width=80, anchor=tk.E)
+        table.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+        tk.Button(window, text="Reset", command=METRICS.reset, bg=self.button_bg, fg=self.button_fg,
+                  relief=tk.FLAT, bd=0, font=("Segoe UI", 10), cursor="hand2",
+                  activebackground=self.button_hover_bg, activeforeground=self.button_fg).pack(pady=(0, 10))
+
+        def refresh():
+            if not window.winfo_exists():
+                return
+            table.delete(*table.get_children())
+            for row in METRICS.snapshot():
+                table.insert("", tk.END, text=row["name"], values=(
+                    row["count"], f"{row['p50_ms']:.1f}", f"{row['p95_ms']:.1f}", f"{row['max_ms']:.1f}"))
+            window.after(1000, refresh)
+
+        refresh()
+
+    def show_history(self):
+        """Window listing the current note's earlier versions, to view or restore one"""
+        if self.current_note_id is None:
+            messagebox.showinfo("Info", "No note selected")
+            return
+        # Save pending edits first, which also writes out the versions they replaced
+        self.commit_editor()
+        note_id = self.current_note_id
+        self.after_flush(lambda: self.open_history(note_id))
+
+    def after_flush(self, callback):
+        """Save pending changes now and call callback once they're written"""
+        request = self.autosave_writer.flush(wait=False)
+
+        def check():
+            if self.autosave_writer.flushed(request):
+                callback()
+            else:
+                self.root.after(20, check)
+
+        self.root.after(20, check)
+
+    def open_history(self, note_id):
+        note = self.notes_manager.get_note_by_id(note_id)
+        if note is None:
+            return
+        window = tk.Toplevel(self.root)
+        window.title(f"History - {note['title']}")
+        window.geometry("900x540")
+        window.configure(bg=self.bg_color)
+        window.rowconfigure(0, weight=1)
+        window.columnconfigure(1, weight=1)
+
+        table = ttk.Treeview(window, columns=("updated", "title"), show="tree headings", selectmode="browse")
+        table.heading("#0", text="Revision")
+        table.column("#0", width=80)
+        table.heading("updated", text="Last edited")
+        table.column("updated", width=140)
+        table.heading("title", text="Title")
+        table.column("title", width=160)
+        table.grid(row=0, column=0, sticky="ns", padx=(10, 5), pady=10)
+        preview = tk.Text(window, wrap=tk.WORD, font=("Segoe UI", 11), bg=self.bg_color, fg=self.fg_color,
+                          relief=tk.FLAT, bd=0, highlightthickness=0, selectbackground=self.tree_select_bg)
+        preview.grid(row=0, column=1, sticky="nsew", padx=(5, 10), pady=10)
+        restore_button = tk.Button(window, text="Restore this version", bg=self.button_bg, fg=self.button_fg,
+                                   relief=tk.FLAT, bd=0, font=("Segoe UI", 10), cursor="hand2",
+                                   activebackground=self.button_hover_bg, activeforeground=self.button_fg)
+        restore_button.grid(row=1, column=0, columnspan=2, pady=(0, 10))
+
+        def fill():
+            if not window.winfo_exists():
+                return
+            note = self.notes_manager.get_note_by_id(note_id)
+            if note is None:
+                window.destroy()
+                return
+            table.delete(*table.get_children())
+            table.insert("", tk.END, iid="current", text="Current", values=(note["updated_at"], note["title"]))
+            for revision in self.notes_manager.list_revisions(note_id):
+                table.insert("", tk.END, iid=str(revision["revision"]), text=str(revision["revision"]),
+                             values=(revision["updated_at"], revision["title"]))
+            table.selection_set("current")
+
+        def show(event=None):
+            selected = table.selection()
+            if not selected:
+                return
+            if selected[0] == "current":
+                note = self.notes_manager.get_note_by_id(note_id)
+                text = note["content"] if note is not None else ""
+            else:
+                revision = self.notes_manager.get_revision(note_id, int(selected[0]))
+                text = revision["content"] if revision is not None else "(This version is no longer kept)"
+            preview.config(state=tk.NORMAL)
+            preview.delete("1.0", tk.END)
+            preview.insert(tk.END, text)
+            preview.config(state=tk.DISABLED)
+            restore_button.config(state=tk.DISABLED if selected[0] == "current" else tk.NORMAL)
+
+        def restore():
+            selected = table.selection()
+            if not selected or selected[0] == "current":
+                return
+            revision = int(selected[0])
+            if not messagebox.askyesno("Restore", f"Replace the note with revision {revision}?\n\n"
+                                       "The current text is kept in the history.", parent=window):
+                return
+            if self.current_note_id == note_id:
+                self.commit_editor()
+            if not self.notes_manager.restore_revision(note_id, revision):
+                messagebox.showerror("Error", "That version is no longer available", parent=window)
+                return
+            if self.current_note_id == note_id:
+                self.load_editor(self.notes_manager.get_note_by_id(note_id)["content"])
+            self.search_notes()
+            self.update_save_status()
+            # The replaced text is listed once the save has written it out
+            self.after_flush(fill)
+
+        table.bind("<<TreeviewSelect>>", show)
+        restore_button.config(command=restore)
+        fill()
+
     def tutorial(self):
         tuto_window = tk.Toplevel(self.root)
         tuto_window.geometry("630x740")
@@ -589,6 +1396,7 @@ class SmartNotesApp:
         ## Notes Management:
         - View your notes in the sidebar on the left
         - Search through your notes using the search box
+        - Choose 'relevance' next to the search box to list the best matches first
         - Click on any note to open it
         - Delete notes with the 'Delete' button
 
@@ -603,7 +1411,11 @@ class SmartNotesApp:
         - Ctrl+T: Change theme
         - Ctrl+Alt+C: Clear current panel
         - Ctrl+Alt+D: Ask AI assistant
+        - Ctrl+Alt+R: Ask AI assistant for a fresh (uncached) answer
+        - Ctrl+Alt+X: Stop the AI response
         - Ctrl+Delete: Delete current note
+        - Ctrl+Alt+M: Show operation timings (diagnostics)
+        - Ctrl+Alt+H: Show the current note's earlier versions
         """
 
         tutorial_label = tk.Text(tuto_window, wrap=tk.WORD, font=("Segoe UI", 11),
@@ -665,8 +1477,63 @@ class SmartNotesApp:
         style.map('Treeview', background=[('selected', self.tree_select_bg)])
         style.configure("Treeview.Heading", background=self.top_frame_color, foreground=self.fg_color)
 
+def migrate_command(target_backend):
+    """Copy notes from the configured backend into another one and switch to it"""
+    config = load_config()
+    source = create_storage()
+    if source.name == target_backend:
+        print(f"Notes are already stored with the {target_backend} backend")
+        source.close()
+        return
+    target = create_storage(target_backend, STORAGE_BACKENDS[target_backend].default_path)
+    count = migrate_storage(source, target)
+    source.close()
+    target.close()
+    config['storage_backend'] = target_backend
+    config['notes_path'] = target.path
+    save_config(config)
+    print(f"Migrated {count} notes from {source.path} to {target.path} ({target_backend})")
+
 # Run application
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = SmartNotesApp(root)
-    root.mainloop()
+    parser = argparse.ArgumentParser(description="Smart Notes")
+    parser.add_argument("--migrate", choices=sorted(STORAGE_BACKENDS), metavar="BACKEND",
+                        help="copy notes into another storage backend (%(choices)s) and use it from now on")
+    parser.add_argument("--startup-time", action="store_true",
+                        help="print how long the window took to appear, then exit")
+    parser.add_argument("--profile", nargs="?", const="smartnotes.prof", metavar="FILE",
+                        help="run the session under cProfile and write the stats to FILE "
+                             "(default %(const)s) on exit")
+    parser.add_argument("--metrics-log", metavar="FILE",
+                        help="append a JSON line per timed operation to FILE")
+    args = parser.parse_args()
+
+    if args.migrate:
+        migrate_command(args.migrate)
+    else:
+        metrics_log = args.metrics_log or load_config().get("metrics_log")
+        if metrics_log:
+            METRICS.open_log(metrics_log)
+        profiler = None
+        if args.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            root = tk.Tk()
+            app = SmartNotesApp(root)
+            if args.startup_time:
+                root.update()
+                print(f"Window drawn {(time.perf_counter() - STARTED_AT) * 1000:.0f} ms after startup")
+                # The same shutdown as closing the window: stops autosave, closes storage
+                app.on_close()
+            else:
+                root.mainloop()
+        finally:
+            METRICS.close()
+            if profiler is not None:
+                import pstats
+                profiler.disable()
+                profiler.dump_stats(args.profile)
+                pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+                print(f"Profile written to {args.profile}")
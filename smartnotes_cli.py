@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Smart Notes Command Line
+Reads and writes the app's notes without loading Tkinter, for scripts,
+cron jobs and pipelines. Results are printed as they are found.
+
+Examples:
+    python smartnotes_cli.py add "Groceries" "eggs, milk"
+    echo "Call the plumber" | python smartnotes_cli.py add "Todo"
+    python smartnotes_cli.py search project --limit 20
+    python smartnotes_cli.py search "budget review" --rank --limit 5
+    python smartnotes_cli.py show 42
+    python smartnotes_cli.py bulk-import ~/markdown-notes
+    python smartnotes_cli.py export notes.zip --query project
+    python smartnotes_cli.py export - | jq -r .title
+    python smartnotes_cli.py history 42 --restore 3
+    python smartnotes_cli.py stats
+    python smartnotes_cli.py serve --port 8765
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import smartnotes_core
+
+
+def open_manager(args):
+    """NotesManager on the configured storage, or the one given by --backend/--path.
+
+    Bodies are only read when a command needs them (on backends that can
+    load lazily). The word index isn't built: one-off searches scan the
+    notes instead, which is faster than indexing them all.
+    """
+    storage = smartnotes_core.create_storage(args.backend, args.path)
+    return smartnotes_core.NotesManager(storage=storage, lazy=True, autosave=False, build_index=False)
+
+
+def note_record(note, content=False):
+    """Plain dict for JSON output; LazyNote bodies have to be asked for by key"""
+    record = {
+        "id": note["id"],
+        "title": note["title"],
+        "created_at": note["created_at"],
+        "updated_at": note["updated_at"]
+    }
+    if content:
+        record["content"] = note["content"]
+    return record
+
+
+def cmd_add(manager, args):
+    content = args.content
+    if content is None:
+        content = "" if sys.stdin.isatty() else sys.stdin.read()
+    note = manager.get_note_by_id(manager.add_note(args.title, content))
+    # Renumbered in place if another process stored a note under its id first
+    manager.save_notes()
+    print(note["id"])
+
+
+def cmd_search(manager, args):
+    if args.rank:
+        # Every match has to be scored before the best can be printed
+        for note, score in manager.rank_notes(args.query, manager.search_notes(args.query, args.mode), args.limit):
+            snippet = smartnotes_core.make_snippet(note["content"], args.query)
+            if args.json:
+                record = note_record(note)
+                record.update(score=round(score, 4), snippet=snippet)
+                print(json.dumps(record))
+            else:
+                print(f"{note['id']}\t{score:.2f}\t{note['title']}\t{snippet}")
+        return
+    notes = manager.iter_search(args.query, args.mode)
+    for count, note in enumerate(notes):
+        if args.limit is not None and count >= args.limit:
+            break
+        if args.json:
+            print(json.dumps(note_record(note)))
+        else:
+            print(f"{note['id']}\t{note['updated_at']}\t{note['title']}")
+
+
+def cmd_show(manager, args):
+    note = manager.get_note_by_id(args.id)
+    if note is None:
+        print(f"No note with id {args.id}", file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps(note_record(note, content=True)))
+    else:
+        sys.stdout.write(smartnotes_core.note_to_markdown(note))
+
+
+def cmd_bulk_import(manager, args):
+    if not os.path.isdir(args.directory):
+        print(f"Not a directory: {args.directory}", file=sys.stderr)
+        return 1
+    note_ids = smartnotes_core.import_notes(manager, args.directory, workers=args.workers)
+    print(f"Imported {len(note_ids)} notes")
+
+
+def cmd_export(manager, args):
+    notes = manager.iter_search(args.query) if args.query else iter(list(manager.notes))
+    if args.destination == "-":
+        for note in notes:
+            print(json.dumps(note_record(note, content=True)))
+        return
+    count = smartnotes_core.export_notes(notes, args.destination)
+    print(f"Exported {count} notes to {args.destination}", file=sys.stderr)
+
+
+def cmd_history(manager, args):
+    if manager.get_note_by_id(args.id) is None:
+        print(f"No note with id {args.id}", file=sys.stderr)
+        return 1
+    if args.restore is not None:
+        if not manager.restore_revision(args.id, args.restore):
+            print(f"Note {args.id} has no revision {args.restore}", file=sys.stderr)
+            return 1
+        manager.save_notes()
+        print(f"Restored note {args.id} to revision {args.restore}")
+    elif args.show is not None:
+        revision = manager.get_revision(args.id, args.show)
+        if revision is None:
+            print(f"Note {args.id} has no revision {args.show}", file=sys.stderr)
+            return 1
+        if args.json:
+            print(json.dumps(revision))
+        else:
+            sys.stdout.write(revision["content"])
+    else:
+        for revision in manager.list_revisions(args.id):
+            if args.json:
+                print(json.dumps(revision))
+            else:
+                print(f"{revision['revision']}\t{revision['updated_at']}\t{revision['title']}")
+
+
+def cmd_stats(manager, args):
+    notes = manager.notes
+    stats = {
+        "backend": manager.storage.name,
+        "path": manager.storage.path,
+        "notes": len(notes),
+        "bytes_on_disk": smartnotes_core.storage_size(manager.storage.path),
+        "oldest_update": min((note["updated_at"] for note in notes), default=None),
+        "newest_update": max((note["updated_at"] for note in notes), default=None)
+    }
+    if args.json:
+        print(json.dumps(stats))
+    else:
+        for key, value in stats.items():
+            print(f"{key}: {value}")
+
+
+def cmd_serve(manager, args):
+    # Imported here so the other commands don't pay for http.server
+    import smartnotes_server
+    # A server answers many searches, so it is worth indexing the notes up front
+    manager.ensure_search_index()
+    server = smartnotes_server.NotesServer(manager, args.host, args.port, token=args.token, verbose=args.verbose)
+    host, port = server.server_address[:2]
+    print(f"Serving notes on http://{host}:{port}/ (Ctrl+C to stop)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Work with Smart Notes from the command line")
+    parser.add_argument("--backend", choices=sorted(smartnotes_core.STORAGE_BACKENDS),
+                        help="storage backend (default: the one in smartnotes_config.json)")
+    parser.add_argument("--path", help="notes file or directory (default: the backend's usual path)")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND", required=True)
+
+    add = commands.add_parser("add", help="add a note and print its id")
+    add.add_argument("title")
+    add.add_argument("content", nargs="?", help="note text (default: read from stdin)")
+    add.set_defaults(run=cmd_add)
+
+    search = commands.add_parser("search", help="print id, date and title of matching notes")
+    search.add_argument("query")
+    search.add_argument("--mode", choices=["auto", "words", "substring"], default="auto",
+                        help="words: word prefixes, substring: anywhere in the text (default: auto)")
+    search.add_argument("--limit", type=int, help="stop after this many matches")
+    search.add_argument("--rank", action="store_true",
+                        help="best matches first (BM25), each with a snippet; prints id, score, title, snippet")
+    search.add_argument("--json", action="store_true", help="print one JSON object per line")
+    search.set_defaults(run=cmd_search)
+
+    show = commands.add_parser("show", help="print a note as Markdown")
+    show.add_argument("id", type=int)
+    show.add_argument("--json", action="store_true", help="print the note as JSON")
+    show.set_defaults(run=cmd_show)
+
+    bulk_import = commands.add_parser("bulk-import", help="import a folder tree of .md/.txt files")
+    bulk_import.add_argument("directory")
+    bulk_import.add_argument("--workers", type=int, help="parser processes (default: one per CPU)")
+    bulk_import.set_defaults(run=cmd_bulk_import)
+
+    export = commands.add_parser("export", help="export notes to a .zip, a folder, or - for JSON lines on stdout")
+    export.add_argument("destination")
+    export.add_argument("--query", help="only export notes matching this search")
+    export.set_defaults(run=cmd_export)
+
+    history = commands.add_parser("history", help="list a note's earlier versions, or show or restore one")
+    history.add_argument("id", type=int)
+    choice = history.add_mutually_exclusive_group()
+    choice.add_argument("--show", type=int, metavar="REVISION", help="print that version's text")
+    choice.add_argument("--restore", type=int, metavar="REVISION", help="put that version back into the note")
+    history.add_argument("--json", action="store_true", help="print JSON objects instead")
+    history.set_defaults(run=cmd_history)
+
+    stats = commands.add_parser("stats", help="print note count and storage details")
+    stats.add_argument("--json", action="store_true", help="print the stats as JSON")
+    stats.set_defaults(run=cmd_stats)
+
+    serve = commands.add_parser("serve", help="serve the notes as a local HTTP/JSON API")
+    serve.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    serve.add_argument("--port", type=int, default=8765, help="port to listen on, 0 for any free one (default: %(default)s)")
+    serve.add_argument("--token", help="require this token in an 'Authorization: Bearer' header")
+    serve.add_argument("--verbose", action="store_true", help="log every request")
+    serve.set_defaults(run=cmd_serve)
+
+    args = parser.parse_args()
+    manager = open_manager(args)
+    try:
+        return args.run(manager, args)
+    except BrokenPipeError:
+        # The reader went away (e.g. piped into head); stop quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    finally:
+        manager.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,3925 @@
+"""
+Smart Notes Core
+Note storage, search, bulk import/export and the AI pipeline, without the
+Tkinter interface. smartnotes.py (the app) and smartnotes_cli.py build on it.
+"""
+
+import os
+import json
+import bisect
+import collections
+import contextlib
+import difflib
+import functools
+import hashlib
+import heapq
+import importlib.util
+import itertools
+import math
+import mmap
+import queue
+import random
+import re
+import shutil
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# google.generativeai is slow to import, so it is only located here and
+# imported the first time the AI assistant needs it (see load_genai)
+try:
+    GENAI_AVAILABLE = importlib.util.find_spec("google.generativeai") is not None
+except (ImportError, ValueError):
+    GENAI_AVAILABLE = False
+genai = None
+_genai_lock = threading.Lock()
+# API key will be loaded from config
+
+
+def load_genai():
+    """Import google.generativeai on first use; None if it is not installed"""
+    global genai, GENAI_AVAILABLE
+    with _genai_lock:
+        if genai is None and GENAI_AVAILABLE:
+            try:
+                import google.generativeai
+                genai = google.generativeai
+            except ImportError:
+                GENAI_AVAILABLE = False
+    return genai
+
+
+# numpy is optional: without it notes aren't offered to the AI as context
+try:
+    NUMPY_AVAILABLE = importlib.util.find_spec("numpy") is not None
+except (ImportError, ValueError):
+    NUMPY_AVAILABLE = False
+
+
+def load_numpy():
+    """Import numpy on first use; None if it is not installed"""
+    global NUMPY_AVAILABLE
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        NUMPY_AVAILABLE = False
+        return None
+
+
+# Timing of hot paths, shown in the diagnostics window (Ctrl+Alt+M)
+class Histogram:
+    """Latency distribution kept in log-spaced buckets.
+
+    Bucket i counts samples of up to BASE * GROWTH ** i seconds, so memory
+    stays constant however many samples are added and percentiles are
+    accurate to within one bucket (25%).
+    """
+
+    BASE = 1e-5
+    GROWTH = 1.25
+    BUCKETS = 72  # up to about 90 seconds; slower samples land in the last bucket
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds <= self.BASE:
+            index = 0
+        else:
+            index = min(math.ceil(math.log(seconds / self.BASE, self.GROWTH)), self.BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the given percentile, in seconds"""
+        if not self.count:
+            return 0.0
+        target = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and index < self.BUCKETS - 1:
+                return min(self.BASE * self.GROWTH ** index, self.max)
+        return self.max
+
+
+class Metrics:
+    """Named latency histograms, optionally logged as JSON lines.
+
+    Wrap a hot path with the timed(name) decorator or the timer(name)
+    context manager, or pass a measured duration to record(). With a log
+    open, every sample is also appended to it as
+    {"time": ..., "name": ..., "ms": ...}.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.log = None
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+            if self.log is not None:
+                self.log.write(json.dumps({"time": round(time.time(), 3), "name": name,
+                                           "ms": round(seconds * 1000, 3)}) + "\n")
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """Decorator recording how long each call of a function takes"""
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - start)
+            return wrapper
+        return decorate
+
+    def snapshot(self):
+        """Summary of each histogram, sorted by name, with times in milliseconds"""
+        with self._lock:
+            return [{
+                "name": name,
+                "count": histogram.count,
+                "mean_ms": histogram.total / histogram.count * 1000,
+                "p50_ms": histogram.percentile(50) * 1000,
+                "p95_ms": histogram.percentile(95) * 1000,
+                "max_ms": histogram.max * 1000
+            } for name, histogram in sorted(self.histograms.items())]
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+
+    def open_log(self, path):
+        with self._lock:
+            if self.log is not None:
+                self.log.close()
+            self.log = open(path, "a", encoding="utf-8")
+
+    def close(self):
+        with self._lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+
+METRICS = Metrics()
+
+
+# Lock shared by every process using a notes store
+class FileLock:
+    """Exclusive lock on a file, held across processes.
+
+    Several windows, the command line and the API server can all use one
+    store; each takes this lock around its writes. It is reentrant for the
+    thread holding it, and other threads of the same process wait just like
+    other processes do. The lock file itself stays empty.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self, blocking=True):
+        """Take the lock; with blocking=False, return False instead of waiting"""
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if self._depth == 0:
+            try:
+                self._file = open(self.path, 'a+b')
+                if not self._lock_file(blocking):
+                    self._file.close()
+                    self._thread_lock.release()
+                    return False
+            except BaseException:
+                if self._file is not None:
+                    self._file.close()
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+    def _lock_file(self, blocking):
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                return True
+            except BlockingIOError:
+                return False
+        self._file.seek(0)
+        while True:
+            try:
+                # LK_LOCK gives up after ten seconds, so keep retrying
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+# Note whose body stays on disk until it is needed
+class LazyNote(dict):
+    """Note dict whose "content" is read from storage on each access.
+
+    Until content is assigned, the dict only holds the metadata fields, so
+    memory use doesn't grow with the size of note bodies. Use note["content"]
+    rather than iterating or copying the dict to get the body.
+    """
+
+    __slots__ = ("storage",)
+
+    def __init__(self, fields, storage):
+        super().__init__(fields)
+        self.storage = storage
+
+    def __missing__(self, key):
+        if key == "content":
+            return self.storage.load_content(self["id"])
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def release(self):
+        """Drop an assigned body once storage holds it"""
+        self.pop("content", None)
+
+
+# Storage backends
+class NotesStorage:
+    """Interface NotesManager persists notes through.
+
+    load() returns every note as a list of dicts; the other operations
+    receive the note dicts NotesManager keeps in memory. next_id is the id
+    counter: one more than the highest id the store has ever held, deleted
+    notes included, so ids are never handed out twice.
+
+    Backends with supports_lazy_load can load(metadata_only=True), returning
+    LazyNote objects whose bodies come from load_content() when accessed.
+
+    Other processes may use the same store. Writers hold file_lock, and
+    signature() changes whenever one of them writes, at which point
+    changes() tells what they wrote.
+    """
+
+    name = None
+    default_path = None
+    supports_lazy_load = False
+
+    def __init__(self, path=None):
+        self.path = path or self.default_path
+        self.next_id = 1
+        self.file_lock = FileLock(self.path + ".lock")
+
+    def _track_id(self, note_id):
+        if note_id >= self.next_id:
+            self.next_id = note_id + 1
+
+    def watched_files(self):
+        """Files every write to the store changes"""
+        return [self.path]
+
+    @staticmethod
+    def _file_stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def signature(self):
+        """Cheap fingerprint of the store on disk, for polling for changes"""
+        return tuple(self._file_stat(path) for path in self.watched_files())
+
+    def changes(self, known, metadata_only=False):
+        """Notes written by other processes since load() or the last call.
+
+        known maps ids to the notes as this process has them. Returns
+        (notes added or changed, ids deleted); notes this process wrote
+        itself may come back too. This default reloads the whole store and
+        compares; backends that can tell what changed more cheaply override
+        it. Call with file_lock held.
+        """
+        return self._diff(self.load(metadata_only), known)
+
+    @staticmethod
+    def _diff(fresh, known):
+        changed = [note for note in fresh if note != known.get(note["id"])]
+        fresh_ids = {note["id"] for note in fresh}
+        return changed, [note_id for note_id in known if note_id not in fresh_ids]
+
+    def load(self, metadata_only=False):
+        raise NotImplementedError
+
+    def load_content(self, note_id):
+        raise NotImplementedError
+
+    def save_all(self, notes):
+        """Replace the stored notes with the given list"""
+        raise NotImplementedError
+
+    def insert(self, note):
+        raise NotImplementedError
+
+    def insert_many(self, notes):
+        """Insert several new notes; backends override this to write them in one go"""
+        for note in notes:
+            self.insert(note)
+
+    def update(self, note):
+        raise NotImplementedError
+
+    def delete(self, note_id):
+        raise NotImplementedError
+
+    def search(self, query):
+        """Return ids of notes matching query, or None to let the caller scan"""
+        return None
+
+    def close(self):
+        pass
+
+
+# Original single-file layout
+class JsonStorage(NotesStorage):
+    """All notes in one pretty-printed JSON list, rewritten on every change.
+
+    The id counter lives next to it in "<path>.meta" so the notes file keeps
+    its original layout.
+    """
+
+    name = "json"
+    default_path = "smart_notes.json"
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        self.meta_file = self.path + ".meta"
+        self._notes = []
+
+    def load(self, metadata_only=False):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as file:
+                    self._notes = json.load(file)
+            except json.JSONDecodeError as e:
+                # Keep the damaged file around: the next save would replace it
+                print(f"Could not read {self.path} ({e}); a copy was kept as {self.path}.corrupt", file=sys.stderr)
+                shutil.copyfile(self.path, self.path + ".corrupt")
+                self._notes = []
+        else:
+            self._notes = []
+        if os.path.exists(self.meta_file):
+            try:
+                with open(self.meta_file, 'r') as file:
+                    self._track_id(json.load(file).get("next_id", 1) - 1)
+            except (json.JSONDecodeError, AttributeError):
+                pass
+        for note in self._notes:
+            self._track_id(note["id"])
+        return self._notes
+
+    def save_all(self, notes):
+        self._notes = notes
+        for note in notes:
+            self._track_id(note["id"])
+        self._write_atomic(self.path, notes, indent=2)
+        self._write_atomic(self.meta_file, {"next_id": self.next_id})
+
+    @staticmethod
+    def _write_atomic(path, data, indent=None):
+        temp_file = path + ".tmp"
+        with open(temp_file, 'w') as file:
+            json.dump(data, file, indent=indent)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, path)
+
+    def insert(self, note):
+        self.save_all(self._notes)
+
+    def insert_many(self, notes):
+        self.save_all(self._notes)
+
+    def update(self, note):
+        self.save_all(self._notes)
+
+    def delete(self, note_id):
+        self._track_id(note_id)
+        self.save_all(self._notes)
+
+    def changes(self, known, metadata_only=False):
+        # load() replaces _notes, which has to stay the manager's live list
+        live = self._notes
+        try:
+            return super().changes(known, metadata_only)
+        finally:
+            self._notes = live
+
+
+# Snapshot plus append-only journal (default backend)
+class JournalStorage(NotesStorage):
+    """Snapshot file plus an append-only log of note mutations.
+
+    The snapshot keeps the original smart_notes.json layout (a JSON list of
+    notes), so existing stores are picked up as-is. Every mutation is
+    appended to "<path>.journal" as one checksummed line and the log is
+    folded back into the snapshot by the write that takes it past
+    compact_threshold bytes.
+
+    Other processes' changes are picked up by reading only the journal
+    lines added since the last read; a full reload is needed only when the
+    snapshot has been rewritten by a compaction.
+    """
+
+    name = "journal"
+    default_path = "smart_notes.json"
+
+    def __init__(self, path=None, compact_threshold=1024 * 1024, fsync=True):
+        super().__init__(path)
+        self.journal_file = self.path + ".journal"
+        # Journal being folded into the snapshot by a compaction; one left
+        # behind was interrupted by a crash
+        self.compacting_file = self.path + ".journal.old"
+        self.compact_threshold = compact_threshold
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._journal = None
+        self._journal_size = 0
+        # The manager's live list, snapshotted on compaction
+        self._notes = []
+        # How far the journal has been read, and the files that was in
+        self._journal_offset = 0
+        self._journal_ino = None
+        self._snapshot_stat = None
+        self._records_end = 0
+
+    def load(self, metadata_only=False):
+        """Read the snapshot and replay any journaled mutations on top of it"""
+        with self._lock:
+            # Another process may have compacted the journal this was appending to
+            self._close_journal()
+        self._snapshot_stat = self._file_stat(self.path)
+        snapshot = JsonStorage(self.path)
+        notes = snapshot.load()
+        self.next_id = snapshot.next_id
+
+        positions = {note["id"]: i for i, note in enumerate(notes)}
+        # A compaction interrupted by a crash leaves its journal behind; the
+        # records are idempotent so replaying them again is always safe.
+        for path in (self.compacting_file, self.journal_file):
+            for record in self._read_records(path):
+                self._apply(notes, positions, record)
+                self._track_id(record["note"]["id"] if record["op"] == "put" else record["id"])
+        journal = self._file_stat(self.journal_file)
+        self._journal_offset = self._records_end if journal else 0
+        self._journal_ino = journal[2] if journal else None
+        self._notes = notes
+        return notes
+
+    def watched_files(self):
+        return [self.path, self.journal_file]
+
+    def changes(self, known, metadata_only=False):
+        tail = self._read_tail()
+        if tail is not None:
+            return tail
+        # load() replaces _notes, which has to stay the manager's live list
+        live = self._notes
+        try:
+            return super().changes(known, metadata_only)
+        finally:
+            self._notes = live
+
+    def _read_tail(self):
+        """Notes put and ids deleted by journal lines written since the last read.
+
+        Returns None when that isn't enough to catch up, because the snapshot
+        was rewritten or the journal replaced, and a full reload is needed.
+        """
+        if self._file_stat(self.path) != self._snapshot_stat or os.path.exists(self.compacting_file):
+            return None
+        journal = self._file_stat(self.journal_file)
+        if journal is None:
+            return None if self._journal_offset else ([], [])
+        if self._journal_ino not in (None, journal[2]) or journal[1] < self._journal_offset:
+            return None
+        if journal[1] == self._journal_offset:
+            return [], []
+        notes, deleted = {}, set()
+        for record in self._read_records(self.journal_file, self._journal_offset):
+            if record["op"] == "put":
+                note_id = record["note"]["id"]
+                notes[note_id] = record["note"]
+                deleted.discard(note_id)
+            else:
+                note_id = record["id"]
+                notes.pop(note_id, None)
+                deleted.add(note_id)
+            self._track_id(note_id)
+        self._journal_offset = self._records_end
+        self._journal_ino = journal[2]
+        return list(notes.values()), list(deleted)
+
+    def _read_records(self, path, start=0):
+        """Yield valid records from a journal, truncating a torn tail.
+
+        Only an unfinished last line is cut off; a corrupt record further
+        up is skipped, so the records after it are still read. Reading
+        starts at byte start; afterwards _records_end is where the complete
+        lines end.
+        """
+        self._records_end = start
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as file:
+            file.seek(start)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                offset = self._records_end
+                self._records_end += len(line)
+                record = self._decode(line)
+                if record is None:
+                    print(f"Skipping corrupt record at byte {offset} of {path}", file=sys.stderr)
+                    continue
+                yield record
+        if self._records_end != os.path.getsize(path):
+            # Drop the half-written record so later appends start on a clean line
+            with open(path, 'r+b') as file:
+                file.truncate(self._records_end)
+
+    @staticmethod
+    def _decode(line):
+        if not line.endswith(b"\n"):
+            return None
+        checksum, _, payload = line[:-1].partition(b" ")
+        try:
+            if int(checksum, 16) != zlib.crc32(payload):
+                return None
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _encode(record):
+        payload = json.dumps(record, separators=(",", ":")).encode("utf-8")
+        return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+    @staticmethod
+    def _apply(notes, positions, record):
+        if record["op"] == "put":
+            note = record["note"]
+            index = positions.get(note["id"])
+            if index is None:
+                positions[note["id"]] = len(notes)
+                notes.append(note)
+            else:
+                notes[index] = note
+        elif record["op"] == "delete":
+            index = positions.pop(record["id"], None)
+            if index is not None:
+                del notes[index]
+                for i in range(index, len(notes)):
+                    positions[notes[i]["id"]] = i
+
+    def insert(self, note):
+        self._track_id(note["id"])
+        self._append({"op": "put", "note": note})
+
+    def insert_many(self, notes):
+        for note in notes:
+            self._track_id(note["id"])
+        self._append(*({"op": "put", "note": note} for note in notes))
+
+    def update(self, note):
+        self._append({"op": "put", "note": note})
+
+    def delete(self, note_id):
+        self._track_id(note_id)
+        self._append({"op": "delete", "id": note_id})
+
+    def save_all(self, notes):
+        self._notes = notes
+        self.compact(notes)
+
+    def _append(self, *records):
+        # Several records share one write and one fsync
+        data = b"".join(self._encode(record) for record in records)
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_file, 'ab')
+            # Other processes append too, so the end of the file is the real position
+            stat = os.fstat(self._journal.fileno())
+            self._journal.write(data)
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            if stat.st_size == self._journal_offset:
+                # Nothing new from anyone else in between: no need to read our own records back
+                self._journal_offset = stat.st_size + len(data)
+                self._journal_ino = stat.st_ino
+            self._journal_size = stat.st_size + len(data)
+            should_compact = self._journal_size >= self.compact_threshold
+        if should_compact:
+            # Runs before returning, so it finishes while the caller still
+            # holds file_lock and no other process can append meanwhile
+            self.compact(self._notes)
+
+    def compact(self, notes):
+        """Fold the journal into a fresh snapshot of notes"""
+        with self._lock:
+            self._close_journal()
+            if os.path.exists(self.journal_file):
+                if os.path.exists(self.compacting_file):
+                    # Leftover from an interrupted compaction: fold the live
+                    # journal onto it so this snapshot covers both.
+                    with open(self.compacting_file, 'ab') as target, open(self.journal_file, 'rb') as source:
+                        shutil.copyfileobj(source, target)
+                        target.flush()
+                        os.fsync(target.fileno())
+                    os.remove(self.journal_file)
+                else:
+                    os.replace(self.journal_file, self.compacting_file)
+            # Copied so edits made on other threads can't change it mid-write
+            self._write_snapshot([dict(note) for note in notes], self.next_id)
+
+    def _write_snapshot(self, notes, next_id):
+        snapshot = JsonStorage(self.path)
+        snapshot.next_id = next_id
+        snapshot.save_all(notes)
+        if os.path.exists(self.compacting_file):
+            os.remove(self.compacting_file)
+        self._snapshot_stat = self._file_stat(self.path)
+        self._journal_offset = 0
+        self._journal_ino = None
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self._journal_size = 0
+
+    def close(self):
+        """Release the journal file"""
+        with self._lock:
+            self._close_journal()
+
+
+# Metadata index plus memory-mapped bodies
+class IndexedStorage(NotesStorage):
+    """Note metadata in a small journaled index, bodies in a separate file.
+
+    The index (path, persisted through JournalStorage) holds each note's
+    title, timestamps and the position of its body in "<stem>.content.<gen>",
+    an append-only file that is memory-mapped for reads. Loading with
+    metadata_only=True therefore reads the index alone and bodies are sliced
+    out of the map on demand. Rewritten bodies leave dead bytes behind; the
+    content file is rewritten under a new generation number by save_all(),
+    or on close() once more than half of it is dead.
+    """
+
+    name = "indexed"
+    default_path = "smart_notes.index"
+    supports_lazy_load = True
+
+    def __init__(self, path=None, compact_threshold=1024 * 1024):
+        super().__init__(path)
+        self.metadata = JournalStorage(self.path, compact_threshold=compact_threshold)
+        self.content_stem = os.path.splitext(self.path)[0] + ".content."
+        self._lock = threading.RLock()
+        self._entries = []
+        self._entries_by_id = {}
+        self._maps = {}
+        self._writer = None
+        self.generation = 0
+        self.dead_bytes = 0
+
+    def _content_file(self, generation):
+        return self.content_stem + str(generation)
+
+    def load(self, metadata_only=False):
+        with self._lock:
+            # Another process may have rewritten the bodies under a new generation
+            self._close_files()
+            self._entries = self.metadata.load()
+            self._entries_by_id = {entry["id"]: entry for entry in self._entries}
+            self.next_id = self.metadata.next_id
+            generations = {entry["gen"] for entry in self._entries}
+            self.generation = max(generations, default=0)
+            # Content files no entry points at are left over from an
+            # interrupted rewrite
+            directory = os.path.dirname(os.path.abspath(self.path))
+            prefix = os.path.basename(self.content_stem)
+            for name in os.listdir(directory):
+                suffix = name[len(prefix):]
+                if name.startswith(prefix) and suffix.isdigit():
+                    if int(suffix) not in generations and int(suffix) != self.generation:
+                        os.remove(os.path.join(directory, name))
+            live = sum(entry["length"] for entry in self._entries)
+            total = sum(os.path.getsize(self._content_file(g))
+                        for g in generations | {self.generation} if os.path.exists(self._content_file(g)))
+            self.dead_bytes = total - live
+        return [self._note(entry, metadata_only) for entry in self._entries]
+
+    def _note(self, entry, metadata_only):
+        fields = {key: entry[key] for key in ("id", "title", "created_at", "updated_at")}
+        if metadata_only:
+            return LazyNote(fields, self)
+        fields["content"] = self.load_content(entry["id"])
+        return fields
+
+    def watched_files(self):
+        return self.metadata.watched_files()
+
+    def changes(self, known, metadata_only=False):
+        with self._lock:
+            tail = self.metadata._read_tail()
+            if tail is None:
+                return super().changes(known, metadata_only)
+            entries, deleted = tail
+            for note_id in deleted:
+                entry = self._entries_by_id.pop(note_id, None)
+                if entry is not None:
+                    self._entries.remove(entry)
+                self._track_id(note_id)
+            for entry in entries:
+                old = self._entries_by_id.get(entry["id"])
+                if old is None:
+                    self._entries.append(entry)
+                    self._entries_by_id[entry["id"]] = entry
+                else:
+                    old.update(entry)
+                self._track_id(entry["id"])
+            return [self._note(entry, metadata_only) for entry in entries], deleted
+
+    def load_content(self, note_id):
+        with self._lock:
+            entry = self._entries_by_id.get(note_id)
+            if entry is None or not entry["length"]:
+                return ""
+            end = entry["offset"] + entry["length"]
+            content_map = self._maps.get(entry["gen"])
+            if content_map is None or len(content_map) < end:
+                # First read from this file, or it has grown since mapping
+                if content_map is not None:
+                    content_map.close()
+                with open(self._content_file(entry["gen"]), 'rb') as file:
+                    content_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[entry["gen"]] = content_map
+            return content_map[entry["offset"]:end].decode("utf-8")
+
+    def _append_body(self, content):
+        return self._append_bodies([content])[0]
+
+    def _append_bodies(self, contents):
+        """Append bodies to the content file; returns their (offset, length) pairs"""
+        if self._writer is None:
+            self._writer = open(self._content_file(self.generation), 'ab')
+        offset = self._writer.seek(0, os.SEEK_END)
+        positions = []
+        for content in contents:
+            data = content.encode("utf-8")
+            self._writer.write(data)
+            positions.append((offset, len(data)))
+            offset += len(data)
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        return positions
+
+    def _entry(self, note, offset, length):
+        return {"id": note["id"], "title": note["title"], "created_at": note["created_at"],
+                "updated_at": note["updated_at"], "gen": self.generation, "offset": offset, "length": length}
+
+    def insert(self, note):
+        with self._lock:
+            # Body first: if we crash before the index record, it's just dead bytes
+            offset, length = self._append_body(note["content"])
+            entry = self._entry(note, offset, length)
+            self._entries.append(entry)
+            self._entries_by_id[note["id"]] = entry
+            self._track_id(note["id"])
+            self.metadata.insert(entry)
+
+    def insert_many(self, notes):
+        with self._lock:
+            positions = self._append_bodies([note["content"] for note in notes])
+            entries = [self._entry(note, offset, length) for note, (offset, length) in zip(notes, positions)]
+            for entry in entries:
+                self._entries.append(entry)
+                self._entries_by_id[entry["id"]] = entry
+                self._track_id(entry["id"])
+            self.metadata.insert_many(entries)
+
+    def update(self, note):
+        with self._lock:
+            old = self._entries_by_id[note["id"]]
+            if "content" in note:
+                offset, length = self._append_body(note["content"])
+                self.dead_bytes += old["length"]
+                old.update(self._entry(note, offset, length))
+            else:
+                old.update(title=note["title"], created_at=note["created_at"], updated_at=note["updated_at"])
+            self.metadata.update(old)
+
+    def delete(self, note_id):
+        with self._lock:
+            entry = self._entries_by_id.pop(note_id, None)
+            if entry is not None:
+                self._entries.remove(entry)
+                self.dead_bytes += entry["length"]
+            self._track_id(note_id)
+            self.metadata.delete(note_id)
+
+    def save_all(self, notes):
+        with self._lock:
+            bodies = [note["content"] for note in notes]
+            self._rewrite(notes, bodies)
+
+    def _rewrite(self, notes, bodies):
+        """Write every body to a new content generation and switch the index to it"""
+        old_generations = set(self._maps) | {self.generation}
+        self._close_files()
+        self.generation += 1
+        entries = []
+        with open(self._content_file(self.generation), 'wb') as file:
+            for note, body in zip(notes, bodies):
+                data = body.encode("utf-8")
+                entries.append(self._entry(note, file.tell(), len(data)))
+                file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        self._entries = entries
+        self._entries_by_id = {entry["id"]: entry for entry in entries}
+        for note in notes:
+            self._track_id(note["id"])
+        self.metadata.next_id = max(self.metadata.next_id, self.next_id)
+        # The index snapshot is the switch-over point between generations
+        self.metadata.save_all(entries)
+        self.dead_bytes = 0
+        for generation in old_generations:
+            if os.path.exists(self._content_file(generation)):
+                os.remove(self._content_file(generation))
+
+    def _close_files(self):
+        for content_map in self._maps.values():
+            content_map.close()
+        self._maps = {}
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def close(self):
+        with self._lock:
+            live = sum(entry["length"] for entry in self._entries)
+            if self.dead_bytes > max(live, 1024 * 1024):
+                notes = [dict(entry) for entry in self._entries]
+                self._rewrite(notes, [self.load_content(entry["id"]) for entry in self._entries])
+            self._close_files()
+            self.metadata.close()
+
+
+# One file per note
+class ShardedStorage(NotesStorage):
+    """Each note in its own JSON file under "<path>/notes", plus a manifest.
+
+    Only the shards of changed notes are written, each through a temp file,
+    fsync and rename, so a crash mid-save can't leave a half-written note.
+    A shard that fails to parse is moved to "<path>/corrupt" and reported
+    in bad_shards instead of taking the rest of the store down with it.
+    """
+
+    name = "sharded"
+    default_path = "smart_notes_shards"
+    FORMAT_VERSION = 1
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        self.notes_dir = os.path.join(self.path, "notes")
+        self.corrupt_dir = os.path.join(self.path, "corrupt")
+        self.manifest_file = os.path.join(self.path, "manifest.json")
+        self.bad_shards = []
+        # Shard file name -> stat key when last read or written, to spot changes
+        self._shard_stats = {}
+        os.makedirs(self.notes_dir, exist_ok=True)
+
+    def _shard_file(self, note_id):
+        return os.path.join(self.notes_dir, f"{note_id}.json")
+
+    @staticmethod
+    def _stat_key(stat):
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _read_manifest(self):
+        if os.path.exists(self.manifest_file):
+            try:
+                with open(self.manifest_file, 'r') as file:
+                    self._track_id(json.load(file)["next_id"] - 1)
+            except (ValueError, KeyError, TypeError) as e:
+                # The shards still carry their ids, so the counter can be rebuilt
+                print(f"Ignoring unreadable manifest {self.manifest_file}: {e}", file=sys.stderr)
+
+    def load(self, metadata_only=False):
+        self._read_manifest()
+        notes = []
+        self.bad_shards = []
+        self._shard_stats = {}
+        for entry in os.scandir(self.notes_dir):
+            if entry.name.endswith(".tmp"):
+                # Left behind by a write that never got renamed into place
+                os.remove(entry.path)
+                continue
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                stat = entry.stat()
+                with open(entry.path, 'r') as file:
+                    note = json.load(file)
+                self._track_id(note["id"])
+                notes.append(note)
+                self._shard_stats[entry.name] = self._stat_key(stat)
+            except (ValueError, KeyError, TypeError, OSError) as e:
+                print(f"Skipping corrupt note file {entry.path}: {e}", file=sys.stderr)
+                self.bad_shards.append(entry.name)
+                os.makedirs(self.corrupt_dir, exist_ok=True)
+                os.replace(entry.path, os.path.join(self.corrupt_dir, entry.name))
+        notes.sort(key=lambda note: note["id"])
+        return notes
+
+    def watched_files(self):
+        # Every shard write renames a file into notes_dir, changing its mtime
+        return [self.notes_dir, self.manifest_file]
+
+    def changes(self, known, metadata_only=False):
+        """Read just the shards whose stat changed since they were last seen"""
+        notes, seen = [], set()
+        for entry in os.scandir(self.notes_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            seen.add(entry.name)
+            try:
+                stat = self._stat_key(entry.stat())
+                if self._shard_stats.get(entry.name) == stat:
+                    continue
+                with open(entry.path, 'r') as file:
+                    note = json.load(file)
+                self._track_id(note["id"])
+            except (ValueError, KeyError, TypeError, OSError):
+                # Left for load() to set aside as corrupt
+                continue
+            self._shard_stats[entry.name] = stat
+            notes.append(note)
+        deleted = [name for name in self._shard_stats if name not in seen]
+        for name in deleted:
+            del self._shard_stats[name]
+        self._read_manifest()
+        return notes, [int(name[:-len(".json")]) for name in deleted]
+
+    def _write_note(self, note):
+        path = self._shard_file(note["id"])
+        self._write_shard(path, self._note_data(note))
+        # Our own write isn't a change to pick up later
+        self._shard_stats[os.path.basename(path)] = self._stat_key(os.stat(path))
+
+    def _write_shard(self, path, data):
+        temp_file = path + ".tmp"
+        with open(temp_file, 'w') as file:
+            json.dump(data, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, path)
+
+    def _sync_directory(self):
+        # Makes the renames durable; not possible (or needed) on Windows
+        if hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.notes_dir, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _write_manifest(self):
+        self._write_shard(self.manifest_file, {"format": self.FORMAT_VERSION, "next_id": self.next_id})
+
+    def _note_data(self, note):
+        return {key: note[key] for key in ("id", "title", "content", "created_at", "updated_at")}
+
+    def insert(self, note):
+        self._write_note(note)
+        self._sync_directory()
+        # Shard ids rebuild the counter on load, so only record it when the
+        # highest id could disappear with a delete
+        self._track_id(note["id"])
+
+    def insert_many(self, notes):
+        for note in notes:
+            self._write_note(note)
+            self._track_id(note["id"])
+        # One directory sync covers all the renames
+        self._sync_directory()
+
+    def update(self, note):
+        self._write_note(note)
+        self._sync_directory()
+
+    def delete(self, note_id):
+        self._track_id(note_id)
+        self._write_manifest()
+        self._shard_stats.pop(f"{note_id}.json", None)
+        if os.path.exists(self._shard_file(note_id)):
+            os.remove(self._shard_file(note_id))
+            self._sync_directory()
+
+    def save_all(self, notes):
+        keep = set()
+        self._shard_stats = {}
+        for note in notes:
+            self._track_id(note["id"])
+            self._write_note(note)
+            keep.add(f"{note['id']}.json")
+        for entry in os.scandir(self.notes_dir):
+            if entry.name not in keep:
+                os.remove(entry.path)
+        self._sync_directory()
+        self._write_manifest()
+
+
+# SQLite database with an FTS5 index for search
+class SQLiteStorage(NotesStorage):
+    """One row per note; mutations and searches are single indexed statements.
+
+    Search uses an external-content FTS5 table with the trigram tokenizer,
+    which keeps the substring semantics of NotesManager.search_notes. Queries
+    shorter than a trigram, or SQLite builds without FTS5, fall back to
+    scanning in NotesManager.
+
+    Triggers log the id of every note inserted, updated or deleted to a
+    changes table, so other processes' writes are picked up by reading only
+    those rows. The log keeps its last CHANGE_LOG_ROWS rows.
+    """
+
+    name = "sqlite"
+    default_path = "smart_notes.db"
+    supports_lazy_load = True
+    CHANGE_LOG_ROWS = 10000
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        self._lock = threading.RLock()
+        # Last row of the change log this process has caught up to
+        self._change_seq = 0
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS notes ("
+                "id INTEGER PRIMARY KEY, title TEXT NOT NULL, content TEXT NOT NULL, "
+                "created_at TEXT NOT NULL, updated_at TEXT NOT NULL)"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, note_id INTEGER NOT NULL)"
+            )
+            for name, event, row in (("insert", "INSERT", "new"), ("update", "UPDATE", "new"),
+                                     ("delete", "DELETE", "old")):
+                self.conn.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS notes_log_{name} AFTER {event} ON notes BEGIN "
+                    f"INSERT INTO changes (note_id) VALUES ({row}.id); END"
+                )
+        self.fts_available = self._create_fts()
+
+    def _create_fts(self):
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5("
+                    "title, content, content='notes', content_rowid='id', tokenize='trigram')"
+                )
+                # Keep the external-content index in step with the notes table
+                self.conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS notes_ai AFTER INSERT ON notes BEGIN "
+                    "INSERT INTO notes_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END"
+                )
+                self.conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS notes_ad AFTER DELETE ON notes BEGIN "
+                    "INSERT INTO notes_fts(notes_fts, rowid, title, content) "
+                    "VALUES ('delete', old.id, old.title, old.content); END"
+                )
+                self.conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS notes_au AFTER UPDATE ON notes BEGIN "
+                    "INSERT INTO notes_fts(notes_fts, rowid, title, content) "
+                    "VALUES ('delete', old.id, old.title, old.content); "
+                    "INSERT INTO notes_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END"
+                )
+            return True
+        except sqlite3.OperationalError:
+            # FTS5 or the trigram tokenizer (SQLite 3.34+) is missing
+            return False
+
+    @staticmethod
+    def _row(note):
+        return (note["id"], note["title"], note["content"], note["created_at"], note["updated_at"])
+
+    def _note(self, row, metadata_only):
+        if metadata_only:
+            return LazyNote({"id": row[0], "title": row[1], "created_at": row[2], "updated_at": row[3]}, self)
+        return {"id": row[0], "title": row[1], "content": row[4], "created_at": row[2], "updated_at": row[3]}
+
+    def _select(self, metadata_only, where="", params=()):
+        columns = "id, title, created_at, updated_at" + ("" if metadata_only else ", content")
+        return self.conn.execute(f"SELECT {columns} FROM notes {where} ORDER BY id", params).fetchall()
+
+    def _last_change(self):
+        return self.conn.execute("SELECT coalesce(max(seq), 0) FROM changes").fetchone()[0]
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """Transaction for a write of ours, which changes() then won't report"""
+        with self._lock, self.conn:
+            caught_up = self._last_change() == self._change_seq
+            yield
+            if caught_up:
+                self._change_seq = self._last_change()
+
+    def _read_next_id(self):
+        stored = self.conn.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+        if stored:
+            self._track_id(stored[0] - 1)
+
+    def _save_next_id(self):
+        # Only ever moves forward, even if another writer got there first
+        self.conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('next_id', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = max(value, excluded.value)",
+            (self.next_id,)
+        )
+
+    def load(self, metadata_only=False):
+        with self._lock:
+            self._change_seq = self._last_change()
+            rows = self._select(metadata_only)
+            self._read_next_id()
+        if rows:
+            self._track_id(rows[-1][0])
+        return [self._note(row, metadata_only) for row in rows]
+
+    def watched_files(self):
+        # Commits land in the write-ahead log until a checkpoint
+        return [self.path, self.path + "-wal"]
+
+    def changes(self, known, metadata_only=False):
+        with self._lock:
+            first, last = self.conn.execute("SELECT min(seq), max(seq) FROM changes").fetchone()
+            if last is None or last <= self._change_seq:
+                return [], []
+            if first > self._change_seq + 1:
+                # The log no longer reaches back to where we were
+                return super().changes(known, metadata_only)
+            note_ids = [row[0] for row in self.conn.execute(
+                "SELECT DISTINCT note_id FROM changes WHERE seq > ? AND seq <= ?", (self._change_seq, last))]
+            self._change_seq = last
+            rows = []
+            # Stay under SQLite's limit on query parameters
+            for start in range(0, len(note_ids), 500):
+                batch = note_ids[start:start + 500]
+                rows.extend(self._select(metadata_only, f"WHERE id IN ({','.join('?' * len(batch))})", batch))
+            self._read_next_id()
+        notes = [self._note(row, metadata_only) for row in rows]
+        for note in notes:
+            self._track_id(note["id"])
+        found = {note["id"] for note in notes}
+        return notes, [note_id for note_id in note_ids if note_id not in found]
+
+    def load_content(self, note_id):
+        with self._lock:
+            row = self.conn.execute("SELECT content FROM notes WHERE id = ?", (note_id,)).fetchone()
+        return row[0] if row else ""
+
+    def save_all(self, notes):
+        with self._writing():
+            # Read every row first: lazy notes fetch their bodies from this table
+            rows = [self._row(n) for n in notes]
+            self.conn.execute("DELETE FROM notes")
+            self.conn.executemany("INSERT INTO notes VALUES (?, ?, ?, ?, ?)", rows)
+            for note in notes:
+                self._track_id(note["id"])
+            self._save_next_id()
+            self._prune_changes()
+
+    def _prune_changes(self):
+        self.conn.execute("DELETE FROM changes WHERE seq <= (SELECT max(seq) FROM changes) - ?",
+                          (self.CHANGE_LOG_ROWS,))
+
+    def insert(self, note):
+        with self._writing():
+            self.conn.execute("INSERT INTO notes VALUES (?, ?, ?, ?, ?)", self._row(note))
+            self._track_id(note["id"])
+            self._save_next_id()
+
+    def insert_many(self, notes):
+        with self._writing():
+            self.conn.executemany("INSERT INTO notes VALUES (?, ?, ?, ?, ?)", [self._row(n) for n in notes])
+            for note in notes:
+                self._track_id(note["id"])
+            self._save_next_id()
+
+    def update(self, note):
+        with self._writing():
+            if "content" not in note:
+                # Lazy note whose body wasn't changed
+                self.conn.execute(
+                    "UPDATE notes SET title = ?, created_at = ?, updated_at = ? WHERE id = ?",
+                    (note["title"], note["created_at"], note["updated_at"], note["id"])
+                )
+                return
+            self.conn.execute(
+                "UPDATE notes SET title = ?, content = ?, created_at = ?, updated_at = ? WHERE id = ?",
+                self._row(note)[1:] + (note["id"],)
+            )
+
+    def delete(self, note_id):
+        with self._writing():
+            self.conn.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+            self._track_id(note_id)
+            self._save_next_id()
+
+    def search(self, query):
+        if not self.fts_available or len(query) < 3:
+            return None
+        # A quoted string is matched as a substring by the trigram tokenizer
+        match = '"' + query.replace('"', '""') + '"'
+        with self._lock:
+            rows = self.conn.execute("SELECT rowid FROM notes_fts WHERE notes_fts MATCH ?", (match,)).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self._lock:
+            with self.conn:
+                self._prune_changes()
+            self.conn.close()
+
+
+# Length-prefixed binary records with compressed bodies
+class BinaryStorage(NotesStorage):
+    """Notes as length-prefixed binary records in one append-only file.
+
+    The file starts with HEADER (magic, format version, id counter and the
+    position of the index). Each record is RECORD (its length and a CRC32
+    of everything but the body), KEY (operation and note id) and, for a
+    put, PUT followed by the timestamps, title and body as UTF-8. Bodies of
+    compress_threshold bytes or more are stored zlib- or lzma-compressed
+    when that makes them smaller; a body's own CRC32 is checked when it is
+    read.
+
+    save_all() writes a put per note followed by an index record listing
+    every note's metadata and body position, so loading reads the index in
+    one go and only parses records appended after it. The file is
+    memory-mapped: with metadata_only=True bodies stay on disk until read.
+    Every change appends a record; the superseded ones are dead bytes,
+    dropped when save_all() rewrites the file or on close() once more than
+    half of it is dead. A torn record at the end, left by a crash, is cut
+    off on load; damaged records before valid ones are skipped.
+    """
+
+    name = "binary"
+    default_path = "smart_notes.bin"
+    supports_lazy_load = True
+    MAGIC = b"SNBF"
+    FORMAT_VERSION = 1
+    # magic, format version, reserved, next id, index record position and size
+    HEADER = struct.Struct("<4sHHQQQ")
+    # bytes after this struct, CRC32 of them up to the body
+    RECORD = struct.Struct("<II")
+    # operation, note id (the index's codec for an index record)
+    KEY = struct.Struct("<Bq")
+    # codec, created_at/updated_at/title lengths, stored body length, body CRC32
+    PUT = struct.Struct("<BHHIII")
+    OP_PUT = 1
+    OP_DELETE = 2
+    OP_INDEX = 3
+    # Where a record could start: its operation byte follows the RECORD struct
+    RECORD_START = re.compile(rb"(?s)(?=.{%d}[\x01-\x03])" % RECORD.size)
+    CODECS = {"none": 0, "zlib": 1, "lzma": 2}
+    # Raw LZMA2 without the .xz container, and a dictionary sized for note
+    # bodies rather than whole files: several times faster on short text
+    LZMA_FILTERS = [{"id": 0x21, "preset": 6, "dict_size": 1 << 20}]
+
+    def __init__(self, path=None, compression="zlib", compress_threshold=256):
+        super().__init__(path)
+        if compression not in self.CODECS:
+            raise ValueError(f"Unknown compression {compression!r}; use one of {', '.join(self.CODECS)}")
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self._lock = threading.RLock()
+        self._map = None
+        self._writer = None
+        # note id -> (body offset, stored length, codec, body CRC32, record size)
+        self._bodies = {}
+        # End of the records read or written so far, and the file's inode
+        self._end = 0
+        self._ino = None
+        self.dead_bytes = 0
+
+    def _compress(self, data):
+        codec = self.CODECS[self.compression]
+        if codec and len(data) >= self.compress_threshold:
+            if codec == self.CODECS["zlib"]:
+                packed = zlib.compress(data)
+            else:
+                # Imported here: most stores never use it
+                import lzma
+                packed = lzma.compress(data, format=lzma.FORMAT_RAW, filters=self.LZMA_FILTERS)
+            if len(packed) < len(data):
+                return packed, codec
+        return data, self.CODECS["none"]
+
+    @classmethod
+    def _decompress(cls, data, codec):
+        if codec == cls.CODECS["zlib"]:
+            return zlib.decompress(data)
+        if codec == cls.CODECS["lzma"]:
+            import lzma
+            return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=cls.LZMA_FILTERS)
+        return data
+
+    def _encode_put(self, note):
+        """Bytes of a put record, and its body's (offset in the record, length, codec, CRC32)"""
+        body = self._stored_body(note)
+        if body is None:
+            data, codec = self._compress(note["content"].encode("utf-8"))
+            body = (data, codec, zlib.crc32(data))
+        data, codec, crc = body
+        created, updated, title = (note[key].encode("utf-8") for key in ("created_at", "updated_at", "title"))
+        meta = (self.KEY.pack(self.OP_PUT, note["id"])
+                + self.PUT.pack(codec, len(created), len(updated), len(title), len(data), crc)
+                + created + updated + title)
+        record = self.RECORD.pack(len(meta) + len(data), zlib.crc32(meta)) + meta + data
+        return record, (self.RECORD.size + len(meta), len(data), codec, crc)
+
+    def _stored_body(self, note):
+        # A lazy note whose body wasn't changed: copy the stored bytes as they are
+        if isinstance(note, LazyNote) and note.storage is self and "content" not in note:
+            body = self._bodies.get(note["id"])
+            if body is not None:
+                offset, length, codec, crc, _ = body
+                self._ensure_mapped(offset + length)
+                return self._map[offset:offset + length], codec, crc
+        return None
+
+    def _encode_delete(self, note_id):
+        meta = self.KEY.pack(self.OP_DELETE, note_id)
+        return self.RECORD.pack(len(meta), zlib.crc32(meta)) + meta
+
+    def _parse(self, start):
+        """Valid records from byte start on, and where they end.
+
+        Records are (note id, metadata dict or None for a delete, body
+        tuple, record size). Damaged bytes followed by valid records are
+        skipped and counted as dead; with nothing valid after them they are
+        a torn tail, and parsing ends where they start.
+        """
+        data = self._map
+        end = len(data) if data is not None else 0
+        records = []
+        position = start
+        while position < end:
+            parsed = self._read_record(data, position, end)
+            if parsed is None:
+                resume = self._next_record(data, position, end)
+                if resume is None:
+                    break
+                print(f"Skipping {resume - position} damaged bytes at {position} of {self.path}", file=sys.stderr)
+                self.dead_bytes += resume - position
+                position = resume
+                continue
+            record, position = parsed
+            if record is not None:
+                records.append(record)
+        return records, position
+
+    def _read_record(self, data, position, end):
+        """The record at position and where it ends, or None if it isn't valid.
+
+        The record is None for an index record, which only repeats the
+        records before it.
+        """
+        if position + self.RECORD.size + self.KEY.size > end:
+            return None
+        size, crc = self.RECORD.unpack_from(data, position)
+        meta_start = position + self.RECORD.size
+        record_end = meta_start + size
+        if size < self.KEY.size or record_end > end:
+            return None
+        op, note_id = self.KEY.unpack_from(data, meta_start)
+        if op == self.OP_PUT:
+            fields_at = meta_start + self.KEY.size
+            if fields_at + self.PUT.size > record_end:
+                return None
+            codec, created_length, updated_length, title_length, body_length, body_crc = \
+                self.PUT.unpack_from(data, fields_at)
+            created_at = fields_at + self.PUT.size
+            updated_at = created_at + created_length
+            title_at = updated_at + updated_length
+            body_at = title_at + title_length
+            if body_at + body_length != record_end or zlib.crc32(data[meta_start:body_at]) != crc:
+                return None
+            try:
+                fields = {
+                    "id": note_id,
+                    "title": data[title_at:body_at].decode("utf-8"),
+                    "created_at": data[created_at:updated_at].decode("utf-8"),
+                    "updated_at": data[updated_at:title_at].decode("utf-8")
+                }
+            except UnicodeDecodeError:
+                return None
+            return (note_id, fields, (body_at, body_length, codec, body_crc), size + self.RECORD.size), record_end
+        if op == self.OP_DELETE and size == self.KEY.size and zlib.crc32(data[meta_start:record_end]) == crc:
+            return (note_id, None, None, size + self.RECORD.size), record_end
+        if op == self.OP_INDEX and zlib.crc32(data[meta_start:record_end]) == crc:
+            return None, record_end
+        return None
+
+    def _next_record(self, data, position, end):
+        """Where the first valid record after a damaged one at position starts; None if none does"""
+        if position + self.RECORD.size <= end:
+            # Usually just the contents are damaged and the length still holds
+            size, _ = self.RECORD.unpack_from(data, position)
+            resume = position + self.RECORD.size + size
+            if resume < end and self._read_record(data, resume, end) is not None:
+                return resume
+        for match in self.RECORD_START.finditer(data, position + 1):
+            if self._read_record(data, match.start(), end) is not None:
+                return match.start()
+        return None
+
+    def _read_index(self, position, size):
+        """Notes listed by the index record at position, keyed by id; None if unusable"""
+        data = self._map
+        if not position or position + size > len(data):
+            return None
+        length, crc = self.RECORD.unpack_from(data, position)
+        payload = data[position + self.RECORD.size:position + size]
+        if length != len(payload) or zlib.crc32(payload) != crc:
+            return None
+        op, codec = self.KEY.unpack_from(payload)
+        if op != self.OP_INDEX:
+            return None
+        # One list per field, so it's all unpacked without a Python loop
+        columns = json.loads(self._decompress(payload[self.KEY.size:], codec))
+        ids = columns["id"]
+        self._bodies.update(zip(ids, zip(columns["offset"], columns["length"], columns["codec"],
+                                         columns["crc"], columns["size"])))
+        if ids:
+            self._track_id(max(ids))
+        return {note_id: {"id": note_id, "title": title, "created_at": created_at, "updated_at": updated_at}
+                for note_id, title, created_at, updated_at
+                in zip(ids, columns["title"], columns["created_at"], columns["updated_at"])}
+
+    def _apply(self, notes, record):
+        note_id, fields, body, size = record
+        old = self._bodies.pop(note_id, None)
+        if old is not None and (body is None or old[0] != body[0]):
+            # (The same offset means our own record, read back)
+            self.dead_bytes += old[4]
+        if fields is None:
+            notes.pop(note_id, None)
+            self.dead_bytes += size
+        else:
+            notes[note_id] = fields
+            self._bodies[note_id] = body + (size,)
+        self._track_id(note_id)
+
+    def _note(self, fields, metadata_only):
+        if metadata_only:
+            return LazyNote(fields, self)
+        note = dict(fields)
+        note["content"] = self.load_content(fields["id"])
+        return note
+
+    def _ensure_mapped(self, end):
+        # First read, or the file has grown since it was mapped
+        if self._map is None or len(self._map) < end:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            with open(self.path, 'rb') as file:
+                if os.fstat(file.fileno()).st_size:
+                    self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load(self, metadata_only=False):
+        with self._lock:
+            self._close_files()
+            self._bodies = {}
+            self.dead_bytes = 0
+            self._end = 0
+            self._ino = None
+            if not os.path.exists(self.path):
+                return []
+            self._ensure_mapped(self.HEADER.size)
+            if self._map is None or len(self._map) < self.HEADER.size:
+                # Created but never written to
+                self._close_files()
+                os.remove(self.path)
+                return []
+            magic, version, _, next_id, index_at, index_size = self.HEADER.unpack_from(self._map, 0)
+            if magic != self.MAGIC:
+                raise ValueError(f"{self.path} is not a Smart Notes binary store")
+            if version > self.FORMAT_VERSION:
+                raise ValueError(f"{self.path} was written by a newer version of Smart Notes (format {version})")
+            self._track_id(next_id - 1)
+            notes = self._read_index(index_at, index_size)
+            if notes is None:
+                # No index, or a damaged one: every record has to be parsed
+                notes, start = {}, self.HEADER.size
+            else:
+                start = index_at + index_size
+            records, end = self._parse(start)
+            for record in records:
+                self._apply(notes, record)
+            if end < len(self._map):
+                # Drop the half-written record so later appends start on a clean boundary
+                self._close_files()
+                with open(self.path, 'r+b') as file:
+                    file.truncate(end)
+            self._end = end
+            self._ino = os.stat(self.path).st_ino
+            return [self._note(fields, metadata_only) for fields in notes.values()]
+
+    def load_content(self, note_id):
+        with self._lock:
+            body = self._bodies.get(note_id)
+            if body is None or not body[1]:
+                return ""
+            offset, length, codec, crc, _ = body
+            self._ensure_mapped(offset + length)
+            data = self._map[offset:offset + length]
+        if zlib.crc32(data) != crc:
+            raise ValueError(f"The text of note {note_id} is damaged in {self.path}")
+        return self._decompress(data, codec).decode("utf-8")
+
+    def changes(self, known, metadata_only=False):
+        with self._lock:
+            stat = self._file_stat(self.path)
+            if stat is None and not self._end:
+                return [], []
+            if stat is None or not self._end or stat[2] != self._ino or stat[1] < self._end:
+                # Rewritten (or removed) by another process
+                return super().changes(known, metadata_only)
+            if stat[1] == self._end:
+                return [], []
+            self._ensure_mapped(stat[1])
+            records, self._end = self._parse(self._end)
+            notes, deleted = {}, set()
+            for record in records:
+                self._apply(notes, record)
+                if record[1] is None:
+                    deleted.add(record[0])
+                else:
+                    deleted.discard(record[0])
+            return [self._note(fields, metadata_only) for fields in notes.values()], list(deleted)
+
+    def _append(self, data):
+        """Write records at the end of the file; returns the offset they start at"""
+        if self._writer is None:
+            self._writer = open(self.path, 'ab')
+        stat = os.fstat(self._writer.fileno())
+        start = stat.st_size
+        if not start:
+            header = self.HEADER.pack(self.MAGIC, self.FORMAT_VERSION, 0, self.next_id, 0, 0)
+            data = header + data
+            start = len(header)
+        self._writer.write(data)
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        if stat.st_size == self._end:
+            # Nothing new from anyone else in between: no need to read our own records back
+            self._end = stat.st_size + len(data)
+            self._ino = stat.st_ino
+        return start
+
+    def _put(self, notes):
+        with self._lock:
+            encoded = [self._encode_put(note) for note in notes]
+            position = self._append(b"".join(record for record, _ in encoded))
+            for note, (record, body) in zip(notes, encoded):
+                old = self._bodies.get(note["id"])
+                if old is not None:
+                    self.dead_bytes += old[4]
+                self._bodies[note["id"]] = (position + body[0],) + body[1:] + (len(record),)
+                position += len(record)
+                self._track_id(note["id"])
+
+    def insert(self, note):
+        self._put([note])
+
+    def insert_many(self, notes):
+        self._put(notes)
+
+    def update(self, note):
+        self._put([note])
+
+    def delete(self, note_id):
+        with self._lock:
+            record = self._encode_delete(note_id)
+            self._append(record)
+            old = self._bodies.pop(note_id, None)
+            if old is not None:
+                self.dead_bytes += old[4]
+            self.dead_bytes += len(record)
+            self._track_id(note_id)
+
+    def save_all(self, notes):
+        """Rewrite the file with one record per note, through a temp file"""
+        with self._lock:
+            for note in notes:
+                self._track_id(note["id"])
+            temp_file = self.path + ".tmp"
+            bodies = {}
+            columns = {key: [] for key in ("id", "title", "created_at", "updated_at",
+                                           "offset", "length", "codec", "crc", "size")}
+            with open(temp_file, 'wb') as file:
+                file.write(self.HEADER.pack(self.MAGIC, self.FORMAT_VERSION, 0, self.next_id, 0, 0))
+                for note in notes:
+                    # Lazy notes still read their bodies from the current file
+                    record, body = self._encode_put(note)
+                    body = (file.tell() + body[0],) + body[1:] + (len(record),)
+                    bodies[note["id"]] = body
+                    for key, value in zip(columns, (note["id"], note["title"], note["created_at"],
+                                                    note["updated_at"]) + body):
+                        columns[key].append(value)
+                    file.write(record)
+                # The index is mostly repeated timestamps, so it is always worth compressing
+                index = json.dumps(columns, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+                payload = self.KEY.pack(self.OP_INDEX, self.CODECS["zlib"]) + zlib.compress(index)
+                index_at = file.tell()
+                file.write(self.RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+                file.seek(0)
+                file.write(self.HEADER.pack(self.MAGIC, self.FORMAT_VERSION, 0, self.next_id,
+                                            index_at, self.RECORD.size + len(payload)))
+                file.flush()
+                os.fsync(file.fileno())
+            self._close_files()
+            os.replace(temp_file, self.path)
+            self._bodies = bodies
+            self.dead_bytes = 0
+            stat = os.stat(self.path)
+            self._end = stat.st_size
+            self._ino = stat.st_ino
+
+    def _close_files(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def close(self):
+        with self._lock:
+            live = sum(body[4] for body in self._bodies.values())
+            if self.dead_bytes > max(live, 1024 * 1024):
+                self.save_all(self.load(metadata_only=True))
+            self._close_files()
+
+
+STORAGE_BACKENDS = {
+    JsonStorage.name: JsonStorage,
+    JournalStorage.name: JournalStorage,
+    IndexedStorage.name: IndexedStorage,
+    ShardedStorage.name: ShardedStorage,
+    SQLiteStorage.name: SQLiteStorage,
+    BinaryStorage.name: BinaryStorage,
+}
+DEFAULT_STORAGE_BACKEND = JournalStorage.name
+CONFIG_FILE = "smartnotes_config.json"
+
+
+def load_config():
+    """Read smartnotes_config.json, returning {} when it is missing or unreadable"""
+    try:
+        if os.path.exists(CONFIG_FILE):
+            with open(CONFIG_FILE, 'r') as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"Error loading config: {e}", file=sys.stderr)
+    return {}
+
+
+def save_config(config):
+    with open(CONFIG_FILE, 'w') as f:
+        json.dump(config, f)
+
+
+def create_storage(backend=None, path=None):
+    """Build the storage backend named in the config (or given explicitly)"""
+    config = load_config()
+    configured = config.get("storage_backend", DEFAULT_STORAGE_BACKEND)
+    backend = backend or configured
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    # notes_path belongs to the configured backend; another one gets its default
+    if not path and backend == configured:
+        path = config.get("notes_path")
+    options = {}
+    if backend == BinaryStorage.name:
+        options = {"compression": config.get("binary_compression", "zlib"),
+                   "compress_threshold": config.get("binary_compress_threshold", 256)}
+    return STORAGE_BACKENDS[backend](path, **options)
+
+
+def storage_size(path):
+    """Bytes on disk used by the store at path, including its side files"""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(folder, name))
+                   for folder, _, names in os.walk(path) for name in names)
+    directory, base = os.path.split(path)
+    stem = os.path.splitext(base)[0]
+    total = 0
+    for entry in os.scandir(directory or "."):
+        if entry.is_file() and (entry.name == base or entry.name.startswith((base + ".", base + "-", stem + ".content."))):
+            total += entry.stat().st_size
+    return total
+
+
+def migrate_storage(source, target):
+    """Copy every note from one storage backend into another"""
+    notes = source.load()
+    if isinstance(source, JournalStorage):
+        # Fold the journal in so the snapshot alone is a complete copy
+        source.save_all(notes)
+    target.next_id = max(target.next_id, source.next_id)
+    target.save_all(notes)
+    return len(notes)
+
+
+class NoteHistory:
+    """Earlier versions of notes, in one JSON-lines file per note.
+
+    Each line is a revision holding either the note's whole text (a
+    snapshot) or the line changes from the revision before it (a delta). A
+    snapshot is written at least every snapshot_every revisions, so reading
+    any revision costs one snapshot plus at most snapshot_every - 1 deltas.
+    Only the newest max_revisions are listed; once a file holds
+    snapshot_every more than that it is rewritten without the oldest.
+
+    record() captures the version a change is about to replace, and
+    flush(), run by NotesManager while it saves, writes the captured
+    versions out. A note changed again within interval seconds of its last
+    revision gets no new one, so a burst of typing makes a single revision.
+    """
+
+    TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self, directory, max_revisions=50, snapshot_every=10, interval=300):
+        self.directory = directory
+        self.max_revisions = max(1, max_revisions)
+        self.snapshot_every = max(1, snapshot_every)
+        self.interval = interval
+        # Note id -> (captured at, version, forced) tuples waiting for
+        # flush(), oldest first; None means the note's history is deleted
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _file(self, note_id):
+        return os.path.join(self.directory, f"{note_id}.jsonl")
+
+    def record(self, note_id, title, content, updated_at, force=False):
+        """Capture a note's current version before it changes.
+
+        force records it even if the last revision is recent, as restoring
+        one does so the text it replaces can be got back.
+        """
+        now = datetime.now()
+        with self._lock:
+            versions = self._pending.setdefault(note_id, [])
+            if versions is None:
+                return
+            version = {"title": title, "content": content, "updated_at": updated_at}
+            if versions and (versions[-1][1] == version or not force
+                             and (now - versions[-1][0]).total_seconds() < self.interval):
+                return
+            versions.append((now, version, force))
+
+    def forget(self, note_id):
+        """Delete a note's history at the next flush"""
+        with self._lock:
+            self._pending[note_id] = None
+
+    def renumber(self, note_id, new_id):
+        with self._lock:
+            if note_id in self._pending:
+                self._pending[new_id] = self._pending.pop(note_id)
+
+    def flush(self):
+        """Write the captured versions; call with the store's file lock held"""
+        with self._lock:
+            pending = list(self._pending.items())
+            self._pending = {}
+        written = 0
+        try:
+            for note_id, versions in pending:
+                if versions is None:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self._file(note_id))
+                else:
+                    self._write(note_id, versions)
+                written += 1
+        finally:
+            with self._lock:
+                # Put back what wasn't written, ahead of anything newer
+                for note_id, versions in pending[written:]:
+                    newer = self._pending.pop(note_id, [])
+                    self._pending[note_id] = None if versions is None or newer is None else versions + newer
+
+    def _write(self, note_id, versions):
+        path = self._file(note_id)
+        revisions, end = self._read(path)
+        lines = []
+        for captured, version, force in versions:
+            if revisions and not force and (captured - datetime.strptime(
+                    revisions[-1]["saved_at"], self.TIME_FORMAT)).total_seconds() < self.interval:
+                continue
+            revision = self._encode(revisions, version, captured.strftime(self.TIME_FORMAT))
+            revisions.append(revision)
+            lines.append(json.dumps(revision, ensure_ascii=False) + "\n")
+        if not lines:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        if len(revisions) > self.max_revisions + self.snapshot_every:
+            self._rewrite(path, revisions)
+            return
+        if os.path.exists(path) and os.path.getsize(path) > end:
+            # Drop a line torn by a crash mid-append
+            os.truncate(path, end)
+        with open(path, 'a', encoding="utf-8") as file:
+            file.writelines(lines)
+
+    def _encode(self, revisions, version, saved_at):
+        """The revision line for version, as a delta from the last one when that's worth it"""
+        revision = {
+            "revision": revisions[-1]["revision"] + 1 if revisions else 1,
+            "saved_at": saved_at,
+            "updated_at": version["updated_at"],
+            "title": version["title"]
+        }
+        content = version["content"]
+        chain = 0
+        for previous in reversed(revisions):
+            if "content" in previous:
+                break
+            chain += 1
+        if revisions and chain < self.snapshot_every - 1:
+            delta = self.make_delta(self._content(revisions, len(revisions) - 1), content)
+            # A delta rewriting most of the note would cost more to read back than it saves
+            if sum(len(text) for _, _, text in delta) + 16 * len(delta) < len(content) // 2:
+                revision["delta"] = delta
+                return revision
+        revision["content"] = content
+        return revision
+
+    def _rewrite(self, path, revisions):
+        """Rewrite a note's history with just the newest max_revisions"""
+        kept = []
+        texts = [self._content(revisions, index) for index in range(len(revisions) - self.max_revisions,
+                                                                    len(revisions))]
+        for revision, content in zip(revisions[-self.max_revisions:], texts):
+            version = dict(revision, content=content)
+            encoded = self._encode(kept, version, revision["saved_at"])
+            encoded["revision"] = revision["revision"]
+            kept.append(encoded)
+        temp_file = path + ".tmp"
+        with open(temp_file, 'w', encoding="utf-8") as file:
+            file.writelines(json.dumps(revision, ensure_ascii=False) + "\n" for revision in kept)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, path)
+
+    @staticmethod
+    def _read(path):
+        """A history file's revisions, oldest first, and where its last whole line ends"""
+        revisions, end = [], 0
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return revisions, end
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break
+            try:
+                revisions.append(json.loads(line))
+            except ValueError:
+                break
+            end += len(line)
+        return revisions, end
+
+    def _content(self, revisions, index):
+        start = index
+        while "content" not in revisions[start]:
+            start -= 1
+        content = revisions[start]["content"]
+        for revision in revisions[start + 1:index + 1]:
+            content = self.apply_delta(content, revision["delta"])
+        return content
+
+    @staticmethod
+    def make_delta(old, new):
+        """Line changes turning old into new, as [start, end, text] items
+        that each replace old lines start:end with text"""
+        old_lines = old.splitlines(keepends=True)
+        new_lines = new.splitlines(keepends=True)
+        # Edits are usually in one place, so match the untouched ends cheaply first
+        limit = min(len(old_lines), len(new_lines))
+        prefix = 0
+        while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+            suffix += 1
+        matcher = difflib.SequenceMatcher(None, old_lines[prefix:len(old_lines) - suffix],
+                                          new_lines[prefix:len(new_lines) - suffix])
+        return [[prefix + i1, prefix + i2, "".join(new_lines[prefix + j1:prefix + j2])]
+                for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+    @staticmethod
+    def apply_delta(old, delta):
+        lines = old.splitlines(keepends=True)
+        parts, position = [], 0
+        for start, end, text in delta:
+            parts.extend(lines[position:start])
+            parts.append(text)
+            position = end
+        parts.extend(lines[position:])
+        return "".join(parts)
+
+    def revisions(self, note_id):
+        """A note's kept revisions, newest first, without their text"""
+        revisions, _ = self._read(self._file(note_id))
+        return [{key: revision[key] for key in ("revision", "saved_at", "updated_at", "title")}
+                for revision in reversed(revisions[-self.max_revisions:])]
+
+    def get(self, note_id, revision):
+        """One revision with its text, or None if it isn't kept"""
+        revisions, _ = self._read(self._file(note_id))
+        first = max(0, len(revisions) - self.max_revisions)
+        for index in range(first, len(revisions)):
+            if revisions[index]["revision"] == revision:
+                found = {key: revisions[index][key] for key in ("revision", "saved_at", "updated_at", "title")}
+                found["content"] = self._content(revisions, index)
+                return found
+        return None
+
+
+def create_history(storage):
+    """NoteHistory kept beside the store, as set in the config file; None if turned off"""
+    config = load_config()
+    max_revisions = config.get("history_max_revisions", 50)
+    if not max_revisions:
+        return None
+    return NoteHistory(storage.path + ".history", max_revisions=max_revisions,
+                       snapshot_every=config.get("history_snapshot_every", 10),
+                       interval=config.get("history_interval_seconds", 300))
+
+
+# In-memory inverted index used by NotesManager.search_notes
+class SearchIndex:
+    """Maps lowercased word tokens to the notes containing them.
+
+    A sorted copy of the vocabulary makes prefix lookups a bisect followed by
+    a short walk, so a query only touches the posting lists it matches.
+    Postings record how often each note uses the token, and note lengths are
+    kept alongside, which is what rank() needs for BM25 scores.
+    """
+
+    TOKEN_PATTERN = re.compile(r"\w+")
+    # A word in the title counts as this many in the text
+    TITLE_WEIGHT = 3
+    # BM25 term frequency saturation and document length normalization
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    def __init__(self):
+        # token -> {note id: weighted count}
+        self.postings = {}
+        # note id -> {token: weighted count}
+        self.note_tokens = {}
+        self.note_lengths = {}
+        self.total_length = 0
+        self.vocabulary = []
+
+    @classmethod
+    def tokenize(cls, text):
+        return cls.TOKEN_PATTERN.findall(text.lower())
+
+    @classmethod
+    def is_word_query(cls, query):
+        """True when the query is only words separated by whitespace"""
+        tokens = cls.tokenize(query)
+        return bool(tokens) and " ".join(tokens) == " ".join(query.lower().split())
+
+    def build(self, notes):
+        self.postings = {}
+        self.note_tokens = {}
+        self.note_lengths = {}
+        self.total_length = 0
+        for note in notes:
+            note_id = note["id"]
+            counts = self._note_tokens(note)
+            self.note_tokens[note_id] = counts
+            self._set_length(note_id, counts)
+            for token, count in counts.items():
+                self.postings.setdefault(token, {})[note_id] = count
+        self.vocabulary = sorted(self.postings)
+
+    def _note_tokens(self, note):
+        counts = collections.Counter(self.tokenize(note["content"]))
+        for token in self.tokenize(note["title"]):
+            counts[token] += self.TITLE_WEIGHT
+        return counts
+
+    def _set_length(self, note_id, counts):
+        length = sum(counts.values())
+        self.total_length += length - self.note_lengths.get(note_id, 0)
+        self.note_lengths[note_id] = length
+
+    def add(self, note):
+        self.update(note)
+
+    def update(self, note):
+        note_id = note["id"]
+        old_tokens = self.note_tokens.get(note_id, {})
+        new_tokens = self._note_tokens(note)
+        for token in old_tokens.keys() - new_tokens.keys():
+            self._remove_posting(token, note_id)
+        for token, count in new_tokens.items():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = {}
+                bisect.insort(self.vocabulary, token)
+            posting[note_id] = count
+        self.note_tokens[note_id] = new_tokens
+        self._set_length(note_id, new_tokens)
+
+    def remove(self, note_id):
+        for token in self.note_tokens.pop(note_id, ()):
+            self._remove_posting(token, note_id)
+        self.total_length -= self.note_lengths.pop(note_id, 0)
+
+    def _remove_posting(self, token, note_id):
+        posting = self.postings[token]
+        posting.pop(note_id, None)
+        if not posting:
+            del self.postings[token]
+            del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+
+    def _prefix_tokens(self, prefix):
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        for token in itertools.islice(self.vocabulary, start, None):
+            if not token.startswith(prefix):
+                break
+            yield token
+
+    def _prefix_matches(self, prefix):
+        ids = set()
+        for token in self._prefix_tokens(prefix):
+            ids.update(self.postings[token])
+        return ids
+
+    def search(self, query):
+        """Ids of notes with a word starting with each word of the query"""
+        tokens = self.tokenize(query)
+        if not tokens:
+            return set()
+        # Longest words first: they tend to have the smallest candidate sets
+        result = None
+        for token in sorted(set(tokens), key=len, reverse=True):
+            matches = self._prefix_matches(token)
+            result = matches if result is None else result & matches
+            if not result:
+                break
+        return result
+
+    def rank(self, query, k=None, note_ids=None):
+        """(note id, BM25 score) pairs for query, best first.
+
+        Scores the notes search() would return, or just note_ids when given
+        (e.g. the hits of a substring search, some of which may score 0).
+        A query word that is the start of several words counts them all.
+        With k only the k best are returned, picked with a heap instead of
+        sorting every match. Equal scores put the newer note first.
+        """
+        tokens = set(self.tokenize(query))
+        candidates = self.search(query) if note_ids is None else set(note_ids)
+        if not candidates or not self.note_lengths:
+            return []
+        count = len(self.note_lengths)
+        lengths = self.note_lengths
+        k1 = self.BM25_K1
+        # k1 * (1 - b + b * length / average length), split into its parts
+        base = k1 * (1 - self.BM25_B)
+        scale = k1 * self.BM25_B / (self.total_length / count or 1)
+        scores = dict.fromkeys(candidates, 0.0)
+        for token in tokens:
+            words = list(self._prefix_tokens(token))
+            if not words:
+                continue
+            if len(words) == 1:
+                frequencies = self.postings[words[0]]
+                matching = len(frequencies)
+            else:
+                frequencies = {}
+                for word in words:
+                    for note_id, frequency in self.postings[word].items():
+                        frequencies[note_id] = frequencies.get(note_id, 0) + frequency
+                matching = len(frequencies)
+            weight = math.log(1 + (count - matching + 0.5) / (matching + 0.5)) * (k1 + 1)
+            # Walk whichever side is smaller
+            if len(frequencies) > len(scores):
+                for note_id in scores:
+                    frequency = frequencies.get(note_id)
+                    if frequency:
+                        scores[note_id] += weight * frequency / (frequency + base + scale * lengths[note_id])
+            else:
+                for note_id, frequency in frequencies.items():
+                    if note_id in scores:
+                        scores[note_id] += weight * frequency / (frequency + base + scale * lengths[note_id])
+        if k is None:
+            return sorted(scores.items(), key=lambda item: (item[1], item[0]), reverse=True)
+        return heapq.nlargest(k, scores.items(), key=lambda item: (item[1], item[0]))
+
+
+def make_snippet(text, query, width=80, highlight=("[", "]")):
+    """A line of text around the first match of query, matches wrapped in highlight.
+
+    Words match the start of words, as in a words search; other queries
+    match as they are, as in a substring search. Whitespace is collapsed,
+    and an ellipsis marks text cut off at either end.
+    """
+    if SearchIndex.is_word_query(query):
+        tokens = sorted(set(SearchIndex.tokenize(query)), key=len, reverse=True)
+        pattern = re.compile(r"\b(?:" + "|".join(map(re.escape, tokens)) + r")\w*", re.IGNORECASE)
+    else:
+        pattern = re.compile(re.escape(query.strip()) or "$^", re.IGNORECASE)
+    match = pattern.search(text)
+    # Start a little before the match (at a word boundary), unless the
+    # line can start at the beginning and still show it
+    start = 0 if match is None or match.end() <= width else match.start() - width // 4
+    if start:
+        start = text.rfind(" ", 0, start) + 1
+    end = start + width * 2
+    words = text[start:end].split()
+    line, used = "", 0
+    for word in words:
+        if line and len(line) + 1 + len(word) > width:
+            break
+        line = f"{line} {word}" if line else word
+        used += 1
+    snippet = line[:width]
+    if start and text[:start].strip():
+        snippet = "\u2026" + snippet
+    if used < len(words) or text[end:].strip():
+        snippet += "\u2026"
+    before, after = highlight
+    return pattern.sub(lambda found: f"{before}{found.group(0)}{after}", snippet)
+
+
+# Hashed TF-IDF vectors used by NotesManager.related_notes
+class SemanticIndex:
+    """Finds the notes closest to a piece of text by cosine similarity.
+
+    Words are hashed into DIMENSIONS buckets. Note vectors use log term
+    frequency, cosine-normalized, and the query carries the IDF weights
+    (the SMART lnc.ltc scheme), so adding or changing a note never touches
+    the other vectors. Vectors are packed into bucket-sorted numpy arrays
+    and a query is scored with one bincount over the rows of its buckets;
+    notes changed since the last pack are scored on the side until enough
+    of them pile up to repack.
+    """
+
+    DIMENSIONS = 1 << 18
+
+    def __init__(self):
+        self.np = load_numpy()
+        # note id -> (bucket array, weight array)
+        self.vectors = {}
+        self.doc_freq = self.np.zeros(self.DIMENSIONS, dtype=self.np.int32)
+        # (bucket offsets, row numbers, weights, note id per row)
+        self.packed = None
+        self.packed_rows = {}
+        # Notes added, updated or removed since the last pack
+        self.changed = set()
+
+    def vectorize(self, text):
+        np = self.np
+        tokens = SearchIndex.tokenize(text)
+        if not tokens:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        mask = self.DIMENSIONS - 1
+        buckets = np.fromiter(map(hash, tokens), dtype=np.int64, count=len(tokens)) & mask
+        buckets, counts = np.unique(buckets.astype(np.int32), return_counts=True)
+        weights = (1 + np.log(counts)).astype(np.float32)
+        weights /= np.linalg.norm(weights)
+        return buckets, weights
+
+    def build(self, notes):
+        """Vectorize every note at once; same result as add() for each"""
+        np = self.np
+        note_ids = []
+        token_lists = []
+        for note in notes:
+            note_ids.append(note["id"])
+            token_lists.append(SearchIndex.tokenize(note["title"] + "\n" + note["content"]))
+        lengths = [len(tokens) for tokens in token_lists]
+        mask = self.DIMENSIONS - 1
+        buckets = np.fromiter(map(hash, itertools.chain.from_iterable(token_lists)),
+                              dtype=np.int64, count=sum(lengths)) & mask
+        rows = np.repeat(np.arange(len(note_ids), dtype=np.int64), lengths)
+        # Count each (row, bucket) pair in one pass over all notes
+        shift = self.DIMENSIONS.bit_length() - 1
+        keys, counts = np.unique((rows << shift) | buckets, return_counts=True)
+        rows = keys >> shift
+        buckets = (keys & mask).astype(np.int32)
+        weights = (1 + np.log(counts)).astype(np.float32)
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=len(note_ids)))
+        weights /= norms[rows].astype(np.float32)
+        splits = np.cumsum(np.bincount(rows, minlength=len(note_ids)))[:-1]
+        self.vectors = dict(zip(note_ids, zip(np.split(buckets, splits), np.split(weights, splits))))
+        self.doc_freq = np.bincount(buckets, minlength=self.DIMENSIONS).astype(np.int32)
+        self._pack()
+
+    def add(self, note):
+        self.update(note)
+
+    def update(self, note):
+        self.remove(note["id"])
+        vector = self.vectorize(note["title"] + "\n" + note["content"])
+        self.vectors[note["id"]] = vector
+        self.doc_freq[vector[0]] += 1
+        self.changed.add(note["id"])
+
+    def remove(self, note_id):
+        vector = self.vectors.pop(note_id, None)
+        if vector is not None:
+            self.doc_freq[vector[0]] -= 1
+            self.changed.add(note_id)
+
+    def _pack(self):
+        np = self.np
+        note_ids = list(self.vectors)
+        vectors = [self.vectors[note_id] for note_id in note_ids]
+        buckets = np.concatenate([v[0] for v in vectors]) if vectors else np.zeros(0, dtype=np.int32)
+        weights = np.concatenate([v[1] for v in vectors]) if vectors else np.zeros(0, dtype=np.float32)
+        rows = np.repeat(np.arange(len(vectors), dtype=np.int32), [len(v[0]) for v in vectors])
+        order = np.argsort(buckets, kind="stable")
+        offsets = np.zeros(self.DIMENSIONS + 1, dtype=np.int64)
+        np.cumsum(np.bincount(buckets, minlength=self.DIMENSIONS), out=offsets[1:])
+        self.packed = (offsets, rows[order], weights[order], np.array(note_ids, dtype=np.int64))
+        self.packed_rows = {note_id: row for row, note_id in enumerate(note_ids)}
+        self.changed = set()
+
+    def search(self, text, k=5):
+        """Up to k (note id, score) pairs, best first, with a score above zero"""
+        np = self.np
+        buckets, weights = self.vectorize(text)
+        if not len(buckets) or not self.vectors:
+            return []
+        idf = np.log((1 + len(self.vectors)) / (1 + self.doc_freq[buckets])) + 1
+        weights = weights * idf.astype(np.float32)
+        weights /= np.linalg.norm(weights)
+
+        if self.packed is None or len(self.changed) > max(2000, len(self.vectors) // 10):
+            self._pack()
+        offsets, rows, row_weights, row_ids = self.packed
+        starts, ends = offsets[buckets], offsets[buckets + 1]
+        positions = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+        scores = np.bincount(rows[positions], weights=row_weights[positions] * np.repeat(weights, ends - starts),
+                             minlength=len(row_ids))
+        stale = [self.packed_rows[note_id] for note_id in self.changed if note_id in self.packed_rows]
+        scores[stale] = 0
+        candidate_ids, candidate_scores = row_ids, scores
+
+        current = [note_id for note_id in self.changed if len(self.vectors.get(note_id, ((),))[0])]
+        if current:
+            # Score notes changed since the pack against a dense query vector
+            query = np.zeros(self.DIMENSIONS, dtype=np.float32)
+            query[buckets] = weights
+            vectors = [self.vectors[note_id] for note_id in current]
+            products = query[np.concatenate([v[0] for v in vectors])] * np.concatenate([v[1] for v in vectors])
+            starts = np.cumsum([0] + [len(v[0]) for v in vectors[:-1]])
+            candidate_ids = np.concatenate((row_ids, np.array(current, dtype=np.int64)))
+            candidate_scores = np.concatenate((scores, np.add.reduceat(products, starts)))
+
+        k = min(k, len(candidate_scores))
+        top = np.argpartition(-candidate_scores, k - 1)[:k]
+        top = top[np.argsort(-candidate_scores[top])]
+        return [(int(candidate_ids[i]), float(candidate_scores[i])) for i in top if candidate_scores[i] > 0]
+
+
+# Notes management class
+class NotesManager:
+    def __init__(self, notes_file="smart_notes.json", storage=None, lazy=False, autosave=True, build_index=True,
+                 history=True):
+        self.storage = storage if storage is not None else JournalStorage(notes_file)
+        self.notes_file = self.storage.path
+        # Earlier versions of edited notes: True keeps them as the config
+        # file says, or pass a NoteHistory, or None for no history
+        self.history = create_history(self.storage) if history is True else history
+        # Changes not yet written to storage: note id -> "insert", "update"
+        # or "delete". With autosave each change is written straight away;
+        # otherwise they accumulate until save_notes().
+        self.autosave = autosave
+        self.dirty = {}
+        # Lazy mode loads metadata only; bodies are read when first used
+        self.lazy = lazy and self.storage.supports_lazy_load
+        # Other processes may be writing to the same store
+        with self.storage.file_lock:
+            self.notes = self.load_notes()
+            self._storage_signature = self.storage.signature()
+        self._notes_by_id = {note["id"]: note for note in self.notes}
+        self._next_id = self.storage.next_id
+        # In lazy mode the search index needs every body, so it is only
+        # built by the first search that uses it. One-off scripts that use
+        # iter_search() can skip it with build_index=False.
+        self.index = SearchIndex()
+        self._index_built = False
+        self._index_build_lock = threading.Lock()
+        if not self.lazy and build_index:
+            self._build_index()
+        # Built by the first related_notes() call
+        self.semantic_index = None
+        self._semantic_build_lock = threading.Lock()
+        self._semantic_thread = None
+        # Ids changed while an index is built without the lock, one set per build
+        self._builds = []
+        # (updated_at, id) pairs kept sorted, oldest first, for the sidebar
+        self._recency = sorted((note["updated_at"], note["id"]) for note in self.notes)
+        # Guards the notes and index against the background search thread
+        self.lock = threading.RLock()
+        # Held while writing, so saves from different threads don't overlap.
+        # Taken before storage.file_lock, which is taken before self.lock.
+        self._save_lock = threading.RLock()
+        # Bumped on every change so cached search results can be invalidated
+        self.version = 0
+        # What sync() picked up from other processes, until poll_changes()
+        self._external = self._no_changes()
+
+    @METRICS.timed("storage.load")
+    def load_notes(self):
+        return self.storage.load(metadata_only=self.lazy)
+
+    def _build_index(self):
+        self.index.build(self.notes)
+        self._index_built = True
+
+    def _ensure_index(self):
+        # Built without self.lock, so edits and the GUI don't wait on it
+        if not self._index_built:
+            with self._index_build_lock:
+                if not self._index_built:
+                    self._build_unlocked(SearchIndex(), self._install_index)
+
+    def ensure_search_index(self):
+        """Build the word index now rather than on the first search that needs it"""
+        self._ensure_index()
+
+    def _install_index(self, index):
+        self.index = index
+        self._index_built = True
+
+    def ensure_semantic_index(self, wait=True):
+        """Build the vectors related_notes() needs; False without numpy
+
+        With wait=False the build is started on a background thread and
+        this only reports whether the vectors are ready yet.
+        """
+        if self.semantic_index is not None or not NUMPY_AVAILABLE:
+            return self.semantic_index is not None
+        if not wait:
+            with self.lock:
+                if self._semantic_thread is None:
+                    self._semantic_thread = threading.Thread(target=self.ensure_semantic_index, daemon=True)
+                    self._semantic_thread.start()
+            return False
+        with self._semantic_build_lock:
+            if self.semantic_index is None:
+                self._build_unlocked(SemanticIndex(), lambda index: setattr(self, "semantic_index", index))
+        return True
+
+    def _build_unlocked(self, index, install):
+        """Build index from the notes without holding self.lock
+
+        Building takes seconds on a large collection, and searches, edits
+        and the GUI all wait on the lock. Notes changed meanwhile are
+        replayed into the index before install(index) swaps it in.
+        """
+        changed = set()
+        with self.lock:
+            notes = list(self.notes)
+            self._builds.append(changed)
+        built = False
+        try:
+            index.build(notes)
+            built = True
+        finally:
+            with self.lock:
+                self._builds = [other for other in self._builds if other is not changed]
+                if built:
+                    for note_id in changed:
+                        note = self._notes_by_id.get(note_id)
+                        if note is None:
+                            index.remove(note_id)
+                        else:
+                            index.update(note)
+                    install(index)
+
+    def _index_note(self, note):
+        # Caller holds self.lock
+        if self._index_built:
+            self.index.update(note)
+        if self.semantic_index is not None:
+            self.semantic_index.update(note)
+        for changed in self._builds:
+            changed.add(note["id"])
+
+    def _unindex_note(self, note_id):
+        # Caller holds self.lock
+        if self._index_built:
+            self.index.remove(note_id)
+        if self.semantic_index is not None:
+            self.semantic_index.remove(note_id)
+        for changed in self._builds:
+            changed.add(note_id)
+
+    @METRICS.timed("storage.save")
+    def save_notes(self):
+        """Write the notes changed since the last save; returns how many
+
+        The pending changes are copied under the lock and written outside
+        it, so a slow disk never holds up edits made in the meantime. Other
+        processes' changes are synced in first, under the store's file lock.
+        """
+        with self._save_lock, self.storage.file_lock:
+            self.sync()
+            with self.lock:
+                pending = [(note_id, change, self._copy_note(note_id, change))
+                           for note_id, change in self.dirty.items()]
+                self.dirty = {}
+            written = 0
+            try:
+                while written < len(pending):
+                    note_id, change, note = pending[written]
+                    if change == "insert":
+                        # Runs of new notes go to storage as one batch
+                        end = written + 1
+                        while end < len(pending) and pending[end][1] == "insert":
+                            end += 1
+                        self.storage.insert_many([entry[2] for entry in pending[written:end]])
+                        written = end
+                        continue
+                    if change == "delete":
+                        self.storage.delete(note_id)
+                    else:
+                        self.storage.update(note)
+                    written += 1
+            finally:
+                with self.lock:
+                    # Anything not written is pending again for the next save
+                    for note_id, change, note in pending[written:]:
+                        self.dirty[note_id] = self._merge_change(change, self.dirty.get(note_id))
+                    for note_id, change, note in pending[:written]:
+                        if note_id not in self.dirty and note_id in self._notes_by_id:
+                            self._release(self._notes_by_id[note_id])
+                # Our own writes aren't changes to pick up
+                self._storage_signature = self.storage.signature()
+            if self.history is not None:
+                self.history.flush()
+            return written
+
+    def _copy_note(self, note_id, change):
+        if change == "delete":
+            return None
+        note = self._notes_by_id[note_id]
+        if isinstance(note, LazyNote):
+            return LazyNote(note, note.storage)
+        return dict(note)
+
+    @staticmethod
+    def _merge_change(previous, change):
+        if change is None:
+            return previous
+        if previous == "insert" and change == "update":
+            # Still a new note as far as storage is concerned
+            return "insert"
+        return change
+
+    @METRICS.timed("storage.save_all")
+    def save_all_notes(self):
+        """Rewrite every note to storage in one go"""
+        with self._save_lock, self.storage.file_lock:
+            self.sync()
+            with self.lock:
+                self.storage.save_all(self.notes)
+                self.dirty = {}
+                for note in self.notes:
+                    self._release(note)
+            self._storage_signature = self.storage.signature()
+            if self.history is not None:
+                self.history.flush()
+
+    def storage_changed(self):
+        """True if the store on disk changed since this manager last read or wrote it"""
+        return self.storage.signature() != self._storage_signature
+
+    def sync(self):
+        """Apply notes other processes have saved since the last sync.
+
+        Call with storage.file_lock held. Unsaved changes made here win over
+        the stored versions of the same notes; a new note whose id was taken
+        meanwhile gets a fresh one. Returns True if any note changed.
+        """
+        signature = self.storage.signature()
+        if signature == self._storage_signature:
+            return False
+        with self.lock:
+            known = dict(self._notes_by_id)
+        notes, deleted = self.storage.changes(known, metadata_only=self.lazy)
+        self._storage_signature = signature
+        return self._apply_external(notes, deleted)
+
+    def poll_changes(self):
+        """Sync if the store changed, without waiting for another writer.
+
+        Costs a stat or two per call when nothing changed, so it can run on
+        a timer. Returns what other processes changed since the last call,
+        including anything picked up by saves in between, as a dict with
+        "changed" and "deleted" id sets and a "renumbered" old -> new id
+        dict; None if nothing changed.
+        """
+        if self.storage_changed() and self.storage.file_lock.acquire(blocking=False):
+            try:
+                self.sync()
+            finally:
+                self.storage.file_lock.release()
+        with self.lock:
+            changes = self._external
+            if not any(changes.values()):
+                return None
+            self._external = self._no_changes()
+            return changes
+
+    @staticmethod
+    def _no_changes():
+        return {"changed": set(), "deleted": set(), "renumbered": {}}
+
+    def _apply_external(self, notes, deleted):
+        with self.lock:
+            changed = False
+            # Notes to swap or drop in self.notes, keyed by id() of the old
+            # dict, so the list is rebuilt once rather than searched per note
+            replaced = {}
+            removed = set()
+            for note in notes:
+                note_id = note["id"]
+                change = self.dirty.get(note_id)
+                if change == "insert":
+                    # Another process stored a different note under this id
+                    self._renumber(note_id)
+                elif change is not None:
+                    # Edited or deleted here since; that is what gets saved
+                    continue
+                local = self._notes_by_id.get(note_id)
+                if local == note and not isinstance(note, LazyNote):
+                    # Already have it, e.g. our own write read back. (Lazy
+                    # notes compare without their bodies, so can't be skipped.)
+                    continue
+                if local is None:
+                    self.notes.append(note)
+                    self._notes_by_id[note_id] = note
+                    self._index_note(note)
+                else:
+                    # Swapped rather than changed in place: other threads may
+                    # be reading the old dict without the lock
+                    self._remove_recency(local)
+                    replaced[id(local)] = note
+                    self._notes_by_id[note_id] = note
+                    self._index_note(note)
+                bisect.insort(self._recency, (note["updated_at"], note_id))
+                self._external["changed"].add(note_id)
+                changed = True
+
+            for note_id in deleted:
+                change = self.dirty.get(note_id)
+                if change == "insert":
+                    self._renumber(note_id)
+                    continue
+                if change == "update":
+                    # Edited here after another process deleted it: store it again
+                    self.dirty[note_id] = "insert"
+                    continue
+                note = self._notes_by_id.pop(note_id, None)
+                if note is None:
+                    continue
+                removed.add(id(note))
+                self._unindex_note(note_id)
+                self._remove_recency(note)
+                self._external["changed"].discard(note_id)
+                self._external["deleted"].add(note_id)
+                changed = True
+
+            if replaced or removed:
+                # In place: storage may hold the same list
+                self.notes[:] = [replaced.get(id(note), note) for note in self.notes if id(note) not in removed]
+            if changed:
+                self.version += 1
+            return changed
+
+    def _renumber(self, note_id):
+        # Storage has already seen the other note, so the next id is free
+        note = self._notes_by_id.pop(note_id)
+        self._remove_recency(note)
+        self._unindex_note(note_id)
+        new_id = self._get_next_id()
+        note["id"] = new_id
+        self._notes_by_id[new_id] = note
+        bisect.insort(self._recency, (note["updated_at"], new_id))
+        self._index_note(note)
+        del self.dirty[note_id]
+        self.dirty[new_id] = "insert"
+        if self.history is not None:
+            self.history.renumber(note_id, new_id)
+        self._external["renumbered"][note_id] = new_id
+        self.version += 1
+
+    def _mark_dirty(self, note_id, change):
+        self.dirty[note_id] = self._merge_change(self.dirty.get(note_id), change)
+
+    def _autosave(self):
+        # Called once the lock is released, as save_notes takes it itself
+        if self.autosave:
+            self.save_notes()
+
+    def add_note(self, title, content):
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        note_id = self._get_next_id()
+
+        new_note = {
+            "id": note_id,
+            "title": title,
+            "content": content,
+            "created_at": timestamp,
+            "updated_at": timestamp
+        }
+        if self.lazy:
+            new_note = LazyNote(new_note, self.storage)
+
+        with self.lock:
+            self.notes.append(new_note)
+            self._notes_by_id[note_id] = new_note
+            self._index_note(new_note)
+            bisect.insort(self._recency, (timestamp, note_id))
+            self.version += 1
+            self._mark_dirty(note_id, "insert")
+        self._autosave()
+        return note_id
+
+    def add_notes(self, notes):
+        """Add (title, content) pairs in one batch; returns the new ids
+
+        Unlike calling add_note in a loop, autosave writes the whole batch
+        to storage in one go.
+        """
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        note_ids = []
+        with self.lock:
+            for title, content in notes:
+                note_id = self._get_next_id()
+                new_note = {
+                    "id": note_id,
+                    "title": title,
+                    "content": content,
+                    "created_at": timestamp,
+                    "updated_at": timestamp
+                }
+                if self.lazy:
+                    new_note = LazyNote(new_note, self.storage)
+                self.notes.append(new_note)
+                self._notes_by_id[note_id] = new_note
+                self._index_note(new_note)
+                self._recency.append((timestamp, note_id))
+                self._mark_dirty(note_id, "insert")
+                note_ids.append(note_id)
+            # Same timestamp and rising ids, so one sort restores the order
+            self._recency.sort()
+            self.version += 1
+        self._autosave()
+        return note_ids
+
+    def _get_next_id(self):
+        # Counter is persisted by the storage backend, so ids of deleted
+        # notes are never reused
+        note_id = max(self._next_id, self.storage.next_id)
+        self._next_id = note_id + 1
+        return note_id
+
+    def update_note(self, note_id, title=None, content=None):
+        with self.lock:
+            note = self._notes_by_id.get(note_id)
+            if note is None:
+                return False
+            if self.history is not None and (title is not None and title != note["title"]
+                                             or content is not None and content != note["content"]):
+                self.history.record(note_id, note["title"], note["content"], note["updated_at"])
+            self._remove_recency(note)
+            if title is not None:
+                note["title"] = title
+            if content is not None:
+                note["content"] = content
+            note["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self._index_note(note)
+            bisect.insort(self._recency, (note["updated_at"], note_id))
+            self.version += 1
+            self._mark_dirty(note_id, "update")
+        self._autosave()
+        return True
+
+    def delete_note(self, note_id):
+        with self.lock:
+            note = self._notes_by_id.pop(note_id, None)
+            if note is None:
+                return False
+            # list.remove matches by identity first, so this is a C-level
+            # memmove rather than a Python loop comparing ids
+            self.notes.remove(note)
+            self._unindex_note(note_id)
+            self._remove_recency(note)
+            self.version += 1
+            self._mark_dirty(note_id, "delete")
+            if self.history is not None:
+                self.history.forget(note_id)
+        self._autosave()
+        return True
+
+    def list_revisions(self, note_id):
+        """Saved earlier versions of a note, newest first, as dicts of
+        revision number, saved_at, updated_at and title"""
+        if self.history is None:
+            return []
+        return self.history.revisions(note_id)
+
+    def get_revision(self, note_id, revision):
+        """An earlier version of a note with its content, or None"""
+        if self.history is None:
+            return None
+        return self.history.get(note_id, revision)
+
+    def restore_revision(self, note_id, revision):
+        """Put an earlier version's title and content back into a note.
+
+        The text it replaces becomes a revision too, so a restore can be undone.
+        """
+        earlier = self.get_revision(note_id, revision)
+        if earlier is None:
+            return False
+        with self.lock:
+            note = self._notes_by_id.get(note_id)
+            if note is None:
+                return False
+            self.history.record(note_id, note["title"], note["content"], note["updated_at"], force=True)
+        return self.update_note(note_id, title=earlier["title"], content=earlier["content"])
+
+    @staticmethod
+    def _release(note):
+        # Once a lazy note's new body is stored it is read back on demand
+        if isinstance(note, LazyNote):
+            note.release()
+
+    def close(self):
+        # Closing can rewrite files (e.g. compaction), so keep other writers out
+        with self._save_lock, self.storage.file_lock:
+            self.save_notes()
+            self.storage.close()
+
+    @staticmethod
+    def resolve_search_mode(query, mode="auto"):
+        if mode == "auto":
+            return "words" if SearchIndex.is_word_query(query) else "substring"
+        return mode
+
+    @METRICS.timed("search")
+    def search_notes(self, query, mode="auto", cancelled=None):
+        """Find notes matching query.
+
+        mode "words" matches notes containing a word starting with each word
+        of the query, using the inverted index. mode "substring" keeps the
+        original behaviour of matching the query anywhere in the title or
+        content. "auto" uses the index unless the query has characters other
+        than words and spaces. If the optional cancelled callable starts
+        returning True the scan stops early and None is returned.
+        """
+        mode = self.resolve_search_mode(query, mode)
+        if mode == "words":
+            self._ensure_index()
+            with self.lock:
+                return self._notes_for_ids(self.index.search(query))
+
+        # Storage guards its own search, and a scan runs over a copy of the
+        # list, so other searches and edits don't wait for this one
+        matching_ids = self.storage.search(query)
+        with self.lock:
+            if matching_ids is not None:
+                return self._notes_for_ids(matching_ids)
+            notes = list(self.notes)
+        return self.filter_notes(notes, query, mode, cancelled)
+
+    @METRICS.timed("search.rank")
+    def rank_notes(self, query, notes=None, k=None):
+        """Notes matching query as (note, BM25 score) pairs, best first.
+
+        By default the notes a words search would return are ranked; pass
+        notes (e.g. search_notes() results) to rank just those. k keeps
+        only the k best. Builds the word index if it isn't yet.
+        """
+        self._ensure_index()
+        with self.lock:
+            note_ids = None if notes is None else [note["id"] for note in notes]
+            return [(self._notes_by_id[note_id], score) for note_id, score in self.index.rank(query, k, note_ids)
+                    if note_id in self._notes_by_id]
+
+    @METRICS.timed("search.filter")
+    def filter_notes(self, notes, query, mode="auto", cancelled=None):
+        """Keep the notes from the given list that match query.
+
+        Used to narrow an earlier result set when a query is extended.
+        Returns None if cancelled. The lock is only held to look up the
+        notes' words; the matching runs outside it.
+        """
+        mode = self.resolve_search_mode(query, mode)
+        if mode == "words":
+            self._ensure_index()
+            query_tokens = SearchIndex.tokenize(query)
+            with self.lock:
+                # The index replaces a note's word counts rather than changing them
+                note_tokens = self.index.note_tokens
+                token_counts = [note_tokens.get(note["id"], ()) for note in notes]
+        else:
+            query = query.lower()
+        results = []
+
+        for i, note in enumerate(notes):
+            if cancelled is not None and i % 256 == 0 and cancelled():
+                return None
+            if mode == "words":
+                if all(any(token.startswith(q) for token in token_counts[i]) for q in query_tokens):
+                    results.append(note)
+            elif query in note["title"].lower() or query in note["content"].lower():
+                results.append(note)
+
+        return results
+
+    def iter_search(self, query, mode="auto"):
+        """Yield the notes search_notes() would return, as they are found.
+
+        For one-off searches such as the command line: unless the word index
+        is already built, notes are scanned directly rather than indexing the
+        whole collection first, so the first results arrive straight away.
+        """
+        mode = self.resolve_search_mode(query, mode)
+        if mode == "words" and self._index_built:
+            yield from self.search_notes(query, mode)
+            return
+        if mode == "words":
+            # A word starting with the token is the token at a word boundary
+            patterns = [re.compile(r"\b" + re.escape(token)) for token in set(SearchIndex.tokenize(query))]
+            if not patterns:
+                return
+            for note in list(self.notes):
+                text = note["title"].lower() + "\n" + note["content"].lower()
+                if all(pattern.search(text) for pattern in patterns):
+                    yield note
+            return
+
+        matching_ids = self.storage.search(query)
+        if matching_ids is not None:
+            yield from self._notes_for_ids(matching_ids)
+            return
+        query = query.lower()
+        for note in list(self.notes):
+            if query in note["title"].lower() or query in note["content"].lower():
+                yield note
+
+    @METRICS.timed("search.related")
+    def related_notes(self, text, k=5, wait=True):
+        """Up to k notes most similar to text, best first; [] without numpy
+
+        With wait=False, [] while the vectors are still being built.
+        """
+        if not self.ensure_semantic_index(wait):
+            return []
+        with self.lock:
+            matches = self.semantic_index.search(text, k)
+            return [self._notes_by_id[note_id] for note_id, score in matches if note_id in self._notes_by_id]
+
+    def get_all_notes(self):
+        return self.notes
+
+    def get_notes_by_recency(self, before=None, limit=None):
+        """Notes, most recently updated first.
+
+        For paging: before, an (updated_at, id) pair, starts the list with
+        the note following that one, and limit caps its length.
+        """
+        with self.lock:
+            end = len(self._recency) if before is None else bisect.bisect_left(self._recency, tuple(before))
+            start = 0 if limit is None else max(end - limit, 0)
+            page = self._recency[start:end]
+        # Looked up outside the lock; a note deleted meanwhile is left out
+        notes_by_id = self._notes_by_id
+        return [note for note in (notes_by_id.get(note_id) for _, note_id in reversed(page)) if note is not None]
+
+    def _remove_recency(self, note):
+        position = bisect.bisect_left(self._recency, (note["updated_at"], note["id"]))
+        del self._recency[position]
+
+    def get_note_by_id(self, note_id):
+        return self._notes_by_id.get(note_id)
+
+    def _notes_for_ids(self, note_ids):
+        # Ids only ever grow, so id order is the order notes were added in
+        return [self._notes_by_id[note_id] for note_id in sorted(note_ids) if note_id in self._notes_by_id]
+
+# Sidebar search runner
+class BackgroundSearch:
+    """Runs NotesManager searches on a worker thread, newest query wins.
+
+    submit() supersedes any query still queued or running; superseded work
+    is abandoned and never reported. When a query extends the previous one
+    (and no note changed in between) only the previous results are filtered.
+    Finished searches are put on the results queue as (generation, query,
+    notes) for the Tk thread to pick up; submitted with top_k, the notes are
+    the top_k best matches by relevance, best first.
+    """
+
+    def __init__(self, notes_manager):
+        self.notes_manager = notes_manager
+        self.results = queue.Queue()
+        self.generation = 0
+        self._requests = queue.Queue()
+        # (query, mode, notes version, results) of the last completed search
+        self._last = None
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, query, top_k=None):
+        self.generation += 1
+        self._requests.put((self.generation, query, top_k))
+        return self.generation
+
+    def cancel(self):
+        """Abandon whatever search is pending"""
+        self.generation += 1
+
+    def _run(self):
+        while True:
+            generation, query, top_k = self._requests.get()
+            if generation != self.generation:
+                continue
+            notes = self._search(query, lambda: generation != self.generation)
+            if notes is not None and top_k and generation == self.generation:
+                notes = [note for note, score in self.notes_manager.rank_notes(query, notes, top_k)]
+            if notes is not None:
+                self.results.put((generation, query, notes))
+
+    def _search(self, query, cancelled):
+        manager = self.notes_manager
+        mode = manager.resolve_search_mode(query)
+        version = manager.version
+        last = self._last
+        if (last is not None and query.lower().startswith(last[0].lower())
+                and mode == last[1] and version == last[2]):
+            notes = manager.filter_notes(last[3], query, mode, cancelled)
+        else:
+            notes = manager.search_notes(query, mode, cancelled)
+        if notes is not None:
+            self._last = (query, mode, version, notes)
+        return notes
+
+
+# Background autosave
+class AutosaveWriter:
+    """Writes a NotesManager's pending changes from a worker thread.
+
+    Call notify() after each change. Changes are coalesced into one save
+    once no change has arrived for quiet_period seconds, or max_delay
+    seconds after the first unsaved change if edits keep coming. flush()
+    asks for a save straight away and can wait for it to finish; without
+    waiting, pass what it returns to flushed() to see when it has.
+    """
+
+    def __init__(self, notes_manager, quiet_period=2.0, max_delay=10.0):
+        self.notes_manager = notes_manager
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        self.saving = False
+        self.last_error = None
+        self.last_saved = None
+        self._condition = threading.Condition()
+        self._first_change = None
+        self._last_change = None
+        # flush() requests are numbered so a waiter knows when the save
+        # that started after its request has finished
+        self._flush_requested = 0
+        self._flush_done = 0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        with self._condition:
+            now = time.monotonic()
+            if self._first_change is None:
+                self._first_change = now
+            self._last_change = now
+            self._condition.notify()
+
+    def flush(self, wait=True):
+        with self._condition:
+            self._flush_requested += 1
+            request = self._flush_requested
+            self._condition.notify()
+            while wait and self._flush_done < request and self._thread.is_alive():
+                self._condition.wait(0.5)
+            return request
+
+    def flushed(self, request):
+        """True once the save asked for by flush() returning request is done"""
+        with self._condition:
+            return self._flush_done >= request or not self._thread.is_alive()
+
+    @property
+    def pending(self):
+        """True while there are changes that haven't reached storage"""
+        return (self.saving or self._first_change is not None
+                or bool(self.notes_manager.dirty))
+
+    def stop(self):
+        """Save anything pending, then end the worker thread"""
+        self.flush(wait=True)
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and self._flush_requested == self._flush_done:
+                    if self._first_change is None:
+                        self._condition.wait()
+                        continue
+                    due = min(self._last_change + self.quiet_period,
+                              self._first_change + self.max_delay)
+                    remaining = due - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._stopped:
+                    return
+                request = self._flush_requested
+                self._first_change = self._last_change = None
+                self.saving = True
+
+            try:
+                self.notes_manager.save_notes()
+                self.last_error = None
+                self.last_saved = datetime.now()
+            except Exception as e:
+                # The changes stay dirty in the manager; try again later
+                self.last_error = e
+                print(f"Autosave failed: {e}", file=sys.stderr)
+
+            with self._condition:
+                self.saving = False
+                self._flush_done = request
+                if self.last_error is not None and self._first_change is None:
+                    self._first_change = self._last_change = time.monotonic()
+                self._condition.notify_all()
+
+
+# Bulk import and export
+IMPORT_EXTENSIONS = (".md", ".txt")
+
+
+def note_file_name(note):
+    """File name a note is exported under: its id plus a slug of the title"""
+    slug = re.sub(r"[^\w\s-]", "", note["title"]).strip()
+    slug = re.sub(r"\s+", "-", slug)[:60] or "note"
+    return f"{note['id']}-{slug}.md"
+
+
+def note_to_markdown(note):
+    return f"# {note['title']}\n\n{note['content']}\n"
+
+
+def read_note_file(path):
+    """Parse one .md/.txt file into (title, content).
+
+    A Markdown file starting with a "# " heading takes its title from it,
+    as written by export_notes; otherwise the file name is the title.
+    Module level so a process pool can run it.
+    """
+    with open(path, 'r', encoding="utf-8", errors="replace") as file:
+        text = file.read()
+    title = os.path.splitext(os.path.basename(path))[0]
+    if path.lower().endswith(".md") and text.startswith("# "):
+        heading, _, text = text.partition("\n")
+        title = heading[2:].strip() or title
+        if text.startswith("\n"):
+            text = text[1:]
+    return title, text.rstrip("\n")
+
+
+def find_note_files(directory):
+    """Every importable file under directory, in a stable order"""
+    paths = []
+    for folder, subfolders, files in os.walk(directory):
+        subfolders.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMPORT_EXTENSIONS):
+                paths.append(os.path.join(folder, name))
+    return paths
+
+
+def import_notes(notes_manager, directory, workers=None):
+    """Import a folder tree of .md/.txt files as new notes; returns their ids.
+
+    Files are parsed across a process pool (in-process for a handful of
+    files) and added with one NotesManager.add_notes batch, then saved in a
+    single batched write.
+    """
+    paths = find_note_files(directory)
+    if workers == 1 or len(paths) < 64:
+        parsed = [read_note_file(path) for path in paths]
+    else:
+        # Imported here, like zipfile and the thread pool below, to keep
+        # importing this module cheap for command-line use
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parsed = list(pool.map(read_note_file, paths, chunksize=64))
+    note_ids = notes_manager.add_notes(parsed)
+    notes_manager.save_notes()
+    return note_ids
+
+
+def export_notes(notes, destination):
+    """Write notes as Markdown files; returns how many were written.
+
+    A destination ending in ".zip" becomes a zip archive written one note
+    at a time, so neither the archive nor all the note bodies are ever held
+    in memory; anything else is a directory of .md files.
+    """
+    count = 0
+    if destination.lower().endswith(".zip"):
+        import zipfile
+        with zipfile.ZipFile(destination, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for note in notes:
+                updated = datetime.strptime(note["updated_at"], "%Y-%m-%d %H:%M:%S")
+                info = zipfile.ZipInfo(note_file_name(note), date_time=updated.timetuple()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info, 'w') as file:
+                    file.write(note_to_markdown(note).encode("utf-8"))
+                count += 1
+    else:
+        os.makedirs(destination, exist_ok=True)
+        for note in notes:
+            with open(os.path.join(destination, note_file_name(note)), 'w', encoding="utf-8") as file:
+                file.write(note_to_markdown(note))
+            count += 1
+    return count
+
+
+# AI assistant backends and worker
+class GeminiBackend:
+    """Streams text chunks of a Google Gemini response.
+
+    One GenerativeModel is built on first use and reused for every request;
+    configure() and set_model() drop it so the next request builds a new one
+    with the new API key or model name.
+    """
+
+    def __init__(self, model_name="gemini-1.5-flash", generation_config=None, api_key=None):
+        self.model_name = model_name
+        self.generation_config = generation_config or {}
+        self.api_key = api_key
+        self._model = None
+        self._lock = threading.Lock()
+
+    def configure(self, api_key):
+        with self._lock:
+            if api_key != self.api_key:
+                self.api_key = api_key
+                self._model = None
+
+    def set_model(self, model_name):
+        with self._lock:
+            if model_name != self.model_name:
+                self.model_name = model_name
+                self._model = None
+
+    def get_model(self):
+        with self._lock:
+            if self._model is None:
+                if load_genai() is None:
+                    raise RuntimeError("Google Generative AI library not installed")
+                if self.api_key:
+                    genai.configure(api_key=self.api_key)
+                self._model = genai.GenerativeModel(self.model_name)
+            return self._model
+
+    def warm(self):
+        """Import the library and build the model ahead of the first request"""
+        try:
+            self.get_model()
+        except Exception:
+            # Reported properly when a request actually needs the model
+            pass
+
+    def stream(self, prompt):
+        model = self.get_model()
+        response = model.generate_content(prompt, generation_config=self.generation_config or None, stream=True)
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+
+class ResponseCache:
+    """Two-tier cache of AI responses keyed by a hash of the request.
+
+    Recent entries sit in an in-memory LRU; every entry is also written to
+    its own file under directory, and the oldest files are evicted once
+    they add up to more than max_disk_bytes. Entries older than ttl seconds
+    (if set) count as misses.
+    """
+
+    def __init__(self, directory="smartnotes_ai_cache", memory_entries=128,
+                 max_disk_bytes=50 * 1024 * 1024, ttl=None):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.memory = collections.OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # key -> (size, last used) of the files on disk, for eviction
+        self._disk = {}
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                self._disk[entry.name[:-5]] = (stat.st_size, stat.st_mtime)
+        self._disk_bytes = sum(size for size, _ in self._disk.values())
+
+    @staticmethod
+    def make_key(model_name, prompt, params=None):
+        request = json.dumps({"model": model_name, "prompt": prompt, "params": params or {}}, sort_keys=True)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key):
+        """Return the cached response text, or None on a miss"""
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            if key in self._disk:
+                try:
+                    with open(self._path(key), 'r') as f:
+                        created, text = json.load(f)
+                except (OSError, ValueError):
+                    created, text = 0, None
+                if text is not None and not self._expired(created):
+                    now = time.time()
+                    os.utime(self._path(key), (now, now))
+                    self._disk[key] = (self._disk[key][0], now)
+                    self._remember(key, created, text)
+                    self.disk_hits += 1
+                    return text
+            self.misses += 1
+            return None
+
+    def put(self, key, text):
+        created = time.time()
+        data = json.dumps([created, text])
+        with self._lock:
+            self._remember(key, created, text)
+            temp_file = self._path(key) + ".tmp"
+            with open(temp_file, 'w') as f:
+                f.write(data)
+            os.replace(temp_file, self._path(key))
+            old_size = self._disk.get(key, (0, 0))[0]
+            self._disk[key] = (len(data.encode("utf-8")), created)
+            self._disk_bytes += self._disk[key][0] - old_size
+            self._evict_disk()
+
+    def _remember(self, key, created, text):
+        self.memory[key] = (created, text)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        for key, (size, _) in sorted(self._disk.items(), key=lambda item: item[1][1]):
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            del self._disk[key]
+            self.memory.pop(key, None)
+            self._disk_bytes -= size
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        return {
+            "hits": hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / (hits + self.misses) if hits + self.misses else 0.0,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+        }
+
+
+class CachedBackend:
+    """Serves repeated prompts from a ResponseCache, streaming only misses.
+
+    stream(prompt, fresh=True) skips the lookup but still stores the new
+    answer. A response is only cached once it has streamed in full.
+    """
+
+    def __init__(self, backend, cache):
+        self.backend = backend
+        self.cache = cache
+
+    def stream(self, prompt, fresh=False):
+        model_name = getattr(self.backend, "model_name", type(self.backend).__name__)
+        params = getattr(self.backend, "generation_config", None)
+        key = self.cache.make_key(model_name, prompt, params)
+        if not fresh:
+            text = self.cache.get(key)
+            if text is not None:
+                yield text
+                return
+        parts = []
+        for text in self.backend.stream(prompt):
+            parts.append(text)
+            yield text
+        self.cache.put(key, "".join(parts))
+
+
+# Words and single punctuation marks, as a subword tokenizer sees them
+TOKEN_ESTIMATE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text):
+    """Local estimate of how many tokens a model counts in text.
+
+    Subword tokenizers use about one token per short word, one per six
+    characters or so of longer words and one per punctuation mark; that's
+    close enough for budgeting without a round trip to the service.
+    """
+    return sum((len(word) + 5) // 6 for word in TOKEN_ESTIMATE_PATTERN.findall(text)) + 1
+
+
+class PromptBuilder:
+    """Keeps what is sent to the model within a token budget.
+
+    build() attaches context notes to a request, trimming them to
+    context_tokens between them. A request estimated above max_tokens has
+    to be condensed first: split() cuts it into chunks of chunk_tokens at
+    paragraph or line breaks, and map_prompt()/reduce_request() are the
+    prompts ChunkedBackend uses to condense them and answer from the result.
+    """
+
+    def __init__(self, max_tokens=8000, context_tokens=1500, chunk_tokens=4000):
+        self.max_tokens = max_tokens
+        self.context_tokens = context_tokens
+        self.chunk_tokens = chunk_tokens
+
+    def needs_chunking(self, request):
+        return estimate_tokens(request) > self.max_tokens
+
+    def truncate(self, text, tokens):
+        """Cut text down to about tokens tokens, at a word boundary"""
+        estimate = estimate_tokens(text)
+        while estimate > tokens and text:
+            text = text[:int(len(text) * tokens / estimate * 0.95)]
+            text = text[:text.rfind(" ")] if " " in text else text
+            estimate = estimate_tokens(text)
+        return text
+
+    def build(self, request, context=()):
+        """The prompt for request with as much of the context notes as fits"""
+        budget = self.context_tokens
+        parts = []
+        for note in context:
+            if budget <= 0:
+                break
+            header = f"--- {note['title']} ---\n"
+            content = note["content"]
+            tokens = estimate_tokens(header + content)
+            if tokens > budget:
+                content = self.truncate(content, budget - estimate_tokens(header)) + "..."
+                tokens = budget
+            parts.append(header + content + "\n")
+            budget -= tokens
+        if not parts:
+            return request
+        return "\n".join(["Here are some of my notes that may be relevant:\n"] + parts + [f"My request:\n{request}"])
+
+    def split(self, text):
+        """Chunks of at most chunk_tokens, broken at paragraphs, then lines, then words"""
+        chunks = []
+        current = []
+        current_tokens = 0
+        for piece in self._pieces(text):
+            tokens = estimate_tokens(piece)
+            if current and current_tokens + tokens > self.chunk_tokens:
+                chunks.append("".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += tokens
+        if current:
+            chunks.append("".join(current))
+        return chunks
+
+    def _pieces(self, text):
+        for paragraph in re.split(r"(?<=\n\n)", text):
+            if estimate_tokens(paragraph) <= self.chunk_tokens:
+                yield paragraph
+                continue
+            for line in paragraph.splitlines(True):
+                while estimate_tokens(line) > self.chunk_tokens:
+                    head = self.truncate(line, self.chunk_tokens) or line[:self.chunk_tokens]
+                    yield head
+                    line = line[len(head):]
+                yield line
+
+    @staticmethod
+    def map_prompt(chunk, index, count):
+        return (f"The text below is part {index} of {count} of a long message. Condense it, keeping any "
+                f"instructions or questions word for word and every fact needed to respond to them.\n\n{chunk}")
+
+    @staticmethod
+    def reduce_request(condensed_parts):
+        parts = "\n\n".join(f"[Part {i} of {len(condensed_parts)}]\n{part}"
+                             for i, part in enumerate(condensed_parts, 1))
+        return ("A long message was too big to send at once, so each part of it was condensed. The "
+                f"condensed parts follow in order; respond to the message as a whole.\n\n{parts}")
+
+
+class ChunkedBackend:
+    """Puts every request through a PromptBuilder on its way to the model.
+
+    stream(request, context) sends small requests in one prompt with the
+    context notes trimmed to budget. Oversized ones are condensed map-reduce
+    style: their chunks are condensed by up to concurrency requests at once
+    (again, if the condensed text is still too big) and only the final
+    answer is streamed back.
+    """
+
+    def __init__(self, backend, builder, concurrency=4, max_rounds=3):
+        self.backend = backend
+        self.builder = builder
+        self.concurrency = concurrency
+        self.max_rounds = max_rounds
+
+    def stream(self, request, context=(), fresh=False):
+        # Only cached backends know about fresh
+        options = {"fresh": True} if fresh else {}
+        for _ in range(self.max_rounds):
+            if not self.builder.needs_chunking(request):
+                break
+            chunks = self.builder.split(request)
+
+            def condense(numbered):
+                index, chunk = numbered
+                prompt = self.builder.map_prompt(chunk, index, len(chunks))
+                return "".join(self.backend.stream(prompt, **options)).strip()
+
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                condensed = list(pool.map(condense, enumerate(chunks, 1)))
+            request = self.builder.reduce_request(condensed)
+        else:
+            if self.builder.needs_chunking(request):
+                request = self.builder.truncate(request, self.builder.max_tokens)
+        yield from self.backend.stream(self.builder.build(request, context), **options)
+
+
+class AIWorker:
+    """Runs AI requests off the Tk thread and streams their output back.
+
+    Any object with a stream(prompt) generator of text chunks can serve as
+    the backend. Each request runs on its own thread and reports
+    (request_id, kind, payload) tuples on the events queue, where kind is
+    "chunk", "done" or "error". Only the newest request is live: submitting
+    a new one, or calling cancel(), abandons the previous one, which stops at
+    its next chunk and never reports again.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.events = queue.Queue()
+        self.current_request = 0
+
+    def submit(self, prompt, **options):
+        """Start a request; options are passed on to backend.stream()"""
+        self.current_request += 1
+        request_id = self.current_request
+        threading.Thread(target=self._run, args=(request_id, prompt, options), daemon=True).start()
+        return request_id
+
+    def cancel(self):
+        self.current_request += 1
+
+    def is_current(self, request_id):
+        return request_id == self.current_request
+
+    def _run(self, request_id, prompt, options):
+        start = time.perf_counter()
+        first_chunk = True
+        try:
+            for text in self.backend.stream(prompt, **options):
+                if first_chunk:
+                    METRICS.record("ai.first_chunk", time.perf_counter() - start)
+                    first_chunk = False
+                if not self.is_current(request_id):
+                    return
+                self.events.put((request_id, "chunk", text))
+        except Exception as e:
+            if self.is_current(request_id):
+                self.events.put((request_id, "error", str(e)))
+            return
+        METRICS.record("ai.request", time.perf_counter() - start)
+        if self.is_current(request_id):
+            self.events.put((request_id, "done", None))
+
+
+class AIQuotaError(Exception):
+    """The AI service refused a request for exceeding a rate or quota limit"""
+
+
+def is_quota_error(error):
+    # Gemini reports quota problems as google.api_core ResourceExhausted (429)
+    if isinstance(error, AIQuotaError) or type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    message = str(error).lower()
+    return "429" in message or "quota" in message or "rate limit" in message
+
+
+class FakeAIBackend:
+    """Offline stand-in for GeminiBackend, for exercising batch jobs.
+
+    Each call waits latency seconds and streams back a short reply naming
+    the start of the prompt. quota_errors makes that many calls fail with
+    AIQuotaError first. calls and max_active record how it was driven.
+    """
+
+    model_name = "fake"
+
+    def __init__(self, latency=0.05, quota_errors=0, chunks=3):
+        self.latency = latency
+        self.quota_errors = quota_errors
+        self.chunks = chunks
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def stream(self, prompt):
+        with self._lock:
+            self.calls += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            fail = self.quota_errors > 0
+            if fail:
+                self.quota_errors -= 1
+        try:
+            time.sleep(self.latency)
+            if fail:
+                raise AIQuotaError("429 Resource has been exhausted (fake quota)")
+            words = f"Fake response to: {' '.join(prompt.split()[-8:])}".split(" ")
+            step = max(1, len(words) // self.chunks)
+            for i in range(0, len(words), step):
+                yield " ".join(words[i:i + step]) + (" " if i + step < len(words) else "")
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+class RateLimiter:
+    """Spaces out calls to stay within per-minute request and token budgets.
+
+    acquire(tokens) blocks until starting one more call of that many
+    estimated tokens keeps the last 60 seconds within requests_per_minute
+    and tokens_per_minute; None disables either limit. A single call larger
+    than the whole token budget still goes through once the window is empty.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, clock=time.monotonic, sleep=time.sleep):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        # (start time, tokens) of calls in the last minute
+        self._window = collections.deque()
+        self._tokens = 0
+
+    def acquire(self, tokens=0):
+        while True:
+            with self._lock:
+                now = self.clock()
+                while self._window and self._window[0][0] <= now - 60:
+                    self._tokens -= self._window.popleft()[1]
+                full = ((self.requests_per_minute and len(self._window) >= self.requests_per_minute)
+                        or (self.tokens_per_minute and self._window
+                            and self._tokens + tokens > self.tokens_per_minute))
+                if not full:
+                    self._window.append((now, tokens))
+                    self._tokens += tokens
+                    return
+                wait = self._window[0][0] + 60 - now
+            self.sleep(max(wait, 0.01))
+
+
+BATCH_ACTIONS = {
+    # action: (prompt template, how the reply is written back, heading)
+    "summarize": ("Summarize this note in a few sentences.\n\nTitle: {title}\n\n{content}", "append", "Summary"),
+    "tag": ("Suggest up to five short tags for this note, as a comma-separated list and nothing else.\n\n"
+            "Title: {title}\n\n{content}", "append", "Tags"),
+    "rewrite": ("Rewrite this note to be clearer and better organized, keeping all of its information. "
+                "Reply with the rewritten note only.\n\nTitle: {title}\n\n{content}", "replace", None),
+}
+# The placeholders filled in a batch prompt; other braces are left as written
+PROMPT_FIELD = re.compile(r"\{(title|content)\}")
+
+
+class BatchJobRunner:
+    """Runs one AI prompt over many notes and writes the replies back.
+
+    Up to concurrency requests are in flight at once, started no faster than
+    the RateLimiter allows. A quota error is retried after an exponential
+    backoff (backoff_base * 2**attempt, with jitter) up to max_retries
+    times; other errors fail that note only. Every finished note is logged
+    to "<job_dir>/<job_id>.jsonl" before its reply is applied, and replies
+    are saved to storage save_every at a time, so resume(job_id) after a
+    crash or cancel() picks up where the job stopped without asking for
+    anything twice. progress holds (done, failed, total) for the UI.
+    """
+
+    def __init__(self, notes_manager, backend, concurrency=4, requests_per_minute=None,
+                 tokens_per_minute=None, max_retries=5, backoff_base=1.0, save_every=20,
+                 job_dir="smartnotes_jobs", sleep=time.sleep):
+        self.notes_manager = notes_manager
+        self.backend = backend
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute, sleep=sleep)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.save_every = save_every
+        self.job_dir = job_dir
+        self.sleep = sleep
+        self.progress = (0, 0, 0)
+        self.retries = 0
+        # Worker threads bump retries together
+        self._retries_lock = threading.Lock()
+        # Ids of notes a reply has been written into
+        self.updated = set()
+        self._cancelled = threading.Event()
+
+    def _job_file(self, job_id):
+        return os.path.join(self.job_dir, job_id + ".jsonl")
+
+    def create(self, note_ids, action="summarize", prompt=None, mode=None, heading=None):
+        """Record a new job and return its id; run it with resume(job_id)"""
+        template, default_mode, default_heading = BATCH_ACTIONS.get(action, (None, "append", action.title()))
+        job = {"op": "job", "action": action, "prompt": prompt or template, "mode": mode or default_mode,
+               "heading": heading if heading is not None else default_heading, "note_ids": list(note_ids)}
+        if job["prompt"] is None:
+            raise ValueError(f"Unknown batch action {action!r} and no prompt given")
+        os.makedirs(self.job_dir, exist_ok=True)
+        job_id = datetime.now().strftime("%Y%m%d-%H%M%S-") + action
+        while os.path.exists(self._job_file(job_id)):
+            job_id += "_"
+        self._append(job_id, job)
+        return job_id
+
+    def run(self, note_ids, action="summarize", prompt=None, mode=None, heading=None):
+        return self.resume(self.create(note_ids, action, prompt, mode, heading))
+
+    def unfinished_jobs(self):
+        """Ids of jobs that were interrupted before finishing"""
+        if not os.path.isdir(self.job_dir):
+            return []
+        jobs = []
+        for name in sorted(os.listdir(self.job_dir)):
+            if name.endswith(".jsonl"):
+                records = list(self._records(name[:-len(".jsonl")]))
+                if records and records[-1]["op"] != "done":
+                    jobs.append(name[:-len(".jsonl")])
+        return jobs
+
+    def cancel(self):
+        """Stop starting new requests; the job can be resumed later"""
+        self._cancelled.set()
+
+    def _records(self, job_id):
+        # Same checksummed line format as the notes journal
+        return JournalStorage(self._job_file(job_id))._read_records(self._job_file(job_id))
+
+    def _append(self, job_id, *records):
+        with open(self._job_file(job_id), 'ab') as file:
+            file.write(b"".join(JournalStorage._encode(record) for record in records))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def resume(self, job_id):
+        """Run the job's remaining notes; returns a dict of counts"""
+        self._cancelled.clear()
+        job, replies, applied = None, {}, set()
+        for record in self._records(job_id):
+            if record["op"] == "job":
+                job = record
+            elif record["op"] == "result":
+                replies[record["id"]] = record["text"]
+            elif record["op"] == "applied":
+                applied.update(record["ids"])
+        if job is None:
+            raise ValueError(f"No batch job {job_id!r} in {self.job_dir}")
+
+        # Replies logged before a crash but never saved go in first
+        self._apply(job_id, job, [(note_id, text) for note_id, text in replies.items() if note_id not in applied])
+        todo = [note_id for note_id in job["note_ids"]
+                if note_id not in replies and self.notes_manager.get_note_by_id(note_id) is not None]
+        done, failed, total = len(replies), 0, len(replies) + len(todo)
+        self.progress = (done, failed, total)
+        self.retries = 0
+
+        tasks = queue.Queue()
+        for note_id in todo:
+            tasks.put(note_id)
+        finished = queue.Queue()
+        workers = [threading.Thread(target=self._work, args=(job, tasks, finished), daemon=True)
+                   for _ in range(min(self.concurrency, len(todo)))]
+        for worker in workers:
+            worker.start()
+
+        pending = []
+        running = len(workers)
+        while running:
+            item = finished.get()
+            if item is None:
+                running -= 1
+                continue
+            note_id, text, error = item
+            if error is None:
+                self._append(job_id, {"op": "result", "id": note_id, "text": text})
+                pending.append((note_id, text))
+                done += 1
+            else:
+                self._append(job_id, {"op": "failed", "id": note_id, "error": error})
+                failed += 1
+            self.progress = (done, failed, total)
+            if len(pending) >= self.save_every:
+                self._apply(job_id, job, pending)
+                pending = []
+        self._apply(job_id, job, pending)
+
+        cancelled = self._cancelled.is_set()
+        if not cancelled and not failed:
+            self._append(job_id, {"op": "done"})
+        return {"job_id": job_id, "done": done, "failed": failed, "total": total,
+                "retries": self.retries, "cancelled": cancelled}
+
+    def _work(self, job, tasks, finished):
+        try:
+            while not self._cancelled.is_set():
+                try:
+                    note_id = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                note = self.notes_manager.get_note_by_id(note_id)
+                if note is None:
+                    continue
+                prompt = PROMPT_FIELD.sub(lambda match: note[match.group(1)], job["prompt"])
+                try:
+                    finished.put((note_id, self._request(prompt), None))
+                except Exception as e:
+                    finished.put((note_id, None, str(e)))
+        finally:
+            finished.put(None)
+
+    @METRICS.timed("ai.batch_request")
+    def _request(self, prompt):
+        attempt = 0
+        while True:
+            self.limiter.acquire(estimate_tokens(prompt))
+            try:
+                return "".join(self.backend.stream(prompt)).strip()
+            except Exception as e:
+                if not is_quota_error(e) or attempt >= self.max_retries or self._cancelled.is_set():
+                    raise
+                with self._retries_lock:
+                    self.retries += 1
+                self.sleep(self.backoff_base * 2 ** attempt * (1 + random.random() / 2))
+                attempt += 1
+
+    def _apply(self, job_id, job, replies):
+        """Write replies into their notes and save them as one batch"""
+        if not replies:
+            return
+        for note_id, text in replies:
+            note = self.notes_manager.get_note_by_id(note_id)
+            if note is None:
+                continue
+            if job["mode"] == "replace":
+                content = text
+            else:
+                content = note["content"]
+                # Re-applying after a crash must not add the reply twice
+                if text in content:
+                    continue
+                heading = f"--- {job['heading']} ---\n" if job["heading"] else ""
+                content = f"{content.rstrip()}\n\n{heading}{text}"
+            self.notes_manager.update_note(note_id, content=content)
+            self.updated.add(note_id)
+        self.notes_manager.save_notes()
+        self._append(job_id, {"op": "applied", "ids": [note_id for note_id, text in replies]})
@@ -0,0 +1,349 @@
+"""
+Smart Notes Server
+Serves the notes store as a local HTTP/JSON API, so tools such as browser
+extensions and editor plugins can read and write the same notes. Start it
+with `python smartnotes_cli.py serve`.
+
+Endpoints:
+    GET    /notes?limit=&cursor=         notes, most recently updated first
+    POST   /notes                        {"title", "content"}; returns the new note
+    GET    /notes/<id>                   one note, with its ETag
+    PUT    /notes/<id>                   {"title" and/or "content"}; send If-Match
+    DELETE /notes/<id>                   send If-Match
+    GET    /search?q=&mode=&limit=&cursor=   matching notes, in id order
+
+Pages hold up to limit notes (default 50, at most 500); pass a response's
+next_cursor back as cursor to get the following page.
+"""
+
+import bisect
+import contextlib
+import hashlib
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from smartnotes_core import METRICS
+
+DEFAULT_PORT = 8765
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_BODY_BYTES = 64 * 1024 * 1024
+NOTE_PATH = re.compile(r"/notes/(\d+)")
+CONTENT_LENGTH = re.compile(r"[0-9]+")
+
+
+class ReadWriteLock:
+    """Lets any number of readers in at once, or a single writer.
+
+    Waiting writers go first: new readers queue up behind them, so a steady
+    stream of reads can't hold writes off. Not reentrant.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._condition:
+            while self._writing or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def note_etag(note):
+    """Quoted ETag for a note, derived from its title and content"""
+    digest = hashlib.sha256(f"{note['title']}\0{note['content']}".encode("utf-8")).hexdigest()
+    return f'"{digest[:20]}"'
+
+
+def note_summary(note):
+    # Spelled out field by field: a LazyNote only has its body on request
+    return {
+        "id": note["id"],
+        "title": note["title"],
+        "created_at": note["created_at"],
+        "updated_at": note["updated_at"]
+    }
+
+
+def note_document(note):
+    document = note_summary(note)
+    document["content"] = note["content"]
+    document["etag"] = note_etag(note)
+    return document
+
+
+def etag_matches(header, etag):
+    """True if an If-Match / If-None-Match header value lists etag (or is *)"""
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+class NotesAPI:
+    """NotesManager operations behind the HTTP endpoints.
+
+    Reads share the read side of a ReadWriteLock and run concurrently:
+    NotesManager only holds its own lock for index lookups and to copy the
+    lists it then scans. Writes take the write side, so the ETag check and
+    the change happen atomically. The change is saved after the write lock
+    is released, so readers aren't held up by the disk, and writes that
+    land during a save go out together in the next one. Errors are raised
+    as APIError.
+    """
+
+    def __init__(self, notes_manager):
+        self.notes_manager = notes_manager
+        self.lock = ReadWriteLock()
+
+    @staticmethod
+    def page_size(limit):
+        try:
+            limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+        except ValueError:
+            raise APIError(400, "limit must be a number")
+        return max(1, min(limit, MAX_PAGE_SIZE))
+
+    def list_notes(self, limit=None, cursor=None):
+        limit = self.page_size(limit)
+        before = None
+        if cursor:
+            updated_at, _, note_id = cursor.rpartition("|")
+            if not updated_at or not note_id.isdigit():
+                raise APIError(400, "Invalid cursor")
+            before = (updated_at, int(note_id))
+        with self.lock.read():
+            notes = self.notes_manager.get_notes_by_recency(before=before, limit=limit + 1)
+            page = [note_summary(note) for note in notes[:limit]]
+        next_cursor = None
+        if len(notes) > limit:
+            last = page[-1]
+            next_cursor = f"{last['updated_at']}|{last['id']}"
+        return {"notes": page, "total": len(self.notes_manager.notes), "next_cursor": next_cursor}
+
+    def search(self, query, mode="auto", limit=None, cursor=None):
+        if not query:
+            raise APIError(400, "Missing q")
+        if mode not in ("auto", "words", "substring"):
+            raise APIError(400, "mode must be auto, words or substring")
+        if cursor is not None and not cursor.isdigit():
+            raise APIError(400, "Invalid cursor")
+        limit = self.page_size(limit)
+        after = int(cursor) if cursor else 0
+        with self.lock.read():
+            notes = sorted(self.notes_manager.search_notes(query, mode), key=lambda note: note["id"])
+            start = bisect.bisect_right([note["id"] for note in notes], after)
+            page = [note_summary(note) for note in notes[start:start + limit]]
+        next_cursor = str(page[-1]["id"]) if start + limit < len(notes) else None
+        return {"notes": page, "total": len(notes), "next_cursor": next_cursor}
+
+    def get_note(self, note_id):
+        with self.lock.read():
+            note = self.notes_manager.get_note_by_id(note_id)
+            if note is None:
+                raise APIError(404, f"No note with id {note_id}")
+            return note_document(note)
+
+    def create_note(self, data):
+        title, content = data.get("title", "Untitled"), data.get("content", "")
+        if not isinstance(title, str) or not isinstance(content, str):
+            raise APIError(400, "title and content must be strings")
+        with self.lock.write():
+            note_id = self.notes_manager.add_note(title, content)
+            note = self.notes_manager.get_note_by_id(note_id)
+        # The save syncs first, and if another process took the id meanwhile
+        # the note is renumbered in place, so the document is built after it
+        self.notes_manager.save_notes()
+        with self.lock.read():
+            return note_document(note)
+
+    def update_note(self, note_id, data, if_match=None):
+        title, content = data.get("title"), data.get("content")
+        if title is None and content is None:
+            raise APIError(400, "Nothing to update: send title and/or content")
+        if not isinstance(title, (str, type(None))) or not isinstance(content, (str, type(None))):
+            raise APIError(400, "title and content must be strings")
+        with self.lock.write():
+            self._check_version(note_id, if_match)
+            self.notes_manager.update_note(note_id, title=title, content=content)
+            document = note_document(self.notes_manager.get_note_by_id(note_id))
+        self.notes_manager.save_notes()
+        return document
+
+    def delete_note(self, note_id, if_match=None):
+        with self.lock.write():
+            self._check_version(note_id, if_match)
+            self.notes_manager.delete_note(note_id)
+        self.notes_manager.save_notes()
+
+    def _check_version(self, note_id, if_match):
+        note = self.notes_manager.get_note_by_id(note_id)
+        if note is None:
+            raise APIError(404, f"No note with id {note_id}")
+        if if_match is not None and not etag_matches(if_match, note_etag(note)):
+            raise APIError(412, "The note has changed since it was read; fetch it again")
+
+
+class NotesRequestHandler(BaseHTTPRequestHandler):
+    server_version = "SmartNotes"
+    # Keep-alive, so clients don't pay for a new connection per request
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this the body waits
+    # for the client's delayed ACK, adding ~40 ms to every response
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_api("GET")
+
+    def do_POST(self):
+        self.handle_api("POST")
+
+    def do_PUT(self):
+        self.handle_api("PUT")
+
+    def do_DELETE(self):
+        self.handle_api("DELETE")
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def handle_api(self, method):
+        with METRICS.timer(f"http.{method}"):
+            try:
+                # Read the body before anything can fail, so an error reply
+                # doesn't leave it behind on the kept-alive connection
+                length = (self.headers.get("Content-Length") or "0").strip()
+                if not CONTENT_LENGTH.fullmatch(length):
+                    # Can't tell where the body ends, so the connection can't be reused
+                    self.close_connection = True
+                    raise APIError(400, "Invalid Content-Length")
+                length = int(length)
+                if length > MAX_BODY_BYTES:
+                    self.close_connection = True
+                    raise APIError(413, "Request body too large")
+                self.body = self.rfile.read(length)
+                self.check_token()
+                self.route(method)
+            except APIError as e:
+                self.send_json(e.status, {"error": str(e)})
+            except Exception as e:
+                self.send_json(500, {"error": str(e)})
+
+    def check_token(self):
+        token = self.server.token
+        if token and self.headers.get("Authorization") != f"Bearer {token}":
+            raise APIError(401, "Missing or wrong API token")
+
+    def route(self, method):
+        api = self.server.api
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        note_match = NOTE_PATH.fullmatch(url.path)
+
+        if url.path == "/notes" and method == "GET":
+            self.send_json(200, api.list_notes(query.get("limit"), query.get("cursor")))
+        elif url.path == "/notes" and method == "POST":
+            document = api.create_note(self.read_json())
+            self.send_json(201, document, etag=document["etag"],
+                           headers={"Location": f"/notes/{document['id']}"})
+        elif url.path == "/search" and method == "GET":
+            self.send_json(200, api.search(query.get("q"), query.get("mode", "auto"),
+                                           query.get("limit"), query.get("cursor")))
+        elif note_match and method == "GET":
+            document = api.get_note(int(note_match.group(1)))
+            if_none_match = self.headers.get("If-None-Match")
+            if if_none_match and etag_matches(if_none_match, document["etag"]):
+                self.send_json(304, None, etag=document["etag"])
+            else:
+                self.send_json(200, document, etag=document["etag"])
+        elif note_match and method == "PUT":
+            document = api.update_note(int(note_match.group(1)), self.read_json(), self.headers.get("If-Match"))
+            self.send_json(200, document, etag=document["etag"])
+        elif note_match and method == "DELETE":
+            api.delete_note(int(note_match.group(1)), self.headers.get("If-Match"))
+            self.send_json(204, None)
+        elif url.path in ("/notes", "/search") or note_match:
+            raise APIError(405, f"{method} is not supported on {url.path}")
+        else:
+            raise APIError(404, f"Unknown path {url.path}")
+
+    def read_json(self):
+        # Requiring JSON also stops web pages posting forms to the API:
+        # browsers won't send a cross-site JSON request without asking first
+        if self.headers.get_content_type() != "application/json":
+            raise APIError(415, "Send the body as application/json")
+        try:
+            data = json.loads(self.body or b"{}")
+        except ValueError:
+            raise APIError(400, "Body is not valid JSON")
+        if not isinstance(data, dict):
+            raise APIError(400, "Body must be a JSON object")
+        return data
+
+    def send_json(self, status, document, etag=None, headers=None):
+        body = b"" if document is None else json.dumps(document).encode("utf-8")
+        self.send_response(status)
+        if document is not None:
+            self.send_header("Content-Type", "application/json")
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+
+class NotesServer(ThreadingHTTPServer):
+    """HTTP server answering each connection on its own thread"""
+
+    daemon_threads = True
+
+    def __init__(self, notes_manager, host="127.0.0.1", port=DEFAULT_PORT, token=None, verbose=False):
+        super().__init__((host, port), NotesRequestHandler)
+        self.api = NotesAPI(notes_manager)
+        self.token = token
+        self.verbose = verbose
+
+    def service_actions(self):
+        # Called by serve_forever about twice a second: pick up notes that
+        # the app or other tools saved to the store
+        if self.api.notes_manager.storage_changed():
+            with self.api.lock.write():
+                self.api.notes_manager.poll_changes()